@@ -0,0 +1,103 @@
+"""Train and profile-build cost of JSON features versus packed float32 vectors.
+
+    python -m benchmarks.bench_features --songs 100000 --users 200 --likes 200
+"""
+import argparse
+import json
+import random
+
+import numpy as np
+from sqlalchemy import insert
+
+from benchmarks.common import make_app, seed_users, Timer, report
+from src.models.user import db, Song, UserPreference
+from src.models.features import FEATURE_DIM, normalize_features, pack_vector
+from src.models.feature_store import feature_store
+from src.models.recommendation import recommendation_engine
+
+
+def random_features(rng):
+    return {
+        'danceability': rng.random(), 'energy': rng.random(), 'key': rng.randrange(12),
+        'loudness': -60 * rng.random(), 'mode': rng.randrange(2), 'speechiness': rng.random(),
+        'acousticness': rng.random(), 'instrumentalness': rng.random(), 'liveness': rng.random(),
+        'valence': rng.random(), 'tempo': 60 + 140 * rng.random(),
+    }
+
+
+def seed_songs_with_features(n_songs, rng):
+    rows = []
+    for i in range(n_songs):
+        features = random_features(rng)
+        rows.append({'spotify_id': f'bench_track_{i}', 'title': f'Song {i}', 'artist': f'Artist {i % 500}',
+                     'features': json.dumps(features),
+                     'feature_vector': pack_vector(normalize_features(features))})
+    db.session.execute(insert(Song), rows)
+    db.session.commit()
+    return [song_id for (song_id,) in db.session.query(Song.id).order_by(Song.id)]
+
+
+def json_load_store():
+    """The previous load path: parse and normalize every song's JSON"""
+    rows = db.session.query(Song.id, Song.features).filter(Song.features.isnot(None)).yield_per(10000)
+    feature_store.load((song_id, normalize_features(json.loads(raw))) for song_id, raw in rows)
+
+
+def json_profile(user_id):
+    """The previous profile rebuild: parse and normalize every liked song's JSON"""
+    liked = (db.session.query(Song.features)
+             .join(UserPreference, UserPreference.song_id == Song.id)
+             .filter(UserPreference.user_id == user_id, UserPreference.rating.is_(True),
+                     Song.features.isnot(None)))
+    vectors = [normalize_features(json.loads(raw)) for (raw,) in liked]
+    return np.array(vectors, dtype=np.float64).reshape(-1, FEATURE_DIM).sum(axis=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--likes', type=int, default=200)
+    parser.add_argument('--database', default='sqlite:///:memory:')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    app = make_app(args.database)
+    with app.app_context():
+        db.create_all()
+        song_ids = seed_songs_with_features(args.songs, rng)
+        user_ids = seed_users(args.users)
+        db.session.execute(insert(UserPreference), [
+            {'user_id': user_id, 'song_id': song_id, 'rating': True}
+            for user_id in user_ids for song_id in rng.sample(song_ids, args.likes)
+        ])
+        db.session.commit()
+
+        results = []
+        for name, load in [('json', json_load_store), ('packed', feature_store.load_from_db)]:
+            with Timer() as timer:
+                load()
+                recommendation_engine.train()
+            results.append({'benchmark': f'train.{name}', 'songs': len(feature_store),
+                            'seconds': timer.seconds})
+            recommendation_engine.reset()
+
+        # Profiles are rebuilt from the database, as on a cold worker
+        for name, build in [('json', json_profile), ('packed', recommendation_engine.rebuild_user_profile)]:
+            with Timer() as timer:
+                for user_id in user_ids:
+                    build(user_id)
+            db.session.rollback()
+            results.append({'benchmark': f'profile_build.{name}', 'users': args.users, 'likes': args.likes,
+                            'seconds': timer.seconds, 'users_per_sec': args.users / timer.seconds})
+
+        for stage in ('train', 'profile_build'):
+            json_s, packed_s = (r['seconds'] for r in results if r['benchmark'].startswith(stage + '.'))
+            results.append({'benchmark': f'{stage}.speedup', 'speedup': json_s / packed_s})
+        report(results)
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
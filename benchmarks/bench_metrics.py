@@ -0,0 +1,89 @@
+"""Overhead of the metrics instrumentation, per observation and per API request.
+
+    python -m benchmarks.bench_metrics --songs 10000 --requests 500
+"""
+import argparse
+
+from benchmarks.common import make_api_app, seed_users, Timer, report
+from benchmarks.synthetic import seed_catalog, seed_histories
+from src.models.user import db
+from src.models.metrics import metrics
+from src.models.recommendation import recommendation_engine
+from src.models.serving import serving_cache
+
+ROUTES = ['/api/recommendations/model', '/api/user/profile', '/api/user/preferences', '/api/recommendations']
+
+
+def timed_stage():
+    with metrics.time_stage('bench'):
+        pass
+
+
+def per_observation(n):
+    results = []
+    for name, record in [
+        ('histogram.observe', lambda: metrics.request_seconds.observe(0.003, 'GET', '/api/bench')),
+        ('counter.inc', lambda: metrics.requests.inc('GET', '/api/bench', '200')),
+        ('time_stage', timed_stage),
+    ]:
+        with Timer() as timer:
+            for _ in range(n):
+                record()
+        results.append({'benchmark': f'metrics.{name}', 'calls': n, 'ns_per_call': 1e9 * timer.seconds / n})
+    return results
+
+
+def per_request(client, n):
+    results = []
+    for route in ROUTES:
+        timings = {}
+        # Interleave the two modes so drift in the machine affects both equally
+        for enabled in (False, True, False, True):
+            metrics.enabled = enabled
+            with Timer() as timer:
+                for _ in range(n):
+                    client.get(route)
+            timings.setdefault(enabled, []).append(timer.seconds)
+        off, on = min(timings[False]), min(timings[True])
+        results.append({
+            'benchmark': f'metrics.request {route}',
+            'requests': n,
+            'us_per_request_off': 1e6 * off / n,
+            'us_per_request_on': 1e6 * on / n,
+            'overhead_us': 1e6 * (on - off) / n,
+            'overhead_pct': 100 * (on - off) / off,
+        })
+    metrics.enabled = True
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--observations', type=int, default=200000)
+    parser.add_argument('--database', default='sqlite:///:memory:')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = make_api_app(args.database)
+    with app.app_context():
+        db.create_all()
+        user_ids = seed_users(args.users)
+        song_ids, popularity = seed_catalog(args.songs, seed=args.seed)
+        seed_histories(user_ids, song_ids, popularity, seed=args.seed)
+        recommendation_engine.generate_recommendations(user_ids[0])
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_ids[0]
+
+        results = per_observation(args.observations) + per_request(client, args.requests)
+        report(results)
+        serving_cache.reset()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
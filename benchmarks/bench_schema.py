@@ -0,0 +1,89 @@
+"""Query plans and latency of the feedback and serving lookups before and after the schema migrations.
+
+    python -m benchmarks.bench_schema --users 2000 --per-user 50
+"""
+import argparse
+import random
+
+from sqlalchemy import insert, text
+
+from benchmarks.common import make_app, seed_users, seed_songs, Timer, report
+from src.models.user import db, UserPreference, Recommendation
+from src.models.migrations import migrate
+
+# The hot lookups: submit_feedback/process_feedback and get_recommendations
+QUERIES = {
+    'preference_lookup': 'SELECT * FROM user_preferences WHERE user_id = :user_id AND song_id = :song_id',
+    'user_preferences': 'SELECT song_id FROM user_preferences WHERE user_id = :user_id',
+    'unshown_recommendations': 'SELECT * FROM recommendations WHERE user_id = :user_id AND is_shown = 0 '
+                               'ORDER BY recommendation_score DESC LIMIT 10',
+}
+
+
+def query_plan(sql, params):
+    return [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params)]
+
+
+def measure(stage, samples, repeat):
+    results = []
+    for name, sql in QUERIES.items():
+        with Timer() as timer:
+            for _ in range(repeat):
+                for params in samples:
+                    db.session.execute(text(sql), params).all()
+        results.append({
+            'benchmark': f'schema.{name}',
+            'stage': stage,
+            'plan': query_plan(sql, samples[0]),
+            'queries': repeat * len(samples),
+            'us_per_query': 1e6 * timer.seconds / (repeat * len(samples)),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--per-user', type=int, default=50)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database', default='sqlite:///:memory:')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = make_app(args.database)
+    with app.app_context():
+        db.create_all()
+        # Recreate the schema as it was before the migrations: drop every index they add
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                db.session.execute(text(f'DROP INDEX {index.name}'))
+        user_ids = seed_users(args.users)
+        song_ids = seed_songs(args.songs)
+
+        rng = random.Random(args.seed)
+        pairs = [(user_id, song_id) for user_id in user_ids for song_id in rng.sample(song_ids, args.per_user)]
+        db.session.execute(insert(UserPreference), [
+            {'user_id': user_id, 'song_id': song_id, 'rating': rng.random() < 0.5} for user_id, song_id in pairs])
+        db.session.execute(insert(Recommendation), [
+            {'user_id': user_id, 'song_id': song_id, 'recommendation_score': rng.random(),
+             'is_shown': rng.random() < 0.8} for user_id, song_id in pairs])
+        db.session.commit()
+
+        samples = [{'user_id': user_id, 'song_id': song_id} for user_id, song_id in rng.sample(pairs, args.samples)]
+        results = measure('before', samples, args.repeat)
+        for result in results:
+            # Without the indexes every lookup is a table scan; otherwise the comparison shows nothing
+            assert any(step.startswith('SCAN') for step in result['plan']), \
+                f"{result['benchmark']} used an index before the migrations: {result['plan']}"
+        db.session.commit()
+        migrate(db.engine)
+        db.session.execute(text('ANALYZE'))
+        results += measure('after', samples, args.repeat)
+        report(results)
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Throughput of the recommendation write path.
+
+    python -m benchmarks.bench_store --users 2000 --per-user 10
+"""
+import argparse
+import random
+
+from benchmarks.common import make_app, seed_users, seed_songs, Timer, report
+from src.models.user import db, Recommendation
+from src.models.recommendation import recommendation_engine
+
+
+def row_at_a_time(batch):
+    """The previous write path: one DELETE per user and one ORM add per row"""
+    for user_id, scored in batch.items():
+        Recommendation.query.filter_by(user_id=user_id, is_shown=False).delete()
+        for song_id, score in scored:
+            db.session.add(Recommendation(user_id=user_id, song_id=song_id,
+                                          recommendation_score=score, is_shown=False))
+        db.session.commit()
+
+
+def per_user_bulk(batch):
+    for user_id, scored in batch.items():
+        recommendation_engine.bulk_store_recommendations({user_id: scored})
+
+
+def all_users_bulk(batch):
+    recommendation_engine.bulk_store_recommendations(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--per-user', type=int, default=10)
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--database', default='sqlite:///:memory:')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = make_app(args.database)
+    with app.app_context():
+        db.create_all()
+        user_ids = seed_users(args.users)
+        song_ids = seed_songs(args.songs)
+
+        rng = random.Random(args.seed)
+        batch = {
+            user_id: [(song_id, rng.random()) for song_id in rng.sample(song_ids, args.per_user)]
+            for user_id in user_ids
+        }
+        rows = args.users * args.per_user
+
+        results = []
+        for name, write in [('row_at_a_time', row_at_a_time),
+                            ('bulk_per_user', per_user_bulk),
+                            ('bulk_all_users', all_users_bulk)]:
+            with Timer() as timer:
+                write(batch)
+            assert Recommendation.query.filter_by(is_shown=False).count() == rows
+            results.append({
+                'benchmark': f'store_recommendations.{name}',
+                'users': args.users,
+                'rows': rows,
+                'seconds': timer.seconds,
+                'rows_per_sec': rows / timer.seconds,
+            })
+        report(results)
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
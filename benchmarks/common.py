@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import time
+
+from flask import Flask
+from sqlalchemy import insert
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from src.models.user import db, User, Song
+
+
+def make_app(database_uri='sqlite:///:memory:'):
+    """Bare Flask app bound to a scratch database, so benchmarks never touch real data"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def make_api_app(database_uri='sqlite:///:memory:'):
+    """Scratch app serving the /api blueprints, with background workers off so timings are deterministic"""
+    from src.routes.user import user_bp
+    from src.routes.ai import ai_bp
+    from src.models.recommendation import recommendation_engine
+    from src.models.serving import serving_cache
+    from src.models.regeneration import regeneration_scheduler
+    from src.models.enrichment import enrichment_queue
+    from src.models.metrics import metrics
+
+    app = make_app(database_uri)
+    app.config['SECRET_KEY'] = 'benchmark'
+    app.config['SERVING_WRITE_BEHIND'] = False
+    app.register_blueprint(user_bp, url_prefix='/api')
+    app.register_blueprint(ai_bp, url_prefix='/api')
+    recommendation_engine.init_app(app)
+    serving_cache.init_app(app)
+    regeneration_scheduler.init_app(app)
+    metrics.init_app(app, db)
+    regeneration_scheduler.worker_enabled = False
+    enrichment_queue.worker_enabled = False
+    return app
+
+
+def seed_users(n_users):
+    db.session.execute(insert(User), [
+        {'username': f'bench_user_{i}', 'email': f'bench_{i}@example.com', 'password_hash': 'x'}
+        for i in range(n_users)
+    ])
+    db.session.commit()
+    return [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+
+
+def seed_songs(n_songs):
+    db.session.execute(insert(Song), [
+        {'spotify_id': f'bench_track_{i}', 'title': f'Song {i}', 'artist': f'Artist {i % 500}'}
+        for i in range(n_songs)
+    ])
+    db.session.commit()
+    return [song_id for (song_id,) in db.session.query(Song.id).order_by(Song.id)]
+
+
+class Timer:
+    """Context manager measuring wall-clock seconds"""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+
+
+def report(results):
+    for result in results:
+        print(json.dumps(result))
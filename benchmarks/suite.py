@@ -0,0 +1,197 @@
+"""Engine stage and API route timings on a seeded synthetic catalog, with regression checks.
+
+    python -m benchmarks.suite run --songs 100000 --users 500 --output bench.json
+    python -m benchmarks.suite compare baseline.json bench.json --threshold 0.25
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.common import make_api_app, seed_users, Timer, report
+from benchmarks.synthetic import seed_catalog, seed_histories
+from src.models.user import db, UserProfile
+from src.models.recommendation import recommendation_engine
+from src.models.serving import serving_cache
+
+
+def measure(name, fn, repeat, warmup=1, **extra):
+    """Call ``fn(i)`` ``repeat`` times after ``warmup`` untimed calls; returns latency percentiles"""
+    for i in range(warmup):
+        fn(i)
+    samples = []
+    for i in range(repeat):
+        with Timer() as timer:
+            fn(warmup + i)
+        samples.append(timer.seconds * 1000)
+    samples = np.array(samples)
+    return dict({
+        'benchmark': name,
+        'runs': repeat,
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'min_ms': float(samples.min()),
+    }, **extra)
+
+
+def engine_stages(user_ids, args):
+    """Time each stage of the recommendation pipeline, cycling through the seeded users"""
+    store = recommendation_engine.store
+
+    def user(i):
+        return int(user_ids[i % len(user_ids)])
+
+    def cold_profile(i):
+        UserProfile.query.filter_by(user_id=user(i)).delete()
+        return recommendation_engine.get_user_profile(user(i))
+
+    def generate(i):
+        return recommendation_engine.generate_recommendations(user(i))
+
+    load = measure('engine.load_feature_store', lambda i: store.load_from_db(), args.train_repeat)
+    load['songs'] = len(store)
+    return [
+        load,
+        measure('engine.train', lambda i: recommendation_engine.train(), args.train_repeat,
+                backend=recommendation_engine.index_backend),
+        measure('engine.rebuild_user_profile', lambda i: recommendation_engine.rebuild_user_profile(user(i)),
+                args.repeat),
+        measure('engine.get_user_profile.cold', cold_profile, args.repeat),
+        measure('engine.get_user_profile.warm', lambda i: recommendation_engine.get_user_profile(user(i)),
+                args.repeat),
+        measure('engine.generate_recommendations', generate, args.repeat),
+    ]
+
+
+def route_timings(app, user_ids, song_spotify_ids, args):
+    """Time the /api routes through the Flask test client, logged in as one seeded user"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = int(user_ids[0])
+
+    def call(method, path, expected=200, **kwargs):
+        def run(i):
+            response = client.open(path, method=method, **kwargs)
+            if response.status_code != expected:
+                raise RuntimeError(f'{method} {path} returned {response.status_code}')
+        return run
+
+    def feedback(i):
+        song_id = song_spotify_ids[i % len(song_spotify_ids)]
+        return call('POST', '/api/feedback', json={'song_id': song_id, 'rating': 'like' if i % 3 else 'dislike'})(i)
+
+    def recommendations_miss(i):
+        serving_cache.invalidate([int(user_ids[0])])
+        return call('GET', '/api/recommendations')(i)
+
+    return [
+        measure('route.GET /api/user/profile', call('GET', '/api/user/profile'), args.repeat),
+        measure('route.GET /api/user/preferences', call('GET', '/api/user/preferences'), args.repeat),
+        measure('route.POST /api/feedback', feedback, args.repeat),
+        measure('route.POST /api/recommendations/generate', call('POST', '/api/recommendations/generate'),
+                args.repeat),
+        measure('route.GET /api/recommendations (buffered)', call('GET', '/api/recommendations'), args.repeat),
+        measure('route.GET /api/recommendations (miss)', recommendations_miss, args.repeat),
+        measure('route.GET /api/recommendations/model', call('GET', '/api/recommendations/model'), args.repeat),
+    ]
+
+
+def run(args):
+    app = make_api_app(args.database)
+    with app.app_context():
+        recommendation_engine.reset()
+        serving_cache.reset()
+        recommendation_engine.index_backend = args.backend
+        db.create_all()
+
+        with Timer() as seeding:
+            user_ids = seed_users(args.users)
+            song_ids, popularity = seed_catalog(args.songs, seed=args.seed)
+            ratings = seed_histories(user_ids, song_ids, popularity, mean_ratings=args.ratings, seed=args.seed)
+        spotify_ids = [f'synthetic_{args.seed}_{i}' for i in range(min(args.songs, 1000))]
+
+        results = engine_stages(user_ids, args) + route_timings(app, user_ids, spotify_ids, args)
+        serving_cache.reset()
+        db.drop_all()
+        recommendation_engine.reset()
+
+    output = {
+        'meta': {
+            'songs': args.songs, 'users': args.users, 'ratings': ratings, 'seed': args.seed,
+            'backend': args.backend, 'repeat': args.repeat, 'seed_seconds': seeding.seconds,
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    return 0
+
+
+def compare(args):
+    """Flag benchmarks slower than the baseline by more than the threshold; exit 1 if any are"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    for key in ('songs', 'users', 'seed', 'backend'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"warning: {key} differs ({baseline['meta'].get(key)} vs {current['meta'].get(key)})")
+
+    before = {result['benchmark']: result for result in baseline['results']}
+    regressions = 0
+    for result in current['results']:
+        name = result['benchmark']
+        if name not in before:
+            print(f"{'new':10} {name:45} {result[args.metric]:10.3f} ms")
+            continue
+        old, new = before[name][args.metric], result[args.metric]
+        change = (new - old) / old if old else 0.0
+        regressed = change > args.threshold and new - old > args.min_delta_ms
+        regressions += regressed
+        status = 'REGRESSED' if regressed else ('faster' if change < -args.threshold else 'ok')
+        print(f"{status:10} {name:45} {old:10.3f} -> {new:10.3f} ms ({change:+.1%})")
+
+    print(f"{regressions} regression(s) over {args.threshold:.0%} on {args.metric}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Seed a scratch database and time every stage and route')
+    run_parser.add_argument('--songs', type=int, default=10000)
+    run_parser.add_argument('--users', type=int, default=200)
+    run_parser.add_argument('--ratings', type=int, default=50, help='Median ratings per user')
+    run_parser.add_argument('--repeat', type=int, default=20)
+    run_parser.add_argument('--train-repeat', type=int, default=3)
+    run_parser.add_argument('--backend', default='ball_tree')
+    run_parser.add_argument('--database', default='sqlite:///:memory:')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='Write results and run metadata as JSON')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser('compare', help='Compare a results file against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--metric', default='p50_ms', choices=['mean_ms', 'p50_ms', 'p95_ms', 'min_ms'])
+    compare_parser.add_argument('--threshold', type=float, default=0.20, help='Relative slowdown to flag')
+    compare_parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                                help='Ignore slowdowns smaller than this (timer noise)')
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.handler(args))
+
+
+if __name__ == '__main__':
+    main()
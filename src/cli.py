@@ -0,0 +1,200 @@
+import json
+import os
+from datetime import datetime
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from src.models.ann import INDEX_BACKENDS, BruteForceIndex, create_index, evaluate_index
+from src.models.batch import BatchRecommender
+from src.models.catalog_import import FORMATS, CatalogImporter
+from src.models.enrichment import enrichment_queue
+from src.models.feature_store import feature_store, FEATURE_DIM
+from src.models.recommendation import recommendation_engine
+from src.models.migrations import migrate, migration_status
+from src.models.model_artifacts import list_artifacts, verify_artifact, prune_artifacts
+from src.models.user import db
+
+
+def register_commands(app):
+    """Attach the maintenance commands to ``flask --app src.main ...``"""
+    app.cli.add_command(index_report)
+    app.cli.add_command(recommend_all)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(migrations_command)
+    app.cli.add_command(models_group)
+    app.cli.add_command(import_catalog)
+
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _parse_backend_params(params):
+    """Turn ``backend.name=value`` options into ``{backend: {name: value}}``"""
+    parsed = {}
+    for param in params:
+        key, _, value = param.partition('=')
+        backend, _, name = key.partition('.')
+        if not name or not value:
+            raise click.BadParameter(f"Expected backend.name=value, got '{param}'")
+        parsed.setdefault(backend, {})[name] = _parse_value(value)
+    return parsed
+
+
+@click.command('index-report')
+@click.option('--backend', 'backends', multiple=True, type=click.Choice(sorted(INDEX_BACKENDS)),
+              help='Backend to evaluate (repeatable, default: all)')
+@click.option('--songs', type=int, default=None, help='Use N random songs instead of the catalog')
+@click.option('--queries', type=int, default=200, help='Number of query vectors')
+@click.option('-k', '--neighbors', type=int, default=10, help='Neighbours per query (recall@k)')
+@click.option('--param', 'params', multiple=True, help='Backend parameter, e.g. ivf.n_probe=16')
+@click.option('--seed', type=int, default=0)
+@with_appcontext
+def index_report(backends, songs, queries, neighbors, params, seed):
+    """Report build time, memory use, latency and recall@k of each index backend."""
+    rng = np.random.default_rng(seed)
+    if songs:
+        X = rng.random((songs, FEATURE_DIM), dtype=np.float32)
+    else:
+        if not feature_store.is_loaded:
+            feature_store.load_from_db()
+        X, _, _ = feature_store.snapshot()
+    if not len(X):
+        raise click.ClickException('No songs with features to index')
+
+    # Queries are perturbed catalog rows, like averaged user profiles
+    Q = X[rng.integers(0, len(X), queries)] + rng.normal(0, 0.05, (queries, X.shape[1])).astype(np.float32)
+    _, exact = BruteForceIndex().fit(X).kneighbors(Q, neighbors)
+
+    backend_params = _parse_backend_params(params)
+    for backend in backends or sorted(INDEX_BACKENDS):
+        index = create_index(backend, **backend_params.get(backend, {}))
+        report = evaluate_index(index, X, Q, neighbors, exact=exact)
+        report['params'] = backend_params.get(backend, {})
+        click.echo(json.dumps(report))
+
+
+@click.command('recommend-all')
+@click.option('-n', '--recommendations', type=int, default=10, help='Recommendations per user')
+@click.option('--workers', type=int, default=None, help='Scoring processes (default: CPU count)')
+@click.option('--user-chunk', type=int, default=256, help='Users scored per task')
+@click.option('--catalog-chunk', type=int, default=16384, help='Catalog rows per distance block')
+@click.option('--write-batch', type=int, default=1000, help='Users per bulk insert')
+@with_appcontext
+def recommend_all(recommendations, workers, user_chunk, catalog_chunk, write_batch):
+    """Precompute recommendations for every user with liked songs."""
+    batch = BatchRecommender(recommendation_engine, n_recommendations=recommendations, workers=workers,
+                             user_chunk=user_chunk, catalog_chunk=catalog_chunk, write_batch=write_batch)
+    written = batch.run()
+    click.echo(f'Stored {written} recommendations')
+
+
+@click.command('migrate')
+@click.option('--to', 'target', default=None, help='Stop after this migration version')
+@with_appcontext
+def migrate_command(target):
+    """Apply pending schema migrations to the configured database."""
+    applied = migrate(db.engine, target)
+    for version in applied:
+        click.echo(f'Applied {version}')
+    if not applied:
+        click.echo('Schema is up to date')
+
+
+@click.command('migrations')
+@with_appcontext
+def migrations_command():
+    """List schema migrations and when each was applied."""
+    for version, description, applied_at in migration_status(db.engine):
+        applied = applied_at.isoformat(' ', 'seconds') if applied_at else 'pending'
+        click.echo(f'{version:40} {applied:20} {description}')
+
+
+def _artifact_dir(directory):
+    directory = directory or recommendation_engine.artifact_dir
+    if not directory:
+        raise click.ClickException('No artifact directory: set RECOMMENDER_ARTIFACT_DIR or pass --dir')
+    return directory
+
+
+@click.group('models')
+def models_group():
+    """List, verify and prune saved model artifacts."""
+
+
+@models_group.command('list')
+@click.option('--dir', 'directory', default=None, help='Artifact directory (default: RECOMMENDER_ARTIFACT_DIR)')
+@with_appcontext
+def models_list(directory):
+    """List saved model artifacts, newest first."""
+    for manifest in list_artifacts(_artifact_dir(directory)):
+        created = datetime.fromtimestamp(manifest['created_at']).isoformat(' ', 'seconds')
+        click.echo(f"{manifest['name']:32} {created:20} {manifest['backend']:10} "
+                   f"{manifest['songs']:>9} songs  catalog {manifest['catalog_checksum'][:12]}")
+
+
+@models_group.command('verify')
+@click.argument('names', nargs=-1)
+@click.option('--dir', 'directory', default=None, help='Artifact directory (default: RECOMMENDER_ARTIFACT_DIR)')
+@with_appcontext
+def models_verify(names, directory):
+    """Check file and catalog checksums of saved artifacts (default: all)."""
+    directory = _artifact_dir(directory)
+    names = names or [manifest['name'] for manifest in list_artifacts(directory)]
+    failed = 0
+    for name in names:
+        problems = verify_artifact(os.path.join(directory, name))
+        failed += bool(problems)
+        click.echo(f"{name}: {'; '.join(problems) if problems else 'ok'}")
+    if failed:
+        raise click.ClickException(f'{failed} artifact(s) failed verification')
+
+
+@models_group.command('prune')
+@click.option('--keep', type=int, default=None, help='Artifacts to keep (default: RECOMMENDER_ARTIFACT_KEEP)')
+@click.option('--dir', 'directory', default=None, help='Artifact directory (default: RECOMMENDER_ARTIFACT_DIR)')
+@with_appcontext
+def models_prune(keep, directory):
+    """Delete all but the newest saved artifacts."""
+    keep = recommendation_engine.artifact_keep if keep is None else keep
+    for path in prune_artifacts(_artifact_dir(directory), keep):
+        click.echo(f'Removed {os.path.basename(path)}')
+
+
+@click.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None, help='Default: from the file extension')
+@click.option('--chunk-size', type=int, default=5000, help='Rows per upsert transaction')
+@click.option('--state', 'state_path', default=None, help='Resume state file (default: PATH.import-state)')
+@click.option('--keep-raw', is_flag=True, help='Also store the raw audio features JSON')
+@click.option('--enrich', is_flag=True, help='Fetch missing audio features from Spotify after the import '
+                                             '(default: left to the servers\' enrichment queue)')
+@with_appcontext
+def import_catalog(path, fmt, chunk_size, state_path, keep_raw, enrich):
+    """Stream a JSONL or CSV track dump into the catalog, resuming an interrupted import."""
+    def progress(state):
+        click.echo(f"{state['rows']:>10} rows  {state['rejected']:>6} rejected  "
+                   f"{state['partial_features']:>6} partial features  "
+                   f"{state['rows_per_second']:>9.0f} rows/s  byte {state['offset']}")
+
+    # This process exits after the import: enrich in the foreground or not at all
+    enrichment_queue.worker_enabled = False
+    try:
+        importer = CatalogImporter(path, fmt, chunk_size=chunk_size, state_path=state_path, keep_raw=keep_raw)
+        state = importer.run(progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Imported {state['rows']} rows in {state['seconds']:.1f}s "
+               f"({state['rows_per_second']:.0f} rows/s), {state['rejected']} rejected, "
+               f"{state['partial_features']} without their incomplete audio features")
+    if enrich:
+        missing = enrichment_queue.depth
+        click.echo(f'Enriched {enrichment_queue.drain()} of {missing} songs missing audio features; '
+                   f'the rest are retried by the servers\' enrichment queue')
@@ -6,8 +6,20 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from flask import Flask, send_from_directory, session
 from src.models.user import db
 from src.routes.user import user_bp
-from src.routes.spotify import spotify_bp
+from src.routes.spotify import spotify_bp, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET
 from src.routes.ai import ai_bp
+from src.models.recommendation import recommendation_engine
+from src.models.spotify_http import spotify_http
+from src.models.spotify_concurrent import spotify_fetcher
+from src.models.spotify_cache import spotify_cache
+from src.models.enrichment import enrichment_queue
+from src.models.serving import serving_cache
+from src.models.popularity import popularity_index
+from src.models.regeneration import regeneration_scheduler
+from src.models.migrations import migrate
+from src.models.metrics import metrics
+from src.models.database import engine_options, configure_database
+from src.cli import register_commands
 import secrets
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
@@ -18,12 +30,94 @@ app.register_blueprint(user_bp, url_prefix='/api')
 app.register_blueprint(spotify_bp, url_prefix='/api')
 app.register_blueprint(ai_bp, url_prefix='/api')
 
-# Enable database with SQLite instead of MySQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///spotify_recommender.db'
+# Database: local SQLite by default, or any SQLAlchemy URI from DATABASE_URL (e.g. mysql+pymysql://...)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///spotify_recommender.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite: WAL so readers don't block the writer, and wait on locks instead of failing
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'synchronous': 'NORMAL',
+}
+# Server databases: connection pool per worker process, checked with a ping before use
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))
+app.config['DATABASE_POOL_TIMEOUT'] = 30
+app.config['DATABASE_POOL_RECYCLE'] = 1800
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+# Page size of cursor-paginated listings (clients may ask for up to the maximum)
+app.config['API_PAGE_SIZE'] = 50
+app.config['API_MAX_PAGE_SIZE'] = 200
 db.init_app(app)
+configure_database(app, db)
+
+# Refit the kNN index once this fraction of the catalog changed since the last fit
+app.config['RECOMMENDER_REFIT_THRESHOLD'] = 0.05
+# Directory for the memory-mapped catalog shared by worker processes (disabled when unset)
+app.config['RECOMMENDER_CATALOG_DIR'] = os.environ.get('RECOMMENDER_CATALOG_DIR')
+app.config['RECOMMENDER_CATALOG_POLL_SECONDS'] = 5.0
+# Nearest-neighbour backend: 'ball_tree', 'brute' or 'ivf' (see src/models/ann.py)
+app.config['RECOMMENDER_INDEX_BACKEND'] = os.environ.get('RECOMMENDER_INDEX_BACKEND', 'ball_tree')
+app.config['RECOMMENDER_INDEX_PARAMS'] = {}
+# Previous model snapshots kept for POST /api/recommendations/model/rollback
+app.config['RECOMMENDER_SNAPSHOT_HISTORY'] = 3
+# Genre/artist/popularity filters allowing at most this fraction of the catalog are searched by a direct scan
+app.config['RECOMMENDER_FILTER_SCAN_FRACTION'] = 0.05
+# Saved fits reused at startup when the catalog is unchanged (disabled when unset)
+app.config['RECOMMENDER_ARTIFACT_DIR'] = os.environ.get('RECOMMENDER_ARTIFACT_DIR')
+app.config['RECOMMENDER_ARTIFACT_KEEP'] = 3
+# Length of the in-memory most-popular lists (global and per genre) used for cold-start users
+app.config['POPULARITY_TOP_K'] = 200
+
+# Shared Spotify HTTP client: keep-alive pool, retries with jittered backoff, (connect, read) timeouts
+app.config['SPOTIFY_HTTP_POOL_SIZE'] = 20
+app.config['SPOTIFY_HTTP_MAX_RETRIES'] = 3
+app.config['SPOTIFY_HTTP_BACKOFF'] = 0.5
+app.config['SPOTIFY_HTTP_TIMEOUT'] = (3.05, 10.0)
+# Concurrent Spotify fetches: worker threads and overall requests per second
+app.config['SPOTIFY_FETCH_CONCURRENCY'] = 8
+app.config['SPOTIFY_FETCH_RATE'] = 20.0
+# Local response cache for track, audio-feature and search calls (shared by workers)
+app.config['SPOTIFY_CACHE_PATH'] = os.path.join(app.instance_path, 'spotify_cache.db')
+app.config['SPOTIFY_CACHE_MAX_ENTRIES'] = 100000
+# Background audio-feature enrichment (app token via client credentials)
+app.config['SPOTIFY_CLIENT_ID'] = SPOTIFY_CLIENT_ID
+app.config['SPOTIFY_CLIENT_SECRET'] = SPOTIFY_CLIENT_SECRET
+app.config['ENRICHMENT_BATCH_SIZE'] = 100
+app.config['ENRICHMENT_MAX_WAIT'] = 1.0
+app.config['ENRICHMENT_MAX_ATTEMPTS'] = 5
+app.config['ENRICHMENT_RETRY_DELAY'] = 30.0
+# In-memory serving buffers for GET /api/recommendations; shown rows are flushed in batches
+app.config['SERVING_BUFFER_SIZE'] = 50
+app.config['SERVING_MAX_USERS'] = 10000
+app.config['SERVING_TTL'] = 60.0
+app.config['SERVING_FLUSH_INTERVAL'] = 1.0
+app.config['SERVING_FLUSH_BATCH'] = 500
+# Feedback-driven regeneration: wait for a pause in a user's feedback (capped), then run once
+app.config['REGENERATION_DEBOUNCE'] = 2.0
+app.config['REGENERATION_MAX_DELAY'] = 10.0
+app.config['REGENERATION_WORKERS'] = 2
+app.config['REGENERATION_TIMEOUT'] = 30
+# Request, SQL, Spotify and engine-stage timings exposed at /api/metrics (Prometheus text format)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+recommendation_engine.init_app(app)
+popularity_index.init_app(app)
+spotify_http.init_app(app)
+spotify_fetcher.init_app(app)
+spotify_cache.init_app(app)
+enrichment_queue.init_app(app)
+serving_cache.init_app(app)
+regeneration_scheduler.init_app(app)
+metrics.init_app(app, db)
+register_commands(app)
+
 with app.app_context():
     db.create_all()
+    migrate(db.engine)
+    recommendation_engine.warm_start()
+    # Songs still missing features, e.g. queued in memory by a process that has since exited
+    enrichment_queue.enqueue_missing()
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -0,0 +1,282 @@
+import logging
+import time
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+logger = logging.getLogger(__name__)
+
+
+class NeighborIndex:
+    """Nearest-neighbour search over the catalog feature matrix.
+
+    ``kneighbors`` follows the sklearn convention: it takes a 2-D array of
+    queries and returns ``(distances, indices)`` arrays of shape
+    ``(n_queries, n_neighbors)`` with euclidean distances, nearest first.
+    """
+
+    name = None
+
+    def fit(self, X):
+        raise NotImplementedError
+
+    def kneighbors(self, queries, n_neighbors=10):
+        raise NotImplementedError
+
+    def kneighbors_excluding(self, query, n_neighbors, exclude_mask):
+        """Nearest rows to a single query that are not set in ``exclude_mask``.
+
+        Returns ``(distances, indices, rounds)`` where ``rounds`` counts the
+        searches needed. The generic version searches ``2 * n`` rows first
+        and, if too few survive the mask, ``n`` plus the number of excluded
+        rows, which is always enough for an exact index: at most two rounds.
+        """
+        n_excluded = int(np.count_nonzero(exclude_mask))
+        limit = min(len(self), n_neighbors + n_excluded)
+        k = min(2 * n_neighbors, limit)
+        rounds = 0
+
+        while True:
+            rounds += 1
+            distances, indices = self.kneighbors(query, k)
+            keep = ~exclude_mask[indices[0]]
+            if keep.sum() >= n_neighbors or k >= limit:
+                return distances[0][keep][:n_neighbors], indices[0][keep][:n_neighbors], rounds
+            k = limit
+
+    def memory_bytes(self):
+        """Bytes held by the index itself"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+def _top_k(sq_distances, k):
+    """Sorted top-k (smallest) columns of each row of a squared-distance matrix"""
+    k = min(k, sq_distances.shape[1])
+    part = np.argpartition(sq_distances, k - 1, axis=1)[:, :k]
+    part_d = np.take_along_axis(sq_distances, part, axis=1)
+    order = np.argsort(part_d, axis=1)
+    indices = np.take_along_axis(part, order, axis=1)
+    distances = np.sqrt(np.maximum(np.take_along_axis(part_d, order, axis=1), 0))
+    return distances, indices
+
+
+class BruteForceIndex(NeighborIndex):
+    """Exact search with one BLAS matrix product per query batch.
+
+    The matrix is referenced, not copied, when it is already contiguous
+    float32, so a memory-mapped catalog stays shared between processes.
+    """
+
+    name = 'brute'
+
+    def __init__(self):
+        self._X = None
+        self._norms = None
+
+    def fit(self, X):
+        self._X = X if isinstance(X, np.ndarray) and X.dtype == np.float32 and X.flags.c_contiguous \
+            else np.ascontiguousarray(X, dtype=np.float32)
+        self._norms = np.einsum('ij,ij->i', self._X, self._X)
+        return self
+
+    def squared_distances(self, queries):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        return self._norms[None, :] - 2.0 * (queries @ self._X.T) + q_norms[:, None]
+
+    def kneighbors(self, queries, n_neighbors=10):
+        return _top_k(self.squared_distances(queries), n_neighbors)
+
+    def kneighbors_excluding(self, query, n_neighbors, exclude_mask):
+        # Mask inside the search: excluded rows can never be selected
+        sq_distances = self.squared_distances(query)
+        sq_distances[0, exclude_mask] = np.inf
+        n_neighbors = min(n_neighbors, len(self) - int(np.count_nonzero(exclude_mask)))
+        if n_neighbors <= 0:
+            return np.empty(0), np.empty(0, dtype=np.int64), 1
+        distances, indices = _top_k(sq_distances, n_neighbors)
+        return distances[0], indices[0], 1
+
+    def memory_bytes(self):
+        # The matrix itself may be a shared mapping; count only what we allocated
+        own = 0 if isinstance(self._X, np.memmap) else self._X.nbytes
+        return own + self._norms.nbytes
+
+    def __len__(self):
+        return len(self._X)
+
+
+class BallTreeIndex(NeighborIndex):
+    """Exact search with sklearn's ball tree (the original engine backend)"""
+
+    name = 'ball_tree'
+
+    def __init__(self, leaf_size=40):
+        self.leaf_size = leaf_size
+        self._model = NearestNeighbors(algorithm='ball_tree', leaf_size=leaf_size)
+
+    def fit(self, X):
+        self._model.fit(X)
+        return self
+
+    def kneighbors(self, queries, n_neighbors=10):
+        n_neighbors = min(n_neighbors, len(self))
+        return self._model.kneighbors(np.atleast_2d(queries), n_neighbors=n_neighbors)
+
+    def memory_bytes(self):
+        return sum(array.nbytes for array in self._model._tree.get_arrays())
+
+    def __len__(self):
+        return self._model.n_samples_fit_
+
+
+class IVFIndex(NeighborIndex):
+    """Approximate search with an inverted file over k-means cells.
+
+    The catalog is partitioned into ``n_lists`` cells; a query scans only the
+    ``n_probe`` cells whose centroids are closest. Raising ``n_probe`` trades
+    latency for recall (``n_probe == n_lists`` is exact).
+    """
+
+    name = 'ivf'
+
+    def __init__(self, n_lists=None, n_probe=8, train_iterations=10, train_sample=50000, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_iterations = train_iterations
+        self.train_sample = train_sample
+        self.seed = seed
+        self._centroids = None
+        self._data = None
+        self._row_ids = None
+        self._offsets = None
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(X))))
+        n_lists = min(n_lists, len(X))
+        self._centroids = self._train_centroids(X, n_lists)
+
+        # Store rows grouped by cell so each cell is one contiguous slice
+        assignment = self._assign(X)
+        order = np.argsort(assignment, kind='stable')
+        self._data = np.ascontiguousarray(X[order])
+        self._row_ids = order.astype(np.int64)
+        self._offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        return self
+
+    def _train_centroids(self, X, n_lists):
+        rng = np.random.default_rng(self.seed)
+        sample = X[rng.choice(len(X), min(len(X), max(self.train_sample, n_lists)), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+        for _ in range(self.train_iterations):
+            labels = self._nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        return centroids
+
+    @staticmethod
+    def _nearest_centroid(X, centroids, chunk_size=65536):
+        labels = np.empty(len(X), dtype=np.int64)
+        c_norms = np.einsum('ij,ij->i', centroids, centroids)
+        for start in range(0, len(X), chunk_size):
+            chunk = X[start:start + chunk_size]
+            labels[start:start + chunk_size] = np.argmin(c_norms[None, :] - 2.0 * (chunk @ centroids.T), axis=1)
+        return labels
+
+    def _assign(self, X):
+        return self._nearest_centroid(X, self._centroids)
+
+    def kneighbors(self, queries, n_neighbors=10):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_neighbors = min(n_neighbors, len(self))
+        all_distances = np.empty((len(queries), n_neighbors))
+        all_indices = np.empty((len(queries), n_neighbors), dtype=np.int64)
+
+        for q, query in enumerate(queries):
+            distances, indices, _ = self._search(query, n_neighbors)
+            all_distances[q] = distances
+            all_indices[q] = indices
+        return all_distances, all_indices
+
+    def kneighbors_excluding(self, query, n_neighbors, exclude_mask):
+        return self._search(np.asarray(query, dtype=np.float32).ravel(), n_neighbors, exclude_mask)
+
+    def _search(self, query, n_neighbors, exclude_mask=None):
+        cell_order = np.argsort(((self._centroids - query) ** 2).sum(axis=1))
+        n_probe = min(self.n_probe, len(cell_order))
+        probed = 0
+        candidates = np.empty(0, dtype=np.int64)
+        rounds = 0
+
+        # Probe the nearest cells, widening until enough candidates survive the mask
+        while True:
+            rounds += 1
+            cells = cell_order[probed:n_probe]
+            probed = n_probe
+            found = np.concatenate([np.arange(self._offsets[c], self._offsets[c + 1]) for c in cells])
+            if exclude_mask is not None:
+                found = found[~exclude_mask[self._row_ids[found]]]
+            candidates = np.concatenate([candidates, found])
+            if len(candidates) >= n_neighbors or n_probe >= len(cell_order):
+                break
+            n_probe = min(2 * n_probe, len(cell_order))
+
+        if not len(candidates):
+            return np.empty(0), np.empty(0, dtype=np.int64), rounds
+
+        diff = self._data[candidates] - query
+        distances, local = _top_k(np.einsum('ij,ij->i', diff, diff)[None, :], n_neighbors)
+        return distances[0], self._row_ids[candidates[local[0]]], rounds
+
+    def memory_bytes(self):
+        return self._data.nbytes + self._row_ids.nbytes + self._offsets.nbytes + self._centroids.nbytes
+
+    def __len__(self):
+        return len(self._data)
+
+
+INDEX_BACKENDS = {
+    BruteForceIndex.name: BruteForceIndex,
+    BallTreeIndex.name: BallTreeIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def create_index(backend='ball_tree', **params):
+    """Instantiate a nearest-neighbour backend by name"""
+    try:
+        return INDEX_BACKENDS[backend](**params)
+    except KeyError:
+        raise ValueError(f"Unknown index backend '{backend}', expected one of {sorted(INDEX_BACKENDS)}")
+
+
+def evaluate_index(index, X, queries, n_neighbors=10, exact=None):
+    """Fit ``index`` on X and report build time, memory, latency and recall@k against exact search"""
+    start = time.perf_counter()
+    index.fit(X)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, indices = index.kneighbors(queries, n_neighbors)
+    query_seconds = time.perf_counter() - start
+
+    if exact is None:
+        _, exact = BruteForceIndex().fit(X).kneighbors(queries, n_neighbors)
+    hits = sum(len(np.intersect1d(found, truth)) for found, truth in zip(indices, exact))
+
+    return {
+        'backend': index.name,
+        'songs': len(X),
+        'build_seconds': build_seconds,
+        'memory_bytes': int(index.memory_bytes()),
+        'query_ms': 1000.0 * query_seconds / len(queries),
+        f'recall_at_{n_neighbors}': hits / float(exact.size),
+    }
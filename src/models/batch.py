@@ -0,0 +1,197 @@
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.models.user import db, UserPreference, UserProfile
+from src.models.feature_store import FEATURE_DIM
+from src.models.catalog_file import write_catalog, open_current_catalog
+
+logger = logging.getLogger(__name__)
+
+# Catalog matrix seen by worker processes (memory-mapped, shared page cache)
+_catalog = None
+_catalog_norms = None
+_exclude_mask = None
+
+
+def _init_worker(catalog_dir, exclude_mask=None):
+    global _catalog, _catalog_norms, _exclude_mask
+    _catalog = open_current_catalog(catalog_dir).features
+    _catalog_norms = np.einsum('ij,ij->i', _catalog, _catalog)
+    _exclude_mask = exclude_mask
+
+
+def score_users(profiles, catalog, catalog_norms, rated_users, rated_rows, n, catalog_chunk=16384,
+                exclude_mask=None):
+    """Top-n catalog rows for each profile, skipping rated rows and rows set in ``exclude_mask``.
+
+    ``rated_users``/``rated_rows`` are parallel arrays: profile index and
+    catalog row of every rated song. The catalog is scanned in chunks small
+    enough for the distance block to stay in cache; each chunk's top-n is
+    merged into the running best with argpartition. Excluded rows come back
+    with an infinite distance when fewer than n rows are left.
+    """
+    n_users = len(profiles)
+    n = min(n, len(catalog))
+    best_d = np.full((n_users, n), np.inf, dtype=np.float32)
+    best_i = np.zeros((n_users, n), dtype=np.int64)
+    p_norms = np.einsum('ij,ij->i', profiles, profiles)
+
+    for start in range(0, len(catalog), catalog_chunk):
+        end = min(start + catalog_chunk, len(catalog))
+        d = catalog_norms[None, start:end] - 2.0 * (profiles @ catalog[start:end].T) + p_norms[:, None]
+
+        in_chunk = (rated_rows >= start) & (rated_rows < end)
+        d[rated_users[in_chunk], rated_rows[in_chunk] - start] = np.inf
+        if exclude_mask is not None:
+            d[:, exclude_mask[start:end]] = np.inf
+
+        k = min(n, end - start)
+        part = np.argpartition(d, k - 1, axis=1)[:, :k]
+        merged_d = np.concatenate([best_d, np.take_along_axis(d, part, axis=1)], axis=1)
+        merged_i = np.concatenate([best_i, part + start], axis=1)
+        keep = np.argpartition(merged_d, n - 1, axis=1)[:, :n]
+        best_d = np.take_along_axis(merged_d, keep, axis=1)
+        best_i = np.take_along_axis(merged_i, keep, axis=1)
+
+    order = np.argsort(best_d, axis=1)
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    best_i = np.take_along_axis(best_i, order, axis=1)
+    return best_i, np.sqrt(np.maximum(best_d, 0))
+
+
+def _score_task(task):
+    user_ids, profiles, rated_users, rated_rows, n, catalog_chunk = task
+    rows, distances = score_users(profiles, _catalog, _catalog_norms, rated_users, rated_rows, n,
+                                  catalog_chunk, _exclude_mask)
+    return user_ids, rows, distances
+
+
+class BatchRecommender:
+    """Precompute recommendations for every user with liked songs in one pass.
+
+    Users without likes are left to the on-demand popularity path.
+    ``filters`` (see ``make_filters``) limit every user's recommendations.
+    """
+
+    def __init__(self, engine, n_recommendations=10, user_chunk=256, catalog_chunk=16384,
+                 workers=None, write_batch=1000, filters=None):
+        self.engine = engine
+        self.filters = filters
+        self.n_recommendations = n_recommendations
+        self.user_chunk = user_chunk
+        self.catalog_chunk = catalog_chunk
+        self.workers = workers or os.cpu_count() or 1
+        self.write_batch = write_batch
+
+    def load_profiles(self):
+        """User ids and mean liked-song vectors for every user with likes"""
+        # Repair users whose likes predate the profile table
+        missing = (db.session.query(UserPreference.user_id)
+                   .outerjoin(UserProfile, UserProfile.user_id == UserPreference.user_id)
+                   .filter(UserPreference.rating.is_(True), UserProfile.user_id.is_(None))
+                   .distinct().all())
+        for (user_id,) in missing:
+            self.engine.rebuild_user_profile(user_id)
+        db.session.commit()
+
+        rows = (db.session.query(UserProfile.user_id, UserProfile.feature_sum, UserProfile.like_count)
+                .filter(UserProfile.like_count > 0)
+                .order_by(UserProfile.user_id).all())
+        user_ids = np.array([user_id for user_id, _, _ in rows], dtype=np.int64)
+        profiles = np.empty((len(rows), FEATURE_DIM), dtype=np.float32)
+        for i, (_, feature_sum, like_count) in enumerate(rows):
+            profiles[i] = np.frombuffer(feature_sum, dtype=np.float64) / like_count
+        return user_ids, profiles
+
+    def load_rated(self, user_ids, snapshot):
+        """Parallel (profile index, catalog row) arrays of every rated song"""
+        pairs = np.array(db.session.query(UserPreference.user_id, UserPreference.song_id).all(),
+                         dtype=np.int64).reshape(-1, 2)
+        user_index = np.searchsorted(user_ids, pairs[:, 0])
+        known = (user_index < len(user_ids)) & (user_ids[np.minimum(user_index, len(user_ids) - 1)] == pairs[:, 0])
+        pairs, user_index = pairs[known], user_index[known]
+
+        # Map song ids to catalog rows, dropping songs outside the fitted catalog
+        in_catalog, rows = snapshot.locate_song_ids(pairs[:, 1])
+        return user_index[in_catalog], rows
+
+    def tasks(self, user_ids, profiles, rated_users, rated_rows):
+        by_user = np.argsort(rated_users, kind='stable')
+        rated_users, rated_rows = rated_users[by_user], rated_rows[by_user]
+        for start in range(0, len(user_ids), self.user_chunk):
+            end = min(start + self.user_chunk, len(user_ids))
+            lo, hi = np.searchsorted(rated_users, [start, end])
+            yield (user_ids[start:end], profiles[start:end], rated_users[lo:hi] - start, rated_rows[lo:hi],
+                   self.n_recommendations, self.catalog_chunk)
+
+    def run(self):
+        """Score and store recommendations for all users with a profile; returns rows written"""
+        if not self.engine.is_trained and not self.engine.train():
+            logger.warning("No catalog to score against")
+            return 0
+        # Score the whole run against one model even if a newer one is activated meanwhile
+        snapshot = self.engine.snapshot
+
+        user_ids, profiles = self.load_profiles()
+        if not len(user_ids):
+            logger.info("No users with liked songs, nothing to precompute")
+            return 0
+        rated_users, rated_rows = self.load_rated(user_ids, snapshot)
+        # Songs deleted since the fit and songs outside the filters are masked for every user
+        exclude_mask = snapshot.exclusion_mask(self.engine.store.deleted_since_fit) \
+            if self.engine.store.is_loaded else np.zeros(len(snapshot), dtype=bool)
+        if self.filters:
+            exclude_mask |= ~self.engine.filter_mask(self.filters, snapshot)
+
+        logger.info(f"Batch scoring {len(user_ids)} users against {len(snapshot)} songs "
+                    f"with {self.workers} workers")
+        started = time.perf_counter()
+        written = users_done = 0
+        pending = {}
+
+        with tempfile.TemporaryDirectory() as catalog_dir:
+            # Workers map a snapshot of the fitted catalog instead of receiving a pickled copy
+            write_catalog(catalog_dir, snapshot.song_features, snapshot.song_ids, keep=1)
+
+            tasks = self.tasks(user_ids, profiles, rated_users, rated_rows)
+            if self.workers > 1:
+                executor = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                               initargs=(catalog_dir, exclude_mask))
+                results = executor.map(_score_task, tasks)
+            else:
+                executor = None
+                _init_worker(catalog_dir, exclude_mask)
+                results = map(_score_task, tasks)
+
+            try:
+                for chunk_user_ids, rows, distances in results:
+                    for user_id, user_rows, user_distances in zip(chunk_user_ids, rows, distances):
+                        finite = np.isfinite(user_distances)
+                        pending[int(user_id)] = [
+                            (int(snapshot.song_ids[row]), 1.0 / (1.0 + float(distance)))
+                            for row, distance in zip(user_rows[finite], user_distances[finite])
+                        ]
+                    users_done += len(chunk_user_ids)
+                    if len(pending) >= self.write_batch:
+                        written += self.engine.bulk_store_recommendations(pending)
+                        pending = {}
+                        self._log_progress(users_done, len(user_ids), written, started)
+                if pending:
+                    written += self.engine.bulk_store_recommendations(pending)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+
+        self._log_progress(users_done, len(user_ids), written, started)
+        return written
+
+    @staticmethod
+    def _log_progress(users_done, users_total, written, started):
+        elapsed = time.perf_counter() - started
+        logger.info(f"Batch recommendations: {users_done}/{users_total} users, {written} rows in "
+                    f"{elapsed:.1f}s ({written / max(elapsed, 1e-9):.0f} rows/sec)")
@@ -0,0 +1,108 @@
+import glob
+import logging
+import os
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# File layout: fixed header, then int64 song ids, then the float32 feature matrix
+MAGIC = b'SPCAT1\x00\x00'
+HEADER = struct.Struct('<8sQQI4x')  # magic, version, rows, dim
+CURRENT_FILE = 'CURRENT'
+
+
+def catalog_path(directory, version):
+    return os.path.join(directory, f'catalog-v{version:08d}.bin')
+
+
+def read_current_version(directory):
+    """Return the published catalog version in ``directory``, or 0 if there is none"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_catalog(directory, matrix, ids, keep=3):
+    """Write a new catalog version and publish it; returns the version number"""
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    if matrix.ndim != 2 or len(matrix) != len(ids) or not len(ids):
+        raise ValueError("Catalog needs a non-empty 2-D matrix aligned with its ids")
+
+    os.makedirs(directory, exist_ok=True)
+    version = read_current_version(directory) + 1
+
+    # O_EXCL makes concurrent writers pick distinct versions
+    while True:
+        tmp_path = catalog_path(directory, version) + '.tmp'
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            break
+        except FileExistsError:
+            version += 1
+
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, version, len(ids), matrix.shape[1]))
+        f.write(ids.tobytes())
+        f.write(matrix.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, catalog_path(directory, version))
+
+    # Publish by atomically swapping the pointer file
+    pointer_tmp = os.path.join(directory, f'{CURRENT_FILE}.{version}.tmp')
+    with open(pointer_tmp, 'w') as f:
+        f.write(str(version))
+    if version > read_current_version(directory):
+        os.replace(pointer_tmp, os.path.join(directory, CURRENT_FILE))
+    else:
+        os.remove(pointer_tmp)
+
+    prune_catalogs(directory, keep)
+    logger.info(f"Published catalog version {version} with {len(ids)} songs to {directory}")
+    return version
+
+
+def prune_catalogs(directory, keep=3):
+    """Delete all but the newest ``keep`` catalog files.
+
+    Workers that still have an older version mapped keep reading it until they
+    swap; the pages stay valid after unlink on POSIX systems.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, 'catalog-v*.bin')))
+    for path in paths[:-keep] if keep else paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Could not remove old catalog {path}: {e}")
+
+
+class MappedCatalog:
+    """Read-only memory-mapped view of a published catalog file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, version, rows, dim = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog file")
+
+        self.path = path
+        self.version = version
+        self.ids = np.memmap(path, dtype=np.int64, mode='r', offset=HEADER.size, shape=(rows,))
+        self.features = np.memmap(path, dtype=np.float32, mode='r',
+                                  offset=HEADER.size + 8 * rows, shape=(rows, dim))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def open_current_catalog(directory):
+    """Map the currently published catalog, or return None if nothing is published"""
+    version = read_current_version(directory)
+    if not version:
+        return None
+    return MappedCatalog(catalog_path(directory, version))
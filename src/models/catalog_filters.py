@@ -0,0 +1,163 @@
+import logging
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+
+from src.models.user import db, Song
+
+logger = logging.getLogger(__name__)
+
+# Popularity (0-100) is indexed in buckets of this width
+POPULARITY_BUCKET = 10
+N_BUCKETS = 100 // POPULARITY_BUCKET + 1
+
+
+def _key(value):
+    return value.strip().lower() if value else None
+
+
+def make_filters(genres=(), artists=(), exclude_artists=(), min_popularity=None):
+    """Normalized recommendation filters, or None when nothing is filtered"""
+    filters = {
+        'genres': tuple(sorted({_key(genre) for genre in genres if _key(genre)})),
+        'artists': tuple(sorted({_key(artist) for artist in artists if _key(artist)})),
+        'exclude_artists': tuple(sorted({_key(artist) for artist in exclude_artists if _key(artist)})),
+        'min_popularity': min_popularity,
+    }
+    if not any(filters.values()) and min_popularity is None:
+        return None
+    return filters
+
+
+def filter_conditions(filters):
+    """The same filters as SQL conditions on ``Song``"""
+    conditions = []
+    if filters['genres']:
+        conditions.append(func.lower(Song.genre).in_(filters['genres']))
+    if filters['artists']:
+        conditions.append(func.lower(Song.artist).in_(filters['artists']))
+    if filters['exclude_artists']:
+        conditions.append(func.lower(Song.artist).notin_(filters['exclude_artists']))
+    if filters['min_popularity'] is not None:
+        conditions.append(Song.popularity >= filters['min_popularity'])
+    return conditions
+
+
+class RowSet:
+    """Set of catalog rows stored like a roaring container.
+
+    Sparse sets keep a sorted int32 row array; once that would be larger than
+    a bitmap over the catalog (more than one row in 32) they keep a packed
+    bitmap instead, so every set costs at most ``size / 8`` bytes.
+    """
+
+    __slots__ = ('rows', 'bits', 'size', 'count')
+
+    def __init__(self, rows, size):
+        self.size = size
+        self.count = len(rows)
+        if len(rows) * 32 < size:
+            self.rows, self.bits = np.asarray(rows, dtype=np.int32), None
+        else:
+            mask = np.zeros(size, dtype=bool)
+            mask[rows] = True
+            self.rows, self.bits = None, np.packbits(mask)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes if self.rows is not None else self.bits.nbytes
+
+    def to_rows(self):
+        if self.rows is not None:
+            return self.rows
+        return np.flatnonzero(np.unpackbits(self.bits, count=self.size))
+
+    def add_to(self, mask):
+        """OR this set into a boolean row mask"""
+        if self.rows is not None:
+            mask[self.rows] = True
+        else:
+            mask |= np.unpackbits(self.bits, count=self.size).view(bool)
+        return mask
+
+
+class CatalogFilterIndex:
+    """Genre, artist and popularity-bucket row sets aligned with one model snapshot's rows.
+
+    Built once per snapshot from the songs table, so genre, artist or
+    popularity edits are picked up with the next model version.
+    """
+
+    def __init__(self, size, genres, artists, popularity):
+        self.size = size
+        self.popularity = popularity  # int16 per row, -1 when unknown
+        self.genres = self._group(genres)
+        self.artists = self._group(artists)
+        buckets = np.where(popularity >= 0, np.minimum(popularity // POPULARITY_BUCKET, N_BUCKETS - 1), -1)
+        self.buckets = [RowSet(np.flatnonzero(buckets == bucket), size) for bucket in range(N_BUCKETS)]
+
+    def _group(self, keys):
+        """Row sets per distinct key of an object array (None keys are not indexed)"""
+        known = np.flatnonzero(keys != None)  # noqa: E711 (elementwise comparison)
+        values, inverse = np.unique(keys[known].astype(str), return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+        return {value: RowSet(known[order[bounds[i]:bounds[i + 1]]], self.size) for i, value in enumerate(values)}
+
+    @classmethod
+    def build(cls, snapshot):
+        """Index the snapshot's songs (one query over the songs table)"""
+        started = time.perf_counter()
+        rows = db.session.execute(select(Song.id, Song.genre, Song.artist, Song.popularity)
+                                  .where(Song.feature_vector.isnot(None))).all()
+        song_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        found, positions = snapshot.locate_song_ids(song_ids)
+        found_at = np.flatnonzero(found)
+
+        size = len(snapshot)
+        genres = np.full(size, None, dtype=object)
+        artists = np.full(size, None, dtype=object)
+        popularity = np.full(size, -1, dtype=np.int16)
+        genres[positions] = [_key(rows[i][1]) for i in found_at]
+        artists[positions] = [_key(rows[i][2]) for i in found_at]
+        popularity[positions] = [-1 if rows[i][3] is None else rows[i][3] for i in found_at]
+
+        index = cls(size, genres, artists, popularity)
+        logger.info(f"Built filter index for model version {snapshot.version}: {len(index.genres)} genres, "
+                    f"{len(index.artists)} artists, {index.nbytes} bytes in "
+                    f"{time.perf_counter() - started:.2f}s")
+        return index
+
+    @property
+    def nbytes(self):
+        sets = list(self.genres.values()) + list(self.artists.values()) + self.buckets
+        return sum(row_set.nbytes for row_set in sets) + self.popularity.nbytes
+
+    def _union(self, row_sets):
+        mask = np.zeros(self.size, dtype=bool)
+        for row_set in row_sets:
+            row_set.add_to(mask)
+        return mask
+
+    def min_popularity_mask(self, min_popularity):
+        bucket = min(max(min_popularity, 0) // POPULARITY_BUCKET, N_BUCKETS - 1)
+        mask = self._union(self.buckets[bucket + 1:])
+        # Only the boundary bucket needs the exact per-row comparison
+        rows = self.buckets[bucket].to_rows()
+        mask[rows[self.popularity[rows] >= min_popularity]] = True
+        return mask
+
+    def mask(self, filters):
+        """Boolean mask of the rows passing ``filters`` (see ``make_filters``)"""
+        allowed = np.ones(self.size, dtype=bool)
+        if filters['genres']:
+            allowed &= self._union(self.genres[genre] for genre in filters['genres'] if genre in self.genres)
+        if filters['artists']:
+            allowed &= self._union(self.artists[artist] for artist in filters['artists'] if artist in self.artists)
+        if filters['exclude_artists']:
+            allowed &= ~self._union(self.artists[artist] for artist in filters['exclude_artists']
+                                    if artist in self.artists)
+        if filters['min_popularity'] is not None:
+            allowed &= self.min_popularity_mask(filters['min_popularity'])
+        return allowed
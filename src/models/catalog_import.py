@@ -0,0 +1,266 @@
+import csv
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import case, delete, func, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from src.models.user import db, Song, UserPreference, UserProfile
+from src.models.enrichment import enrichment_queue
+from src.models.popularity import popularity_index
+from src.models.features import FEATURE_SCALES, normalize_features, pack_vector
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'csv')
+_EXTENSIONS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl', '.csv': 'csv'}
+
+# Accepted names of each column in track dumps (our own names first, then common export layouts)
+_ALIASES = {
+    'spotify_id': ('spotify_id', 'id', 'track_id', 'uri'),
+    'title': ('title', 'name', 'track_name'),
+    'artist': ('artist', 'artists', 'artist_name', 'artist_names'),
+    'album': ('album', 'album_name'),
+    'genre': ('genre', 'track_genre'),
+    'popularity': ('popularity',),
+    'preview_url': ('preview_url',),
+}
+FEATURE_NAMES = tuple(name for name, _ in FEATURE_SCALES)
+# Columns an upsert may change on an existing song; missing values keep what is stored
+_UPDATED_COLUMNS = ('title', 'artist', 'album', 'genre', 'popularity', 'preview_url', 'feature_vector')
+
+
+def detect_format(path):
+    fmt = _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f"Cannot tell the format of {path}; expected one of {', '.join(FORMATS)}")
+    return fmt
+
+
+def _field(record, name):
+    for alias in _ALIASES[name]:
+        value = record.get(alias)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def _name(value):
+    """Artist or album as text: dump layouts use a string, a {'name': ...} object or a list of either"""
+    if isinstance(value, dict):
+        return value.get('name')
+    if isinstance(value, list):
+        return ', '.join(filter(None, (_name(item) for item in value))) or None
+    return value
+
+
+def song_row(record, keep_raw=False):
+    """Column values for one dumped track and whether its audio features were incomplete.
+
+    Raises ValueError when a required field is missing. A track with only
+    some audio features is imported without them: zero-filling the missing
+    dimensions would place it wrongly in the feature space.
+    """
+    spotify_id = _field(record, 'spotify_id')
+    if isinstance(spotify_id, str) and spotify_id.startswith('spotify:track:'):
+        spotify_id = spotify_id.rsplit(':', 1)[1]
+    title, artist = _field(record, 'title'), _name(_field(record, 'artist'))
+    if not spotify_id or not title or not artist:
+        raise ValueError('spotify_id, title and artist are required')
+
+    # Audio features are either nested (API-style dumps) or flat columns (CSV exports)
+    features = record.get('audio_features') or record.get('features')
+    if isinstance(features, str):
+        features = json.loads(features)
+    if not features:
+        features = {name: record[name] for name in FEATURE_NAMES if record.get(name) not in (None, '')}
+    features = {name: float(features[name]) for name in FEATURE_NAMES if features.get(name) is not None}
+    partial = 0 < len(features) < len(FEATURE_NAMES)
+    if partial:
+        features = {}
+
+    popularity = _field(record, 'popularity')
+    album, genre, preview_url = _name(_field(record, 'album')), _field(record, 'genre'), _field(record, 'preview_url')
+    return {
+        'spotify_id': str(spotify_id)[:64],
+        'title': str(title)[:256],
+        'artist': str(artist)[:256],
+        'album': str(album)[:256] if album else None,
+        'genre': str(genre)[:128] if genre else None,
+        'popularity': int(float(popularity)) if popularity is not None else None,
+        'preview_url': str(preview_url)[:512] if preview_url else None,
+        'features': json.dumps(features) if keep_raw and features else None,
+        'feature_vector': pack_vector(normalize_features(features)),
+    }, partial
+
+
+def _updates(new):
+    """Upsert assignments from the proposed row ``new``, keeping stored values a dump leaves empty"""
+    current = Song.__table__.c
+    updates = {name: func.coalesce(new[name], current[name]) for name in _UPDATED_COLUMNS}
+    # The raw JSON and the enrichment state go with the vector: reset whenever a new vector is written
+    has_vector = new.feature_vector.isnot(None)
+    updates['features'] = case((has_vector, new.features), else_=current.features)
+    updates['features_status'] = case((has_vector, None), else_=current.features_status)
+    updates['enrichment_attempts'] = case((has_vector, 0), else_=current.enrichment_attempts)
+    return updates
+
+
+def upsert_statement(dialect_name):
+    """INSERT ... ON CONFLICT (spotify_id) for the given dialect"""
+    if dialect_name in ('sqlite', 'postgresql'):
+        stmt = (sqlite if dialect_name == 'sqlite' else postgresql).insert(Song)
+        return stmt.on_conflict_do_update(index_elements=[Song.spotify_id], set_=_updates(stmt.excluded))
+    if dialect_name in ('mysql', 'mariadb'):
+        stmt = mysql.insert(Song)
+        return stmt.on_duplicate_key_update(_updates(stmt.inserted))
+    raise ValueError(f'Bulk upserts are not supported on {dialect_name}')
+
+
+class CatalogImporter:
+    """Stream a JSONL or CSV dump of tracks into the songs table.
+
+    The file is read one record at a time and written in chunked upserts on
+    ``spotify_id``, one transaction per chunk, so memory stays bounded by the
+    chunk size. After every commit the byte offset reached is saved to a
+    state file; a later run of the same (unchanged) file resumes from there,
+    and since writes are upserts a chunk replayed after a crash is harmless.
+
+    Rows are written with Core statements, which bypass the Song listeners,
+    so each chunk does their work itself: this process's popularity lists
+    are updated, taste profiles of users who like a song given new features
+    are dropped (to be rebuilt on next use) and songs left without features
+    are queued for enrichment. Running servers pick the new songs up on
+    their next reloading fit.
+    """
+
+    def __init__(self, path, fmt=None, chunk_size=5000, state_path=None, keep_raw=False):
+        self.path = path
+        self.fmt = fmt or detect_format(path)
+        self.chunk_size = chunk_size
+        self.state_path = state_path or f'{path}.import-state'
+        self.keep_raw = keep_raw
+
+    def _fingerprint(self):
+        stat = os.stat(self.path)
+        return {'source': os.path.abspath(self.path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def load_state(self):
+        """Progress of an interrupted import of this file, or None"""
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            state = json.load(f)
+        if {key: state.get(key) for key in ('source', 'size', 'mtime_ns')} != self._fingerprint():
+            raise ValueError(f'{self.state_path} belongs to a different or modified file; '
+                             f'remove it to import from the start')
+        return state
+
+    def _save_state(self, state):
+        tmp = f'{self.state_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    @staticmethod
+    def _lines(f, position):
+        """Decoded lines of a binary file, keeping ``position['offset']`` at the end of the last line read"""
+        for line in f:
+            # A byte order mark can only precede the first line
+            encoding = 'utf-8-sig' if position['offset'] == 0 else 'utf-8'
+            position['offset'] += len(line)
+            yield line.decode(encoding)
+
+    def records(self, offset=0, header=None):
+        """Yield ``(record, offset after it)``: a JSON line still to parse, or a CSV row as a dict.
+
+        CSV files also need the ``header`` when resuming mid-file.
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            position = {'offset': offset}
+            lines = self._lines(f, position)
+            if self.fmt == 'jsonl':
+                for line in lines:
+                    if line.strip():
+                        yield line, position['offset']
+                return
+            # The csv reader pulls lines only as a record needs them, so the offset stays at a record boundary
+            reader = csv.reader(lines)
+            if header is None:
+                header = next(reader, None)
+                self.header = header
+            for values in reader:
+                if values:
+                    yield dict(zip(header, values)), position['offset']
+
+    @staticmethod
+    def _drop_stale_profiles(spotify_ids):
+        """Delete the taste profiles summing the old vectors of these songs; they are rebuilt on next use"""
+        if spotify_ids:
+            likers = (select(UserPreference.user_id).join(Song, Song.id == UserPreference.song_id)
+                      .where(Song.spotify_id.in_(spotify_ids), UserPreference.rating.is_(True)))
+            db.session.execute(delete(UserProfile).where(UserProfile.user_id.in_(likers)))
+
+    def run(self, progress=None):
+        """Import the file, resuming a previous run; returns the final progress dict"""
+        state = self.load_state() or dict(self._fingerprint(), offset=0, rows=0, rejected=0, partial_features=0,
+                                          header=None)
+        if state['offset']:
+            logger.info(f"Resuming import of {self.path} at byte {state['offset']} ({state['rows']} rows done)")
+        stmt = upsert_statement(db.engine.dialect.name)
+        self.header = state['header']
+        started = time.perf_counter()
+        imported = 0
+
+        def commit(chunk, offset):
+            nonlocal imported
+            popularity, missing_features = {}, []
+            if chunk:
+                spotify_ids = list(chunk)
+                old_genres = dict(db.session.execute(
+                    select(Song.spotify_id, Song.genre).where(Song.spotify_id.in_(spotify_ids))).all())
+                db.session.execute(stmt, list(chunk.values()))
+                self._drop_stale_profiles([spotify_id for spotify_id, row in chunk.items()
+                                           if row['feature_vector'] is not None])
+                for song_id, spotify_id, genre, song_popularity, has_vector, status in db.session.execute(
+                        select(Song.id, Song.spotify_id, Song.genre, Song.popularity, Song.feature_vector.isnot(None),
+                               Song.features_status).where(Song.spotify_id.in_(spotify_ids))):
+                    popularity[song_id] = (old_genres.get(spotify_id), genre, song_popularity)
+                    if not has_vector and status is None:
+                        missing_features.append(song_id)
+            db.session.commit()
+            popularity_index.apply_pending(popularity)
+            enrichment_queue.enqueue(missing_features)
+            imported += len(chunk)
+            state.update(offset=offset, rows=state['rows'] + len(chunk), header=self.header)
+            self._save_state(state)
+            elapsed = time.perf_counter() - started
+            state['rows_per_second'] = imported / elapsed if elapsed else 0.0
+            if progress and chunk:
+                progress(state)
+
+        chunk, offset = {}, state['offset']
+        for record, offset in self.records(state['offset'], state['header']):
+            try:
+                row, partial = song_row(json.loads(record) if self.fmt == 'jsonl' else record, self.keep_raw)
+            except (AttributeError, TypeError, ValueError) as e:
+                state['rejected'] += 1
+                logger.warning(f"Skipping record ending at byte {offset}: {e}")
+                continue
+            state['partial_features'] += partial
+            # Later records for the same track win, within a chunk as across chunks
+            chunk[row['spotify_id']] = row
+            if len(chunk) >= self.chunk_size:
+                commit(chunk, offset)
+                chunk = {}
+        commit(chunk, offset)
+
+        os.remove(self.state_path)
+        state['seconds'] = time.perf_counter() - started
+        logger.info(f"Imported {imported} rows from {self.path} in {state['seconds']:.1f}s "
+                    f"({state['rows_per_second']:.0f} rows/s), {state['rejected']} rejected, "
+                    f"{state['partial_features']} with incomplete audio features imported without them")
+        return state
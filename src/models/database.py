@@ -0,0 +1,61 @@
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+# WAL lets readers and one writer proceed concurrently; NORMAL sync is durable
+# across application crashes in WAL mode and avoids an fsync per commit
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+}
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def engine_options(config):
+    """SQLAlchemy engine options for the configured database URI.
+
+    SQLite keeps the default pool (connections are cheap and file locks do
+    the arbitration). Server databases get a bounded pool with pre-ping, so
+    connections dropped by the server or a proxy are replaced transparently.
+    """
+    if is_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        busy_timeout = config.get('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS).get('busy_timeout', 5000)
+        return {'connect_args': {'timeout': busy_timeout / 1000.0}}
+
+    return {
+        'pool_pre_ping': True,
+        'pool_size': config.get('DATABASE_POOL_SIZE', 10),
+        'max_overflow': config.get('DATABASE_MAX_OVERFLOW', 20),
+        'pool_timeout': config.get('DATABASE_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DATABASE_POOL_RECYCLE', 1800),
+    }
+
+
+def install_sqlite_pragmas(engine, pragmas=None):
+    """Run the PRAGMAs on every new connection of a SQLite engine"""
+    pragmas = DEFAULT_SQLITE_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def configure_database(app, db):
+    """Apply per-backend connection tuning to the app's engine"""
+    if not is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        return
+    pragmas = app.config.get('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    with app.app_context():
+        engine = db.engine
+    install_sqlite_pragmas(engine, pragmas)
+    logger.info(f"SQLite pragmas for {engine.url.database}: {pragmas}")
@@ -0,0 +1,249 @@
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import select
+
+from src.models.user import db, Song
+from src.models.recommendation import SpotifyClient
+from src.models.spotify_concurrent import enrich_songs, spotify_fetcher
+
+logger = logging.getLogger(__name__)
+
+
+class EnrichmentQueue:
+    """Fetches missing audio features in the background.
+
+    Request handlers enqueue songs that have no features and return
+    immediately; a worker thread collects queued ids into batches of up to
+    100 and fetches them through the shared concurrent fetcher, using an app
+    token from the client credentials flow. Ids already queued are not queued
+    again. Songs Spotify answers with no features are retried with growing
+    delays and marked ``features_status='failed'`` after ``max_attempts``;
+    songs whose request failed, or that found no token, are put back after
+    ``retry_delay`` without counting an attempt.
+    """
+
+    def __init__(self, batch_size=SpotifyClient.AUDIO_FEATURES_BATCH_SIZE, max_wait=1.0, max_attempts=5,
+                 retry_delay=30.0, token_provider=None, fetcher=spotify_fetcher):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.token_provider = token_provider
+        self.fetcher = fetcher
+        self.worker_enabled = True
+        self.app = None
+        self._ready = deque()
+        self._delayed = []  # heap of (due time, song id)
+        self._queued = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._token = None
+        self._token_expires = 0.0
+        self._reset_stats()
+
+    def init_app(self, app):
+        """Read batching and retry settings and Spotify app credentials from the Flask config"""
+        self.app = app
+        self.batch_size = app.config.get('ENRICHMENT_BATCH_SIZE', self.batch_size)
+        self.max_wait = app.config.get('ENRICHMENT_MAX_WAIT', self.max_wait)
+        self.max_attempts = app.config.get('ENRICHMENT_MAX_ATTEMPTS', self.max_attempts)
+        self.retry_delay = app.config.get('ENRICHMENT_RETRY_DELAY', self.retry_delay)
+        self.worker_enabled = app.config.get('ENRICHMENT_WORKER', self.worker_enabled)
+        if self.token_provider is None:
+            client_id = app.config.get('SPOTIFY_CLIENT_ID')
+            client_secret = app.config.get('SPOTIFY_CLIENT_SECRET')
+            self.token_provider = lambda: SpotifyClient.get_app_token(client_id, client_secret)
+
+    def _reset_stats(self):
+        self.started_at = time.monotonic()
+        self.batches = 0
+        self.enriched = 0
+        self.retried = 0
+        self.deferred = 0
+        self.failed = 0
+
+    def reset(self):
+        """Drop everything queued and zero the counters"""
+        with self._cond:
+            self._ready.clear()
+            self._delayed = []
+            self._queued.clear()
+            self._reset_stats()
+
+    @property
+    def depth(self):
+        with self._cond:
+            return len(self._queued)
+
+    def stats(self):
+        with self._cond:
+            elapsed = max(time.monotonic() - self.started_at, 1e-9)
+            return {
+                'depth': len(self._queued),
+                'ready': len(self._ready),
+                'waiting_retry': len(self._delayed),
+                'batches': self.batches,
+                'enriched': self.enriched,
+                'retried': self.retried,
+                'deferred': self.deferred,
+                'failed': self.failed,
+                'drain_rate': round(self.enriched / elapsed, 3),
+                'worker_running': self._thread is not None and self._thread.is_alive(),
+            }
+
+    def enqueue(self, song_ids):
+        """Queue songs for enrichment; returns how many were newly queued"""
+        added = 0
+        with self._cond:
+            for song_id in song_ids:
+                if song_id is None or song_id in self._queued:
+                    continue
+                self._queued.add(song_id)
+                self._ready.append(song_id)
+                added += 1
+            if added:
+                self._cond.notify()
+        if added and self.worker_enabled:
+            self._ensure_worker()
+        return added
+
+    def enqueue_songs(self, songs):
+        """Queue the songs among ``songs`` that still need audio features"""
+        return self.enqueue([song.id for song in songs
+                             if song.feature_vector is None and song.features_status != 'failed'])
+
+    def enqueue_missing(self):
+        """Queue every song still waiting for audio features, including those queued by a previous process"""
+        return self.enqueue(db.session.execute(
+            select(Song.id).where(Song.feature_vector.is_(None), Song.features_status.is_(None))).scalars())
+
+    def _ensure_worker(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='enrichment', daemon=True)
+                self._thread.start()
+
+    def _promote_due(self):
+        # Move retries whose delay has passed back to the ready queue
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._ready.append(heapq.heappop(self._delayed)[1])
+
+    def next_batch(self, block=True):
+        """Take up to ``batch_size`` ready ids, waiting up to ``max_wait`` for a batch to fill"""
+        with self._cond:
+            deadline = None
+            while True:
+                self._promote_due()
+                if len(self._ready) >= self.batch_size or not block:
+                    break
+                now = time.monotonic()
+                if self._ready:
+                    deadline = deadline or now + self.max_wait
+                    if now >= deadline:
+                        break
+                    timeout = deadline - now
+                else:
+                    timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+            return [self._ready.popleft() for _ in range(min(self.batch_size, len(self._ready)))]
+
+    def _access_token(self):
+        if self._token is None or time.monotonic() >= self._token_expires:
+            token_info = self.token_provider() if self.token_provider else None
+            if not token_info:
+                return None
+            self._token = token_info['access_token']
+            # Refresh a minute early
+            self._token_expires = time.monotonic() + token_info.get('expires_in', 3600) - 60
+        return self._token
+
+    def process_batch(self, song_ids):
+        """Fetch and store features for one batch; returns the number of songs enriched"""
+        songs = Song.query.filter(Song.id.in_(song_ids)).all()
+        pending = [song for song in songs if song.feature_vector is None and song.features_status != 'failed']
+
+        token = self._access_token() if pending else None
+        failed = []
+        if token:
+            enrich_songs(token, [song.spotify_id for song in pending], self.fetcher, failed)
+        else:
+            failed = [song.spotify_id for song in pending]
+        failed = set(failed)
+        if failed:
+            # A rejected token fails every request; fetch a fresh one next time
+            self._token = None
+
+        enriched = 0
+        retry, deferred = [], []
+        # One query refreshes the songs expired by the fetch's commits
+        Song.query.filter(Song.id.in_([song.id for song in pending])).all()
+        for song in pending:
+            if song.feature_vector is not None:
+                enriched += 1
+            elif song.spotify_id in failed:
+                # Spotify never answered for this song, so it is not an attempt
+                deferred.append(song.id)
+            else:
+                song.enrichment_attempts = (song.enrichment_attempts or 0) + 1
+                if song.enrichment_attempts >= self.max_attempts:
+                    song.features_status = 'failed'
+                    logger.warning(f"Giving up on audio features for song {song.id} ({song.spotify_id})")
+                else:
+                    retry.append((song.id, song.enrichment_attempts))
+        db.session.commit()
+
+        with self._cond:
+            done = set(song_ids) - {song_id for song_id, _ in retry} - set(deferred)
+            self._queued.difference_update(done)
+            now = time.monotonic()
+            for song_id, attempts in retry:
+                heapq.heappush(self._delayed, (now + self.retry_delay * 2 ** (attempts - 1), song_id))
+            for song_id in deferred:
+                heapq.heappush(self._delayed, (now + self.retry_delay, song_id))
+            self.batches += 1
+            self.enriched += enriched
+            self.retried += len(retry)
+            self.deferred += len(deferred)
+            self.failed += len(pending) - enriched - len(retry) - len(deferred)
+            if retry or deferred:
+                self._cond.notify()
+        return enriched
+
+    def drain(self):
+        """Process every ready id in the calling thread; returns the number enriched.
+
+        Stops early when a whole batch is put back unanswered: Spotify or the
+        token is unavailable, and retrying at once would not help.
+        """
+        enriched = 0
+        while True:
+            batch = self.next_batch(block=False)
+            if not batch:
+                return enriched
+            deferred = self.deferred
+            enriched += self.process_batch(batch)
+            if self.deferred - deferred == len(batch):
+                return enriched
+
+    def _run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with self.app.app_context():
+                    self.process_batch(batch)
+            except Exception as e:
+                logger.error(f"Enrichment batch failed: {e}")
+                with self._cond:
+                    # Keep the ids queued and try again after the retry delay
+                    due = time.monotonic() + self.retry_delay
+                    for song_id in batch:
+                        heapq.heappush(self._delayed, (due, song_id))
+
+
+# Create a singleton instance
+enrichment_queue = EnrichmentQueue()
@@ -0,0 +1,250 @@
+import logging
+import threading
+
+import numpy as np
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from src.models.user import db, Song
+from src.models.features import FEATURE_DIM, unpack_vector, unpack_vectors
+
+logger = logging.getLogger(__name__)
+
+# session.info key holding song changes waiting for the transaction to commit
+_PENDING_KEY = 'feature_store_pending'
+
+
+class CatalogFeatureStore:
+    """Contiguous float32 feature matrix for the catalog with a song id -> row map.
+
+    Rows are appended, updated and deleted in place (deletes move the last row
+    into the hole), so keeping the store in sync never needs a full rebuild.
+    Every change takes the next sequence number, so a fit can record exactly
+    which changes its snapshot saw.
+    """
+
+    def __init__(self, dim=FEATURE_DIM, initial_capacity=1024):
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._ids = np.zeros(initial_capacity, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+        self._fitted_size = 0
+        self._seq = 0
+        self._fitted_seq = 0
+        self._deleted = {}  # song id -> sequence number of its deletion, for deletions not fitted yet
+        self.is_loaded = False
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, song_id):
+        return song_id in self._rows
+
+    @property
+    def matrix(self):
+        """View of the live rows (do not hold on to it across writes)"""
+        return self._matrix[:self._size]
+
+    @property
+    def ids(self):
+        """Song ids aligned with the rows of ``matrix``"""
+        return self._ids[:self._size]
+
+    @property
+    def changes_since_fit(self):
+        return self._seq - self._fitted_seq
+
+    @property
+    def deleted_since_fit(self):
+        """Songs in the fitted model that have been deleted from the store since"""
+        with self._lock:
+            return set(self._deleted)
+
+    def row_of(self, song_id):
+        return self._rows.get(song_id)
+
+    def vector(self, song_id):
+        """Return a copy of a song's feature vector, or None if it is not stored"""
+        with self._lock:
+            row = self._rows.get(song_id)
+            if row is None:
+                return None
+            return self._matrix[row].copy()
+
+    def clear(self):
+        with self._lock:
+            self._rows = {}
+            self._size = 0
+            self._fitted_size = 0
+            self._fitted_seq = self._seq
+            self._deleted = {}
+            self.is_loaded = False
+
+    def load(self, items):
+        """Replace the store contents with ``(song_id, vector)`` pairs"""
+        with self._lock:
+            self.clear()
+            for song_id, vector in items:
+                self._append(song_id, vector)
+            self.is_loaded = True
+            logger.info(f"Feature store loaded with {self._size} songs")
+
+    def load_from_db(self, batch_size=10000):
+        """Full load from the songs table (cold start or repair)"""
+        rows = db.session.execute(
+            select(Song.id, Song.feature_vector)
+            .where(Song.feature_vector.isnot(None))
+            .execution_options(yield_per=batch_size))
+
+        with self._lock:
+            self.clear()
+            # Packed vectors are joined and viewed as one block per partition, no per-row parsing
+            for partition in rows.partitions():
+                ids = np.fromiter((song_id for song_id, _ in partition), dtype=np.int64, count=len(partition))
+                self._append_many(ids, unpack_vectors(blob for _, blob in partition))
+            self.is_loaded = True
+            logger.info(f"Feature store loaded with {self._size} songs")
+
+    def upsert(self, song_id, vector):
+        """Insert or update a song's vector; a None vector removes the song"""
+        if vector is None:
+            return self.delete(song_id)
+
+        with self._lock:
+            row = self._rows.get(song_id)
+            if row is None:
+                self._append(song_id, vector)
+                self._deleted.pop(song_id, None)
+            else:
+                self._matrix[row] = vector
+            self._seq += 1
+        return True
+
+    def delete(self, song_id):
+        with self._lock:
+            row = self._rows.pop(song_id, None)
+            if row is None:
+                return False
+
+            last = self._size - 1
+            if row != last:
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = self._ids[last]
+                self._rows[int(self._ids[row])] = row
+            self._size = last
+            self._seq += 1
+            self._deleted[song_id] = self._seq
+        return True
+
+    def snapshot(self):
+        """Copy the live rows so a model can be fitted while the store keeps changing.
+
+        Returns the matrix, the song ids and the sequence number of the last
+        change included, to pass to ``mark_fitted``.
+        """
+        with self._lock:
+            return self.matrix.copy(), self.ids.copy(), self._seq
+
+    def mark_fitted(self, seq=None):
+        """Record a fit on the snapshot taken at ``seq`` (default: now).
+
+        Changes committed after the snapshot still count towards drift, and
+        songs deleted after it stay excluded from the fitted model.
+        """
+        with self._lock:
+            seq = self._seq if seq is None else seq
+            self._fitted_size = self._size
+            self._fitted_seq = seq
+            self._deleted = {song_id: deleted_at for song_id, deleted_at in self._deleted.items()
+                             if deleted_at > seq}
+
+    def mark_fitted_on(self, fitted_ids):
+        """Make a model fitted on ``fitted_ids`` at an unknown point (e.g. one rolled back to) the reference.
+
+        Its songs missing from the store are excluded as deleted since the fit,
+        and the songs the two differ by count as the changes since.
+        """
+        with self._lock:
+            fitted_ids = np.asarray(fitted_ids, dtype=np.int64)
+            missing = fitted_ids[~np.isin(fitted_ids, self.ids)]
+            added = self._size - (len(fitted_ids) - len(missing))
+            self._fitted_size = len(fitted_ids)
+            self._fitted_seq = self._seq - len(missing) - added
+            self._deleted = dict.fromkeys(missing.tolist(), self._seq)
+
+    def drift(self):
+        """Fraction of rows changed since the last fit"""
+        return self.changes_since_fit / max(self._fitted_size, 1)
+
+    def _append(self, song_id, vector):
+        if self._size == len(self._matrix):
+            self._grow()
+        self._matrix[self._size] = vector
+        self._ids[self._size] = song_id
+        self._rows[song_id] = self._size
+        self._size += 1
+
+    def _append_many(self, ids, matrix):
+        while self._size + len(ids) > len(self._matrix):
+            self._grow()
+        end = self._size + len(ids)
+        self._matrix[self._size:end] = matrix
+        self._ids[self._size:end] = ids
+        self._rows.update(zip(ids.tolist(), range(self._size, end)))
+        self._size = end
+
+    def _grow(self):
+        capacity = max(2 * len(self._matrix), 1)
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        ids = np.zeros(capacity, dtype=np.int64)
+        matrix[:self._size] = self._matrix[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        self._matrix, self._ids = matrix, ids
+
+    def apply_pending(self, pending):
+        """Apply committed song changes recorded by the session listeners"""
+        if not self.is_loaded:
+            return
+        for song_id, blob in pending.items():
+            self.upsert(song_id, unpack_vector(blob))
+
+
+# Create a singleton instance
+feature_store = CatalogFeatureStore()
+
+
+def _record_change(target, feature_vector):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(_PENDING_KEY, {})[target.id] = feature_vector
+
+
+@event.listens_for(Song, 'after_insert')
+def _song_inserted(mapper, connection, target):
+    if target.feature_vector:
+        _record_change(target, target.feature_vector)
+
+
+@event.listens_for(Song, 'after_update')
+def _song_updated(mapper, connection, target):
+    if inspect(target).attrs.feature_vector.history.has_changes():
+        _record_change(target, target.feature_vector)
+
+
+@event.listens_for(Song, 'after_delete')
+def _song_deleted(mapper, connection, target):
+    _record_change(target, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _session_committed(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        feature_store.apply_pending(pending)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _session_rolled_back(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
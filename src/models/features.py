@@ -0,0 +1,62 @@
+import numpy as np
+
+# Number of normalized audio features per song
+FEATURE_DIM = 11
+
+
+# (raw audio feature, divisor) in vector order; persisted with model artifacts
+# so a model is never reused with vectors normalized differently
+FEATURE_SCALES = (
+    ('danceability', 1.0),
+    ('energy', 1.0),
+    ('key', 11.0),  # Normalize key
+    ('loudness', -60.0),  # Normalize loudness
+    ('mode', 1.0),
+    ('speechiness', 1.0),
+    ('acousticness', 1.0),
+    ('instrumentalness', 1.0),
+    ('liveness', 1.0),
+    ('valence', 1.0),
+    ('tempo', 250.0),  # Normalize tempo
+)
+
+
+def normalize_features(features):
+    """Turn a raw Spotify audio-features dict into the engine's feature vector"""
+    if not features:
+        return None
+
+    return [features.get(name, 0) / scale for name, scale in FEATURE_SCALES]
+
+
+# Features Spotify reports as integers (pitch class, major/minor)
+INTEGER_FEATURES = ('key', 'mode')
+
+
+def denormalize_features(vector):
+    """Audio-features dict back from a normalized vector, rounded to the 6 significant digits float32 keeps"""
+    if vector is None:
+        return None
+
+    features = {name: float(value) * scale for (name, scale), value in zip(FEATURE_SCALES, vector)}
+    return {name: int(round(value)) if name in INTEGER_FEATURES else float(f'{value:.6g}')
+            for name, value in features.items()}
+
+
+def pack_vector(vector):
+    """Pack a feature vector into the little-endian float32 bytes stored on Song.feature_vector"""
+    if vector is None:
+        return None
+    return np.asarray(vector, dtype='<f4').tobytes()
+
+
+def unpack_vector(blob):
+    """Read-only float32 view of a packed feature vector"""
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype='<f4')
+
+
+def unpack_vectors(blobs):
+    """Stack packed feature vectors into an (n, FEATURE_DIM) float32 matrix with one copy"""
+    return np.frombuffer(b''.join(blobs), dtype='<f4').reshape(-1, FEATURE_DIM)
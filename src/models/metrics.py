@@ -0,0 +1,255 @@
+import bisect
+import functools
+import logging
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond lookups to multi-second fits
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Path segments that are resource ids (Spotify base62 ids or numbers), collapsed to keep label cardinality bounded
+_ID_SEGMENT = re.compile(r'^(?:[0-9A-Za-z]{22}|\d+)$')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic counter per label combination"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in values]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label combination, as Prometheus expects"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        lines = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            plain = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{plain} {_format_value(total)}')
+            lines.append(f'{self.name}_count{plain} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """In-process instrumentation rendered in the Prometheus text format at ``/api/metrics``.
+
+    Flask hooks time every request and attribute the SQL statements run
+    while it is active; the Spotify HTTP client and the recommendation
+    engine report their own calls and stages. Values are per process, so a
+    multi-worker deployment is scraped per worker.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics = []
+        self.requests = self._add(Counter(
+            'http_requests_total', 'HTTP requests handled', ('method', 'route', 'status')))
+        self.request_seconds = self._add(Histogram(
+            'http_request_duration_seconds', 'HTTP request latency', ('method', 'route')))
+        self.request_queries = self._add(Histogram(
+            'http_request_db_queries', 'SQL statements executed per HTTP request', ('method', 'route'),
+            buckets=COUNT_BUCKETS))
+        self.request_query_seconds = self._add(Histogram(
+            'http_request_db_seconds', 'Time spent in SQL per HTTP request', ('method', 'route')))
+        self.queries = self._add(Counter('db_queries_total', 'SQL statements executed'))
+        self.query_seconds = self._add(Histogram('db_query_duration_seconds', 'SQL statement latency'))
+        self.spotify_calls = self._add(Counter(
+            'spotify_requests_total', 'Spotify API calls, including retries', ('method', 'endpoint', 'status')))
+        self.spotify_seconds = self._add(Histogram(
+            'spotify_request_duration_seconds', 'Spotify API call latency', ('method', 'endpoint')))
+        self.stage_seconds = self._add(Histogram(
+            'recommender_stage_duration_seconds', 'Recommendation engine stage latency', ('stage',)))
+        self.search_rounds = self._add(Histogram(
+            'recommender_knn_search_rounds', 'kNN searches run per recommendation request', buckets=COUNT_BUCKETS))
+        self.short_searches = self._add(Counter(
+            'recommender_short_results_total', 'Recommendation requests that found fewer songs than asked for'))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def init_app(self, app, db):
+        """Install the request hooks and the SQL timing listeners"""
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _before_request(self):
+        if self.enabled:
+            g._metrics_started = time.perf_counter()
+            g._metrics_queries = 0
+            g._metrics_query_seconds = 0.0
+
+    def _after_request(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.requests.inc(request.method, route, str(response.status_code))
+        self.request_seconds.observe(time.perf_counter() - started, request.method, route)
+        self.request_queries.observe(g._metrics_queries, request.method, route)
+        self.request_query_seconds.observe(g._metrics_query_seconds, request.method, route)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('_metrics_started')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        self.queries.inc()
+        self.query_seconds.observe(elapsed)
+        # Statements run by background workers have no request to attribute them to
+        if has_request_context() and '_metrics_queries' in g:
+            g._metrics_queries += 1
+            g._metrics_query_seconds += elapsed
+
+    def observe_spotify(self, method, url, status, seconds):
+        """Record one Spotify HTTP attempt; ``status`` is the HTTP status or 'error'"""
+        if not self.enabled:
+            return
+        endpoint = spotify_endpoint(url)
+        self.spotify_calls.inc(method, endpoint, str(status))
+        self.spotify_seconds.observe(seconds, method, endpoint)
+
+    def observe_search(self, rounds, short):
+        """Record one recommendation request's kNN search: rounds run and whether it came up short"""
+        if not self.enabled:
+            return
+        self.search_rounds.observe(rounds)
+        if short:
+            self.short_searches.inc()
+
+    @contextmanager
+    def time_stage(self, stage):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - started, stage)
+
+    def timed(self, stage):
+        """Decorator recording each call's duration as an engine stage"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time_stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+def spotify_endpoint(url):
+    """Low-cardinality label for a Spotify URL: its path with ids replaced by ``{id}``"""
+    segments = urlparse(url).path.split('/')
+    return '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment for segment in segments) or '/'
+
+
+# Create a singleton instance
+metrics = Metrics()
@@ -0,0 +1,155 @@
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, MetaData, String, Table, bindparam, inspect, select, text,
+                        update)
+from sqlalchemy.schema import CreateColumn
+
+from src.models.user import Song, UserPreference, UserProfile, Recommendation
+from src.models.features import normalize_features, pack_vector
+
+logger = logging.getLogger(__name__)
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', String(64), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def add_column(conn, column):
+    """Add a model column to its existing table unless it is already there"""
+    table = column.table
+    existing = {c['name'] for c in inspect(conn).get_columns(table.name)}
+    if column.name in existing:
+        return False
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+    logger.info(f"Added column {table.name}.{column.name}")
+    return True
+
+
+def create_index(conn, model, name):
+    """Create one of a model's declared indexes unless it already exists"""
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    index.create(conn, checkfirst=True)
+
+
+def backfill_feature_vectors(conn, batch_size=5000):
+    """Pack ``Song.feature_vector`` for rows that only have raw JSON features; returns rows updated"""
+    songs = Song.__table__
+    updated = last_id = 0
+    while True:
+        # Keyset pagination, so rows whose JSON yields no vector are not selected again
+        rows = conn.execute(
+            select(songs.c.id, songs.c.features)
+            .where(songs.c.feature_vector.is_(None), songs.c.features.isnot(None), songs.c.id > last_id)
+            .order_by(songs.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+        conn.execute(
+            update(songs).where(songs.c.id == bindparam('song_id')).values(feature_vector=bindparam('vector')),
+            [{'song_id': song_id, 'vector': pack_vector(normalize_features(json.loads(raw)))}
+             for song_id, raw in rows])
+        updated += len(rows)
+        last_id = rows[-1][0]
+    if updated:
+        logger.info(f"Backfilled packed feature vectors for {updated} songs")
+    return updated
+
+
+def _song_enrichment_columns(conn):
+    add_column(conn, Song.__table__.c.features_status)
+    add_column(conn, Song.__table__.c.enrichment_attempts)
+
+
+def _song_feature_vector(conn):
+    add_column(conn, Song.__table__.c.feature_vector)
+    backfill_feature_vectors(conn)
+
+
+def _unique_user_preferences(conn):
+    # Keep the newest row of each duplicated (user, song) pair, then enforce uniqueness.
+    # The derived table lets MySQL delete from the table it is selecting from.
+    affected = [user_id for (user_id,) in conn.execute(text(
+        'SELECT DISTINCT user_id FROM user_preferences GROUP BY user_id, song_id HAVING COUNT(*) > 1'))]
+    if affected:
+        removed = conn.execute(text(
+            'DELETE FROM user_preferences WHERE id NOT IN (SELECT id FROM ('
+            'SELECT MAX(id) AS id FROM user_preferences GROUP BY user_id, song_id) AS keep)')).rowcount
+        # Profiles counted the duplicates; drop them so they are rebuilt on next use
+        conn.execute(UserProfile.__table__.delete().where(UserProfile.__table__.c.user_id.in_(affected)))
+        logger.info(f"Removed {removed} duplicate preferences of {len(affected)} users")
+    create_index(conn, UserPreference, 'uq_user_preferences_user_song')
+
+
+def _recommendation_serving_index(conn):
+    create_index(conn, Recommendation, 'ix_recommendations_user_shown_score')
+
+
+def _preference_history_index(conn):
+    create_index(conn, UserPreference, 'ix_user_preferences_user_time')
+
+
+def _song_popularity_indexes(conn):
+    create_index(conn, Song, 'ix_songs_popularity')
+    create_index(conn, Song, 'ix_songs_genre_popularity')
+
+
+def _preference_song_index(conn):
+    create_index(conn, UserPreference, 'ix_user_preferences_song_rating')
+
+
+# (version, description, function) in the order they must be applied; never edit or reorder
+# an applied migration, add a new one instead
+MIGRATIONS = [
+    ('0001_song_enrichment_columns', 'Song.features_status and Song.enrichment_attempts',
+     _song_enrichment_columns),
+    ('0002_song_feature_vector', 'Packed Song.feature_vector, backfilled from the JSON features',
+     _song_feature_vector),
+    ('0003_unique_user_preferences', 'Deduplicate preferences and add a unique (user_id, song_id) index',
+     _unique_user_preferences),
+    ('0004_recommendation_serving_index', 'Index on recommendations (user_id, is_shown, score)',
+     _recommendation_serving_index),
+    ('0005_preference_history_index', 'Index on user_preferences (user_id, timestamp, id) for paging',
+     _preference_history_index),
+    ('0006_song_popularity_indexes', 'Indexes on songs (popularity) and (genre, popularity) for top-K lists',
+     _song_popularity_indexes),
+    ('0007_preference_song_index', 'Index on user_preferences (song_id, rating) for profile updates',
+     _preference_song_index),
+]
+
+
+def applied_versions(engine):
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {version: applied_at for version, applied_at in conn.execute(select(schema_migrations))}
+
+
+def migration_status(engine):
+    """``(version, description, applied_at or None)`` for every known migration"""
+    applied = applied_versions(engine)
+    return [(version, description, applied.get(version)) for version, description, _ in MIGRATIONS]
+
+
+def migrate(engine, target=None):
+    """Apply pending migrations up to and including ``target``; returns the versions applied.
+
+    ``db.create_all()`` never alters existing tables, so every change to one
+    is a numbered migration. Each runs in its own transaction and is recorded
+    in ``schema_migrations``. Migrations must be idempotent: a fresh database
+    from ``create_all()`` already has the latest columns and indexes.
+    """
+    applied = applied_versions(engine)
+    done = []
+    for version, description, apply in MIGRATIONS:
+        if version not in applied:
+            with engine.begin() as conn:
+                apply(conn)
+                conn.execute(schema_migrations.insert().values(version=version, applied_at=datetime.utcnow()))
+            logger.info(f"Applied migration {version}: {description}")
+            done.append(version)
+        if version == target:
+            break
+    return done
@@ -0,0 +1,188 @@
+import glob
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from src.models.features import FEATURE_DIM, FEATURE_SCALES
+
+logger = logging.getLogger(__name__)
+
+# Directory layout: manifest.json, arrays.npz (features + song ids), index.pkl (fitted index)
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+ARRAYS_FILE = 'arrays.npz'
+INDEX_FILE = 'index.pkl'
+
+
+def catalog_checksum(song_features, song_ids):
+    """Order-independent SHA-256 of a catalog's song ids and feature vectors"""
+    song_ids = np.asarray(song_ids, dtype=np.int64)
+    order = np.argsort(song_ids, kind='stable')
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(song_ids[order], dtype='<i8').tobytes())
+    digest.update(np.ascontiguousarray(np.asarray(song_features)[order], dtype='<f4').tobytes())
+    return digest.hexdigest()
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_parameters(backend, index_params):
+    """Everything besides the catalog that must match for an artifact to be reusable"""
+    return {
+        'format': FORMAT_VERSION,
+        'backend': backend,
+        'index_params': dict(index_params),
+        'feature_dim': FEATURE_DIM,
+        'feature_scales': [list(pair) for pair in FEATURE_SCALES],
+    }
+
+
+def save_artifact(directory, model, song_features, song_ids, backend, index_params, keep=3):
+    """Write a fitted model as a new artifact directory; returns its manifest"""
+    song_features = np.asarray(song_features, dtype=np.float32)
+    song_ids = np.asarray(song_ids, dtype=np.int64)
+    checksum = catalog_checksum(song_features, song_ids)
+    created_at = time.time()
+    token = uuid.uuid4().hex[:8]
+    name = f'model-{int(created_at * 1000):013d}-{checksum[:8]}-{token}'
+
+    # Build in a private directory and rename it into place, so readers never see a partial artifact
+    os.makedirs(directory, exist_ok=True)
+    tmp_dir = os.path.join(directory, f'.tmp-{token}')
+    os.makedirs(tmp_dir)
+    try:
+        np.savez(os.path.join(tmp_dir, ARRAYS_FILE), song_features=song_features, song_ids=song_ids)
+        with open(os.path.join(tmp_dir, INDEX_FILE), 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        manifest = dict(model_parameters(backend, index_params),
+                        name=name,
+                        created_at=created_at,
+                        songs=len(song_ids),
+                        catalog_checksum=checksum,
+                        files={filename: _file_sha256(os.path.join(tmp_dir, filename))
+                               for filename in (ARRAYS_FILE, INDEX_FILE)})
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_dir, os.path.join(directory, name))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    prune_artifacts(directory, keep)
+    logger.info(f"Saved model artifact {name} with {len(song_ids)} songs to {directory}")
+    return manifest
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def list_artifacts(directory):
+    """Manifests of the artifacts in ``directory``, newest first (unreadable ones are skipped)"""
+    manifests = []
+    for path in sorted(glob.glob(os.path.join(directory, 'model-*')), reverse=True):
+        try:
+            manifest = read_manifest(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable model artifact {path}: {e}")
+            continue
+        manifest['path'] = path
+        manifests.append(manifest)
+    return manifests
+
+
+def verify_artifact(path):
+    """Problems found in an artifact: file checksums, and the stored catalog against its checksum"""
+    try:
+        manifest = read_manifest(path)
+    except (OSError, ValueError) as e:
+        return [f"unreadable manifest: {e}"]
+
+    problems = []
+    for filename in (ARRAYS_FILE, INDEX_FILE):
+        expected = manifest.get('files', {}).get(filename)
+        file_path = os.path.join(path, filename)
+        if not os.path.exists(file_path):
+            problems.append(f"{filename} is missing")
+        elif expected is None:
+            problems.append(f"{filename} has no checksum in the manifest")
+        elif _file_sha256(file_path) != expected:
+            problems.append(f"{filename} checksum mismatch")
+    if problems:
+        return problems
+
+    with np.load(os.path.join(path, ARRAYS_FILE)) as arrays:
+        if catalog_checksum(arrays['song_features'], arrays['song_ids']) != manifest['catalog_checksum']:
+            problems.append("stored catalog does not match its checksum")
+    return problems
+
+
+def _read_checked(path, manifest, filename):
+    """Contents of one artifact file, after checking them against the manifest's SHA-256"""
+    expected = manifest.get('files', {}).get(filename)
+    if expected is None:
+        raise ValueError(f"{filename} has no checksum in the manifest")
+    with open(os.path.join(path, filename), 'rb') as f:
+        data = f.read()
+    # Hash the bytes that are parsed, so a file replaced after the check is never loaded
+    if hashlib.sha256(data).hexdigest() != expected:
+        raise ValueError(f"{filename} checksum mismatch")
+    return data
+
+
+def load_artifact(path):
+    """Read an artifact back; returns (manifest, model, song_features, song_ids).
+
+    Every file is checked against its manifest checksum, and the arrays
+    against the catalog checksum, before the index is unpickled; any
+    mismatch raises ValueError.
+    """
+    manifest = read_manifest(path)
+    with np.load(io.BytesIO(_read_checked(path, manifest, ARRAYS_FILE))) as arrays:
+        song_features = arrays['song_features']
+        song_ids = arrays['song_ids']
+    if catalog_checksum(song_features, song_ids) != manifest['catalog_checksum']:
+        raise ValueError("stored catalog does not match its checksum")
+    model = pickle.loads(_read_checked(path, manifest, INDEX_FILE))
+    return manifest, model, song_features, song_ids
+
+
+def find_compatible_artifact(directory, checksum, backend, index_params):
+    """Newest artifact fitted on the catalog with ``checksum`` using the current model parameters"""
+    expected = model_parameters(backend, index_params)
+    for manifest in list_artifacts(directory):
+        if manifest.get('catalog_checksum') != checksum:
+            continue
+        if any(manifest.get(key) != value for key, value in expected.items()):
+            continue
+        return manifest
+    return None
+
+
+def prune_artifacts(directory, keep=3):
+    """Delete all but the newest ``keep`` artifacts; returns the paths removed"""
+    paths = sorted(glob.glob(os.path.join(directory, 'model-*')), reverse=True)
+    removed = []
+    for path in paths[keep:]:
+        try:
+            shutil.rmtree(path)
+            removed.append(path)
+        except OSError as e:
+            logger.warning(f"Could not remove old model artifact {path}: {e}")
+    return removed
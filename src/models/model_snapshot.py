@@ -0,0 +1,79 @@
+import time
+
+import numpy as np
+
+
+class ModelSnapshot:
+    """One fitted model with the catalog it was fitted on, never modified after creation.
+
+    The engine swaps whole snapshots, so a request that took a reference to
+    one keeps a consistent index, feature matrix and id mapping even if a
+    newer model is activated while it runs.
+    """
+
+    __slots__ = ('version', 'model', 'song_features', 'song_ids', 'source', 'catalog_version', 'created_at',
+                 '_id_order', '_sorted_ids')
+
+    def __init__(self, version, model, song_features, song_ids, source='train', catalog_version=0):
+        song_features = np.asarray(song_features)
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        # Private copies are frozen; memory-mapped catalogs are read-only already
+        for array in (song_features, song_ids):
+            if array.flags.writeable and array.flags.owndata:
+                array.flags.writeable = False
+
+        self.version = version
+        self.model = model
+        self.song_features = song_features
+        self.song_ids = song_ids
+        self.source = source
+        self.catalog_version = catalog_version
+        self.created_at = time.time()
+
+        # Sorted view of the song ids for vectorized id -> row lookups
+        self._id_order = np.argsort(song_ids, kind='stable')
+        self._sorted_ids = song_ids[self._id_order]
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'source': self.source,
+            'songs': len(self),
+            'catalog_version': self.catalog_version,
+            'backend': getattr(self.model, 'name', type(self.model).__name__),
+            'created_at': self.created_at,
+        }
+
+    def locate_song_ids(self, song_ids):
+        """Vectorized lookup: which songs are in the fitted model, and their rows"""
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        if not len(song_ids) or not len(self._sorted_ids):
+            return np.zeros(len(song_ids), dtype=bool), np.empty(0, dtype=np.int64)
+
+        pos = np.minimum(np.searchsorted(self._sorted_ids, song_ids), len(self._sorted_ids) - 1)
+        found = self._sorted_ids[pos] == song_ids
+        return found, self._id_order[pos[found]]
+
+    def rows_for_song_ids(self, song_ids):
+        """Rows of the fitted model holding the given songs (unknown ids are dropped)"""
+        return self.locate_song_ids(np.fromiter(song_ids, dtype=np.int64))[1]
+
+    def nearest_in_rows(self, query, rows, n_neighbors):
+        """Exact nearest neighbours among a small set of rows (``rows`` sorted); returns distances, rows"""
+        if not len(rows):
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        diff = self.song_features[rows] - np.asarray(query, dtype=np.float32).ravel()
+        sq_distances = np.einsum('ij,ij->i', diff, diff)
+        n_neighbors = min(n_neighbors, len(rows))
+        best = np.argpartition(sq_distances, n_neighbors - 1)[:n_neighbors]
+        best = best[np.argsort(sq_distances[best], kind='stable')]
+        return np.sqrt(sq_distances[best]), rows[best]
+
+    def exclusion_mask(self, song_ids):
+        """Boolean mask over the fitted rows with the given songs set"""
+        mask = np.zeros(len(self.song_ids), dtype=bool)
+        mask[self.rows_for_song_ids(song_ids)] = True
+        return mask
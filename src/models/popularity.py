@@ -0,0 +1,209 @@
+import bisect
+import logging
+import threading
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from src.models.user import db, Song
+
+logger = logging.getLogger(__name__)
+
+# session.info key holding popularity changes waiting for the transaction to commit
+_PENDING_KEY = 'popularity_index_pending'
+
+# Key of the catalog-wide list; genre lists are keyed by the genre name
+GLOBAL = None
+
+
+class _TopList:
+    __slots__ = ('entries', 'members', 'complete')
+
+    def __init__(self, rows, k):
+        # Sorted (-popularity, song id): most popular first, ties by song id
+        self.entries = sorted((-popularity, song_id) for song_id, popularity in rows)
+        self.members = {song_id: -negated for negated, song_id in self.entries}
+        # Holds every song of its key, so removals never leave a gap to refill
+        self.complete = len(self.entries) < k
+
+
+class PopularityIndex:
+    """In-memory top-K most popular songs, catalog-wide and per genre.
+
+    Lists are loaded once with a bounded query and then updated in place from
+    committed song changes: a new or more popular song is inserted at its
+    rank, pushing the last one out. A list that loses a member (song deleted,
+    popularity lowered, genre changed) while songs outside it may now rank
+    higher is refilled from the database on its next read. ``version``
+    increases with every change to any list.
+    """
+
+    def __init__(self, k=200):
+        self.k = k
+        self._lists = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self.version = 0
+        self.is_loaded = False
+
+    def init_app(self, app):
+        """Read the list length from the Flask config"""
+        self.k = app.config.get('POPULARITY_TOP_K', self.k)
+
+    def clear(self):
+        with self._lock:
+            self._lists.clear()
+            self._dirty.clear()
+            self.is_loaded = False
+
+    def stats(self):
+        with self._lock:
+            return {'version': self.version, 'k': self.k, 'genres': len(self._lists) - (GLOBAL in self._lists),
+                    'songs': len(self._lists[GLOBAL].members) if GLOBAL in self._lists else 0}
+
+    @staticmethod
+    def _ranked(query):
+        return query.where(Song.popularity.isnot(None)).order_by(Song.popularity.desc(), Song.id)
+
+    def load_from_db(self):
+        """Load the global list and every genre's list (one windowed query for all genres)"""
+        top = db.session.execute(self._ranked(select(Song.id, Song.popularity)).limit(self.k)).all()
+
+        rank = func.row_number().over(partition_by=Song.genre, order_by=(Song.popularity.desc(), Song.id))
+        ranked = (select(Song.id, Song.genre, Song.popularity, rank.label('rank'))
+                  .where(Song.genre.isnot(None), Song.popularity.isnot(None))
+                  .subquery())
+        by_genre = {}
+        for song_id, genre, popularity in db.session.execute(
+                select(ranked.c.id, ranked.c.genre, ranked.c.popularity).where(ranked.c.rank <= self.k)):
+            by_genre.setdefault(genre, []).append((song_id, popularity))
+
+        with self._lock:
+            self._lists = {genre: _TopList(rows, self.k) for genre, rows in by_genre.items()}
+            self._lists[GLOBAL] = _TopList(top, self.k)
+            self._dirty.clear()
+            self.version += 1
+            self.is_loaded = True
+        logger.info(f"Popularity lists loaded: {len(top)} songs globally, {len(by_genre)} genres")
+
+    def _refill(self, key):
+        query = self._ranked(select(Song.id, Song.popularity))
+        if key is not GLOBAL:
+            query = query.where(Song.genre == key)
+        rows = db.session.execute(query.limit(self.k)).all()
+        with self._lock:
+            self._lists[key] = _TopList(rows, self.k)
+            self._dirty.discard(key)
+            self.version += 1
+
+    def _remove(self, key, song_id):
+        """Drop a song from a list; returns its popularity there, or None if it was not listed"""
+        top = self._lists.get(key)
+        if top is None or song_id not in top.members:
+            return None
+        popularity = top.members.pop(song_id)
+        del top.entries[bisect.bisect_left(top.entries, (-popularity, song_id))]
+        return popularity
+
+    def _offer(self, key, song_id, popularity):
+        top = self._lists.get(key)
+        if top is None:
+            # First song of a new genre
+            top = self._lists[key] = _TopList([], self.k)
+        entry = (-popularity, song_id)
+        if len(top.entries) >= self.k and entry > top.entries[-1]:
+            top.complete = False
+            return False
+        bisect.insort(top.entries, entry)
+        top.members[song_id] = popularity
+        if len(top.entries) > self.k:
+            _, dropped = top.entries.pop()
+            del top.members[dropped]
+            top.complete = False
+        return True
+
+    def apply_pending(self, pending):
+        """Apply committed song changes recorded by the session listeners"""
+        if not self.is_loaded:
+            return
+        with self._lock:
+            changed = False
+            for song_id, (old_genre, genre, popularity) in pending.items():
+                for key in {GLOBAL, old_genre, genre}:
+                    if key is not GLOBAL and not key:
+                        continue
+                    new = popularity if key is GLOBAL or key == genre else None
+                    complete = key in self._lists and self._lists[key].complete
+                    old = self._remove(key, song_id)
+                    inserted = new is not None and self._offer(key, song_id, new)
+                    # A member that left or dropped may have been overtaken by a song outside the list
+                    if old is not None and not complete and (new is None or new < old):
+                        self._dirty.add(key)
+                    changed |= old is not None or inserted
+            if changed:
+                self.version += 1
+
+    def top(self, n, exclude=(), genres=()):
+        """Up to ``n`` popular song ids not in ``exclude``: the given genres' lists first, then the global list"""
+        if not self.is_loaded:
+            self.load_from_db()
+        for key in [genre for genre in genres if genre in self._dirty] + [GLOBAL] * (GLOBAL in self._dirty):
+            self._refill(key)
+
+        chosen = []
+        seen = set(exclude)
+        with self._lock:
+            for key in list(genres) + [GLOBAL]:
+                top = self._lists.get(key)
+                for _, song_id in (top.entries if top else ()):
+                    if song_id not in seen:
+                        seen.add(song_id)
+                        chosen.append(song_id)
+                        if len(chosen) >= n:
+                            return chosen
+        return chosen
+
+
+# Create a singleton instance
+popularity_index = PopularityIndex()
+
+
+def _record_change(target, old_genre, genre, popularity):
+    session = object_session(target)
+    if session is not None:
+        pending = session.info.setdefault(_PENDING_KEY, {})
+        # Several flushes in one transaction: the lists still hold the song under its first genre
+        if target.id in pending:
+            old_genre = pending[target.id][0]
+        pending[target.id] = (old_genre, genre, popularity)
+
+
+@event.listens_for(Song, 'after_insert')
+def _song_inserted(mapper, connection, target):
+    if target.popularity is not None:
+        _record_change(target, None, target.genre, target.popularity)
+
+
+@event.listens_for(Song, 'after_update')
+def _song_updated(mapper, connection, target):
+    state = inspect(target).attrs
+    if state.popularity.history.has_changes() or state.genre.history.has_changes():
+        old_genre = (state.genre.history.deleted or [target.genre])[0]
+        _record_change(target, old_genre, target.genre, target.popularity)
+
+
+@event.listens_for(Song, 'after_delete')
+def _song_deleted(mapper, connection, target):
+    _record_change(target, target.genre, None, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _session_committed(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        popularity_index.apply_pending(pending)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _session_rolled_back(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
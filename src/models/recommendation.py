@@ -1,9 +1,26 @@
-import requests
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
-from src.models.user import db, User, Song, UserPreference, Recommendation
+from datetime import datetime
+from sqlalchemy import delete, event, func, insert, inspect, select
+from sqlalchemy.orm import Session
+from src.models.user import db, User, Song, UserPreference, UserProfile, Recommendation
+from src.models.feature_store import feature_store
+from src.models.features import FEATURE_DIM, unpack_vector, unpack_vectors
+from src.models.ann import create_index, BruteForceIndex, BallTreeIndex
+from src.models.model_snapshot import ModelSnapshot
+from src.models.spotify_http import spotify_http
+from src.models.spotify_cache import spotify_cache
+from src.models.serving import serving_cache
+from src.models.popularity import popularity_index
+from src.models.catalog_filters import CatalogFilterIndex, filter_conditions
+from src.models.catalog_file import write_catalog, read_current_version, open_current_catalog
+from src.models.metrics import metrics
+from src.models.model_artifacts import catalog_checksum, save_artifact, load_artifact, find_compatible_artifact
+from collections import deque
+import itertools
 import json
 import logging
+import threading
+import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +31,10 @@ class SpotifyClient:
     
     BASE_URL = "https://api.spotify.com/v1"
     
+    # Maximum ids per request accepted by the batch endpoints
+    AUDIO_FEATURES_BATCH_SIZE = 100
+    TRACKS_BATCH_SIZE = 50
+    
     @staticmethod
     def get_headers(access_token):
         """Get headers for Spotify API requests"""
@@ -22,20 +43,88 @@ class SpotifyClient:
             'Content-Type': 'application/json'
         }
     
+    @staticmethod
+    def get_app_token(client_id, client_secret):
+        """Get an app access token with the client credentials flow (no user needed)"""
+        try:
+            response = spotify_http.post(
+                'https://accounts.spotify.com/api/token',
+                data={'grant_type': 'client_credentials'},
+                auth=(client_id, client_secret)
+            )
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            logger.error(f"Error getting app access token: {e}")
+            return None
+    
     @staticmethod
     def get_audio_features(access_token, track_id):
         """Get audio features for a track"""
+        cached = spotify_cache.get('audio-features', track_id)
+        if cached is not None:
+            return cached
+        
         url = f"{SpotifyClient.BASE_URL}/audio-features/{track_id}"
         headers = SpotifyClient.get_headers(access_token)
         
         try:
-            response = requests.get(url, headers=headers)
+            response = spotify_http.get(url, headers=headers)
             response.raise_for_status()
-            return response.json()
+            features = response.json()
+            spotify_cache.set('audio-features', track_id, features)
+            return features
         except Exception as e:
             logger.error(f"Error getting audio features: {e}")
             return None
     
+    @staticmethod
+    def chunk_ids(ids, size):
+        """Split ids into request-sized chunks, dropping duplicates and blanks"""
+        ids = list(dict.fromkeys(track_id for track_id in ids if track_id))
+        return [ids[i:i + size] for i in range(0, len(ids), size)]
+    
+    @staticmethod
+    def _get_batch(access_token, endpoint, key, cache_name, track_ids, batch_size, failed=None):
+        """Fetch a batch endpoint chunk by chunk and merge the results by track id.
+        
+        Ids of chunks whose request failed are added to ``failed`` when given,
+        to tell them apart from ids Spotify answered with null.
+        """
+        url = f"{SpotifyClient.BASE_URL}/{endpoint}"
+        headers = SpotifyClient.get_headers(access_token)
+        
+        # Only ask Spotify for the ids that are not cached
+        results = spotify_cache.get_many(cache_name, [track_id for track_id in track_ids if track_id])
+        missing = [track_id for track_id in track_ids if track_id not in results]
+        
+        for chunk in SpotifyClient.chunk_ids(missing, batch_size):
+            try:
+                response = spotify_http.get(url, headers=headers, params={'ids': ','.join(chunk)})
+                response.raise_for_status()
+                # Unknown ids come back as null entries
+                fetched = {item['id']: item for item in response.json().get(key) or [] if item}
+                spotify_cache.set_many(cache_name, fetched)
+                results.update(fetched)
+            except Exception as e:
+                logger.error(f"Error getting {endpoint} for {len(chunk)} tracks: {e}")
+                if failed is not None:
+                    failed.extend(chunk)
+        
+        return results
+    
+    @staticmethod
+    def get_audio_features_batch(access_token, track_ids, failed=None):
+        """Get audio features for many tracks as {track_id: features}, 100 ids per request"""
+        return SpotifyClient._get_batch(access_token, 'audio-features', 'audio_features', 'audio-features', track_ids,
+                                        SpotifyClient.AUDIO_FEATURES_BATCH_SIZE, failed)
+    
+    @staticmethod
+    def get_tracks_batch(access_token, track_ids):
+        """Get track details for many tracks as {track_id: track}, 50 ids per request"""
+        return SpotifyClient._get_batch(access_token, 'tracks', 'tracks', 'track', track_ids,
+                                        SpotifyClient.TRACKS_BATCH_SIZE)
+    
     @staticmethod
     def get_recommendations(access_token, seed_tracks=None, seed_genres=None, seed_artists=None, limit=10):
         """Get recommendations from Spotify"""
@@ -55,7 +144,7 @@ class SpotifyClient:
             params['seed_genres'] = 'pop,rock,hip-hop,electronic,r-n-b'
         
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = spotify_http.get(url, headers=headers, params=params)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -65,6 +154,11 @@ class SpotifyClient:
     @staticmethod
     def search_tracks(access_token, query, limit=10):
         """Search for tracks on Spotify"""
+        cache_key = f'{limit}:{query}'
+        cached = spotify_cache.get('search', cache_key)
+        if cached is not None:
+            return cached
+        
         url = f"{SpotifyClient.BASE_URL}/search"
         headers = SpotifyClient.get_headers(access_token)
         params = {
@@ -74,9 +168,11 @@ class SpotifyClient:
         }
         
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = spotify_http.get(url, headers=headers, params=params)
             response.raise_for_status()
-            return response.json()
+            results = response.json()
+            spotify_cache.set('search', cache_key, results)
+            return results
         except Exception as e:
             logger.error(f"Error searching tracks: {e}")
             return None
@@ -84,13 +180,19 @@ class SpotifyClient:
     @staticmethod
     def get_track(access_token, track_id):
         """Get track details"""
+        cached = spotify_cache.get('track', track_id)
+        if cached is not None:
+            return cached
+        
         url = f"{SpotifyClient.BASE_URL}/tracks/{track_id}"
         headers = SpotifyClient.get_headers(access_token)
         
         try:
-            response = requests.get(url, headers=headers)
+            response = spotify_http.get(url, headers=headers)
             response.raise_for_status()
-            return response.json()
+            track = response.json()
+            spotify_cache.set('track', track_id, track)
+            return track
         except Exception as e:
             logger.error(f"Error getting track: {e}")
             return None
@@ -98,98 +200,413 @@ class SpotifyClient:
 class RecommendationEngine:
     """AI-based recommendation engine that learns from user feedback"""
     
-    def __init__(self):
-        self.model = NearestNeighbors(n_neighbors=10, algorithm='ball_tree')
-        self.song_features = []
-        self.song_ids = []
-        self.is_trained = False
+    def __init__(self, store=feature_store, refit_threshold=0.05, catalog_dir=None, catalog_poll_seconds=5.0,
+                 index_backend='ball_tree', index_params=None, snapshot_history=3, artifact_dir=None,
+                 artifact_keep=3, filter_scan_fraction=0.05):
+        self.index_backend = index_backend
+        self.index_params = dict(index_params or {})
+        self.store = store
+        self.refit_threshold = refit_threshold
+        self.catalog_dir = catalog_dir
+        self.catalog_poll_seconds = catalog_poll_seconds
+        self.catalog_version = 0
+        self.artifact_dir = artifact_dir
+        self.artifact_keep = artifact_keep
+        # Filtered searches allowing at most this fraction of the catalog scan those rows directly
+        self.filter_scan_fraction = filter_scan_fraction
+        self._filter_index = (None, None)  # (snapshot, CatalogFilterIndex built for it)
+        self._catalog_checked_at = 0.0
+        self.app = None
+        # The active model is an immutable snapshot replaced by a single reference swap;
+        # previous snapshots are kept for rollback
+        self._snapshot = None
+        self._history = deque(maxlen=snapshot_history)
+        self._versions = itertools.count(1)
+        self._swap_lock = threading.Lock()
+        self._train_lock = threading.Lock()
+        self._training_thread = None
+        self.training = self._idle_training_status()
+        self._stats_lock = threading.Lock()
+        self.search_stats = self._empty_search_stats()
+    
+    def init_app(self, app):
+        """Read engine settings from the Flask config"""
+        self.refit_threshold = app.config.get('RECOMMENDER_REFIT_THRESHOLD', self.refit_threshold)
+        self.index_backend = app.config.get('RECOMMENDER_INDEX_BACKEND', self.index_backend)
+        self.index_params = dict(app.config.get('RECOMMENDER_INDEX_PARAMS', self.index_params))
+        self.catalog_dir = app.config.get('RECOMMENDER_CATALOG_DIR', self.catalog_dir)
+        self.catalog_poll_seconds = app.config.get('RECOMMENDER_CATALOG_POLL_SECONDS', self.catalog_poll_seconds)
+        self._history = deque(self._history, maxlen=app.config.get('RECOMMENDER_SNAPSHOT_HISTORY', self._history.maxlen))
+        self.artifact_dir = app.config.get('RECOMMENDER_ARTIFACT_DIR', self.artifact_dir)
+        self.artifact_keep = app.config.get('RECOMMENDER_ARTIFACT_KEEP', self.artifact_keep)
+        self.filter_scan_fraction = app.config.get('RECOMMENDER_FILTER_SCAN_FRACTION', self.filter_scan_fraction)
+        self.app = app
+        
+        # Start from the shared catalog file if another process already published one
+        if self.catalog_dir:
+            self.check_for_new_catalog(force=True)
+    
+    def reset(self):
+        """Forget the fitted model and the cached catalog"""
+        self.store.clear()
+        with self._swap_lock:
+            self._snapshot = None
+            self._history.clear()
+        self.catalog_version = 0
+        self._catalog_checked_at = 0.0
+        popularity_index.clear()
+        self._filter_index = (None, None)
+        self.training = self._idle_training_status()
+        self.search_stats = self._empty_search_stats()
+    
+    @staticmethod
+    def _idle_training_status():
+        return {'state': 'idle', 'started_at': None, 'finished_at': None, 'error': None}
+    
+    @property
+    def snapshot(self):
+        """The active model snapshot (None before the first fit); take it once per request"""
+        return self._snapshot
+    
+    @property
+    def is_trained(self):
+        return self._snapshot is not None
+    
+    @property
+    def model(self):
+        return self._snapshot.model if self._snapshot else None
+    
+    @property
+    def song_ids(self):
+        return self._snapshot.song_ids if self._snapshot else np.empty(0, dtype=np.int64)
+    
+    @property
+    def song_features(self):
+        return self._snapshot.song_features if self._snapshot else np.empty((0, FEATURE_DIM), dtype=np.float32)
+    
+    def activate(self, snapshot):
+        """Make ``snapshot`` the one new requests use, keeping the current one for rollback"""
+        with self._swap_lock:
+            if self._snapshot is not None:
+                self._history.append(self._snapshot)
+            self._snapshot = snapshot
+        logger.info(f"Activated model version {snapshot.version} ({snapshot.source}, {len(snapshot)} songs)")
+    
+    def rollback(self):
+        """Reactivate the previous snapshot; returns it, or None when there is none"""
+        with self._swap_lock:
+            if not self._history:
+                return None
+            self._snapshot = self._history.pop()
+            snapshot = self._snapshot
+        logger.info(f"Rolled back to model version {snapshot.version}")
+        
+        # Deletions are tracked against the active model: songs it still holds may be gone
+        if self.store.is_loaded:
+            self.store.mark_fitted_on(snapshot.song_ids)
+        
+        # Other worker processes follow the shared catalog
+        if self.catalog_dir:
+            self.export_catalog(snapshot=snapshot)
+        return snapshot
+    
+    def model_status(self):
+        """Training state, the active snapshot, the ones available for rollback and kNN search counters"""
+        with self._swap_lock:
+            active = self._snapshot.describe() if self._snapshot else None
+            previous = [snapshot.describe() for snapshot in reversed(self._history)]
+        with self._stats_lock:
+            search = dict(self.search_stats)
+        return {'training': dict(self.training), 'active': active, 'previous': previous,
+                'popularity': popularity_index.stats(), 'search': search}
+    
+    @staticmethod
+    def _empty_search_stats():
+        # rounds: total kNN searches run; widened: requests needing more than one;
+        # short: requests that got fewer than n songs (catalog exhausted)
+        return {'searches': 0, 'rounds': 0, 'max_rounds': 0, 'widened': 0, 'short': 0}
     
     def extract_features(self, song):
         """Extract relevant features from a song"""
-        features = song.get_features()
-        if not features:
-            return None
+        return song.get_vector()
+    
+    @metrics.timed('train')
+    def train(self, user_id=None, reload=False):
+        """Train the recommendation model"""
+        # One fit at a time; readers keep using the active snapshot meanwhile
+        with self._train_lock:
+            # The feature store is loaded once and then kept in sync by the Song
+            # listeners; a full reload is only needed on cold start or for repair
+            if reload or not self.store.is_loaded:
+                self.store.load_from_db()
+            # Popularity lists only follow this process's commits; a reload also catches other writers
+            if reload:
+                popularity_index.load_from_db()
+            
+            song_features, song_ids, seq = self.store.snapshot()
+            
+            if not len(song_features):
+                logger.warning("No song features available for training")
+                return False
+            
+            # Train the model
+            model = create_index(self.index_backend, **self.index_params)
+            model.fit(song_features)
+            # Changes committed while fitting are not in this model: keep counting them
+            self.store.mark_fitted(seq)
+            snapshot = ModelSnapshot(next(self._versions), model, song_features, song_ids)
+            logger.info(f"Model trained with {len(song_features)} songs")
+            
+            # Share the new catalog with the other worker processes
+            if self.catalog_dir:
+                self.export_catalog(snapshot=snapshot)
+            self.activate(snapshot)
+            
+            # Persist the fit so the next process start can skip it
+            if self.artifact_dir:
+                try:
+                    save_artifact(self.artifact_dir, model, song_features, song_ids,
+                                  self.index_backend, self.index_params, keep=self.artifact_keep)
+                except Exception as e:
+                    logger.error(f"Error saving model artifact: {e}")
         
-        # Extract relevant audio features
-        relevant_features = [
-            features.get('danceability', 0),
-            features.get('energy', 0),
-            features.get('key', 0) / 11.0,  # Normalize key
-            features.get('loudness', 0) / -60.0,  # Normalize loudness
-            features.get('mode', 0),
-            features.get('speechiness', 0),
-            features.get('acousticness', 0),
-            features.get('instrumentalness', 0),
-            features.get('liveness', 0),
-            features.get('valence', 0),
-            features.get('tempo', 0) / 250.0,  # Normalize tempo
-        ]
+        # If user_id is provided, generate recommendations for that user
+        if user_id:
+            self.generate_recommendations(user_id)
         
-        return relevant_features
+        return True
     
-    def train(self, user_id=None):
-        """Train the recommendation model"""
-        # Get all songs with features
-        songs = Song.query.all()
+    def train_async(self, reload=False):
+        """Fit a new snapshot on a background thread; returns False if a fit is already running"""
+        with self._swap_lock:
+            if self._training_thread is not None and self._training_thread.is_alive():
+                return False
+            self.training = {'state': 'training', 'started_at': time.time(), 'finished_at': None, 'error': None}
+            self._training_thread = threading.Thread(target=self._train_in_background, args=(reload,),
+                                                     name='model-training', daemon=True)
+            self._training_thread.start()
+        return True
+    
+    def _train_in_background(self, reload):
+        try:
+            with self.app.app_context():
+                trained = self.train(reload=reload)
+            state, error = ('ready', None) if trained else ('failed', 'No song features available for training')
+        except Exception as e:
+            logger.error(f"Background training failed: {e}")
+            state, error = 'failed', str(e)
+        self.training = dict(self.training, state=state, finished_at=time.time(), error=error)
+    
+    def wait_for_training(self, timeout=None):
+        thread = self._training_thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.training['state']
+    
+    def load_latest_artifact(self):
+        """Activate the newest saved model fitted on the current catalog; returns False if there is none"""
+        if not self.artifact_dir:
+            return False
         
-        self.song_features = []
-        self.song_ids = []
+        with self._train_lock:
+            if not self.store.is_loaded:
+                self.store.load_from_db()
+            song_features, song_ids, seq = self.store.snapshot()
+            if not len(song_ids):
+                return False
+            
+            manifest = find_compatible_artifact(self.artifact_dir, catalog_checksum(song_features, song_ids),
+                                                self.index_backend, self.index_params)
+            if manifest is None:
+                logger.info("No model artifact matches the current catalog")
+                return False
+            
+            try:
+                _, model, song_features, song_ids = load_artifact(manifest['path'])
+            except Exception as e:
+                # Checksum mismatches land here too, so a damaged artifact is refitted rather than used
+                logger.error(f"Error loading model artifact {manifest['name']}: {e}")
+                return False
+            
+            self.store.mark_fitted(seq)
+            self.activate(ModelSnapshot(next(self._versions), model, song_features, song_ids, source='artifact'))
+        logger.info(f"Loaded model artifact {manifest['name']}")
+        return True
+    
+    def warm_start(self):
+        """At process start: reuse a saved model for the current catalog, or fit one in the background"""
+        if not self.artifact_dir or self.is_trained:
+            return False
+        if self.load_latest_artifact():
+            return True
+        if self.app is not None:
+            self.train_async()
+        return False
+    
+    def refit_if_drifted(self):
+        """Refit the index once enough of the catalog has changed since the last fit"""
+        drift = self.store.drift()
+        if drift <= self.refit_threshold:
+            return False
         
-        for song in songs:
-            features = self.extract_features(song)
-            if features:
-                self.song_features.append(features)
-                self.song_ids.append(song.id)
+        logger.info(f"Catalog drift {drift:.3f} exceeds {self.refit_threshold}, refitting model")
+        # Requests keep the current snapshot while the new one is built
+        if self.app is not None:
+            return self.train_async()
+        return self.train()
+    
+    def export_catalog(self, directory=None, snapshot=None):
+        """Write a snapshot's feature matrix and song ids as a new shared catalog version"""
+        snapshot = snapshot or self._snapshot
+        self.catalog_version = write_catalog(directory or self.catalog_dir, snapshot.song_features, snapshot.song_ids)
+        snapshot.catalog_version = self.catalog_version
+        return self.catalog_version
+    
+    def attach_catalog(self, catalog):
+        """Serve from a memory-mapped catalog instead of a private copy of the features"""
+        # A ball tree would build a private float64 copy of the mapped matrix;
+        # brute force is just as exact and keeps referencing the shared pages
+        if self.index_backend == BallTreeIndex.name:
+            model = BruteForceIndex()
+        else:
+            model = create_index(self.index_backend, **self.index_params)
+        model.fit(catalog.features)
         
-        if not self.song_features:
-            logger.warning("No song features available for training")
+        self.catalog_version = catalog.version
+        self.activate(ModelSnapshot(next(self._versions), model, catalog.features, catalog.ids,
+                                    source='catalog', catalog_version=catalog.version))
+        logger.info(f"Attached catalog version {catalog.version} with {len(catalog)} songs")
+    
+    def check_for_new_catalog(self, force=False):
+        """Swap to a newer published catalog version, polling at most every few seconds"""
+        now = time.monotonic()
+        if not force and now - self._catalog_checked_at < self.catalog_poll_seconds:
             return False
+        self._catalog_checked_at = now
         
-        # Train the model
-        self.model.fit(self.song_features)
-        self.is_trained = True
-        logger.info(f"Model trained with {len(self.song_features)} songs")
+        if read_current_version(self.catalog_dir) <= self.catalog_version:
+            return False
         
-        # If user_id is provided, generate recommendations for that user
-        if user_id:
-            self.generate_recommendations(user_id)
+        try:
+            catalog = open_current_catalog(self.catalog_dir)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error opening shared catalog: {e}")
+            return False
         
+        self.attach_catalog(catalog)
+        # The catalog was published after changes this process may not have seen: reload the lists on next use
+        popularity_index.clear()
         return True
     
+    def song_vector(self, song_id):
+        """Feature vector of a single song, from the feature store when it is loaded"""
+        if self.store.is_loaded:
+            return self.store.vector(song_id)
+        
+        song = Song.query.get(song_id)
+        return self.extract_features(song) if song else None
+    
+    def rebuild_user_profile(self, user_id):
+        """Recompute a user's profile from scratch (repair path)"""
+        # One joined query for all liked songs that have features
+        liked = (db.session.query(Song.id, Song.feature_vector)
+                 .join(UserPreference, UserPreference.song_id == Song.id)
+                 .filter(UserPreference.user_id == user_id,
+                         UserPreference.rating.is_(True),
+                         Song.feature_vector.isnot(None))
+                 .all())
+        
+        if self.store.is_loaded:
+            rows = [self.store.row_of(song_id) for song_id, _ in liked]
+            vectors = self.store.matrix[[row for row in rows if row is not None]]
+        else:
+            vectors = unpack_vectors(blob for _, blob in liked)
+        
+        profile = UserProfile.query.get(user_id)
+        if profile is None:
+            profile = UserProfile(user_id=user_id)
+            db.session.add(profile)
+        profile.set_sum(vectors.sum(axis=0, dtype=np.float64))
+        profile.like_count = len(vectors)
+        
+        logger.info(f"Rebuilt profile for user {user_id} from {len(vectors)} liked songs")
+        return profile
+    
+    def update_user_profile(self, user_id, song_id, old_rating, new_rating):
+        """Apply a like, unlike or flip to the user's running profile in O(d)"""
+        delta = int(bool(new_rating)) - int(bool(old_rating))
+        if not delta:
+            return
+        
+        profile = UserProfile.query.get(user_id)
+        if profile is None:
+            # First profile for this user: the rebuild already sees the new rating
+            self.rebuild_user_profile(user_id)
+            return
+        
+        vector = self.song_vector(song_id)
+        if vector is None:
+            return
+        
+        profile.set_sum(profile.get_sum(len(vector)) + delta * vector)
+        profile.like_count = max(profile.like_count + delta, 0)
+    
+    def locate_song_ids(self, song_ids):
+        """Which songs are in the active model, and their rows"""
+        return self._snapshot.locate_song_ids(song_ids)
+    
+    def rows_for_song_ids(self, song_ids):
+        """Rows of the active model holding the given songs (unknown ids are dropped)"""
+        return self._snapshot.rows_for_song_ids(song_ids)
+    
+    def filter_mask(self, filters, snapshot=None):
+        """Rows of the snapshot passing ``filters`` (built with ``make_filters``), from its bitset indexes"""
+        snapshot = snapshot or self._snapshot
+        indexed, index = self._filter_index
+        if indexed is not snapshot:
+            index = CatalogFilterIndex.build(snapshot)
+            self._filter_index = (snapshot, index)
+        return index.mask(filters)
+    
+    def _record_search(self, rounds, found, wanted):
+        with self._stats_lock:
+            stats = self.search_stats
+            stats['searches'] += 1
+            stats['rounds'] += rounds
+            stats['max_rounds'] = max(stats['max_rounds'], rounds)
+            stats['widened'] += rounds > 1
+            stats['short'] += found < wanted
+        metrics.observe_search(rounds, found < wanted)
+    
+    @metrics.timed('profile')
     def get_user_profile(self, user_id):
         """Create a user profile based on liked songs"""
-        # Get user's liked songs
-        preferences = UserPreference.query.filter_by(user_id=user_id, rating=True).all()
-        
-        if not preferences:
-            logger.info(f"User {user_id} has no liked songs")
-            return None
+        profile = UserProfile.query.get(user_id)
+        if profile is None:
+            profile = self.rebuild_user_profile(user_id)
+            db.session.commit()
         
-        # Extract features from liked songs
-        liked_features = []
-        for pref in preferences:
-            song = Song.query.get(pref.song_id)
-            if song:
-                features = self.extract_features(song)
-                if features:
-                    liked_features.append(features)
-        
-        if not liked_features:
-            logger.info(f"No features available for user {user_id}'s liked songs")
+        if not profile.like_count:
+            logger.info(f"User {user_id} has no liked songs with features")
             return None
         
-        # Create user profile by averaging features
-        user_profile = np.mean(liked_features, axis=0)
-        logger.info(f"Created user profile for user {user_id} based on {len(liked_features)} songs")
+        # User profile is the average of the liked songs' features
+        user_profile = profile.get_sum(FEATURE_DIM) / profile.like_count
+        logger.info(f"Loaded user profile for user {user_id} based on {profile.like_count} songs")
         return user_profile
     
-    def generate_recommendations(self, user_id, n_recommendations=10):
-        """Generate recommendations for a user"""
+    def generate_recommendations(self, user_id, n_recommendations=10, filters=None):
+        """Generate recommendations for a user, optionally limited by genre, artist or popularity filters"""
+        if self.catalog_dir:
+            self.check_for_new_catalog()
+        
         if not self.is_trained:
             success = self.train()
             if not success:
                 logger.warning("Failed to train model for recommendations")
                 return False
+        else:
+            self.refit_if_drifted()
         
         # Get user profile
         user_profile = self.get_user_profile(user_id)
@@ -197,77 +614,159 @@ class RecommendationEngine:
         # If user has no profile, use popularity-based recommendations
         if user_profile is None:
             logger.info(f"Using popularity-based recommendations for user {user_id}")
-            return self.popularity_recommendations(user_id, n_recommendations)
-        
-        # Find nearest neighbors to user profile
-        distances, indices = self.model.kneighbors([user_profile], n_neighbors=n_recommendations*2)
+            return self.popularity_recommendations(user_id, n_recommendations, filters)
         
-        # Get recommended song IDs
-        recommended_song_ids = [self.song_ids[idx] for idx in indices[0]]
+        # Use one snapshot for the whole request, even if a new model is activated meanwhile
+        snapshot = self._snapshot
         
-        # Filter out songs the user has already rated
+        # Exclude songs the user has already rated and songs removed since the last fit
         user_rated_songs = UserPreference.query.filter_by(user_id=user_id).with_entities(UserPreference.song_id).all()
-        user_rated_song_ids = [song.song_id for song in user_rated_songs]
-        
-        recommended_song_ids = [song_id for song_id in recommended_song_ids if song_id not in user_rated_song_ids]
-        
-        # Limit to requested number
-        recommended_song_ids = recommended_song_ids[:n_recommendations]
+        excluded = [song.song_id for song in user_rated_songs]
+        if self.store.is_loaded:
+            excluded.extend(self.store.deleted_since_fit)
+        exclude_mask = snapshot.exclusion_mask(excluded)
+        if filters:
+            exclude_mask |= ~self.filter_mask(filters, snapshot)
+        
+        # Find the nearest unrated neighbors to the user profile
+        with metrics.time_stage('knn'):
+            allowed_rows = np.flatnonzero(~exclude_mask) if filters else None
+            if allowed_rows is not None and len(allowed_rows) <= self.filter_scan_fraction * len(snapshot):
+                # Narrow filter: scanning the allowed rows beats widening an index search around them
+                distances, indices = snapshot.nearest_in_rows(user_profile, allowed_rows, n_recommendations)
+                rounds = 1
+            else:
+                distances, indices, rounds = snapshot.model.kneighbors_excluding(user_profile, n_recommendations,
+                                                                                 exclude_mask)
+        self._record_search(rounds, len(indices), n_recommendations)
+        if rounds > 1:
+            logger.info(f"kNN search for user {user_id} needed {rounds} rounds")
+        
+        recommended_song_ids = [int(snapshot.song_ids[idx]) for idx in indices]
         
         # Store recommendations in database
-        self.store_recommendations(user_id, recommended_song_ids, distances[0])
+        self.store_recommendations(user_id, recommended_song_ids, distances)
         
         logger.info(f"Generated {len(recommended_song_ids)} recommendations for user {user_id}")
         return True
     
-    def popularity_recommendations(self, user_id, n_recommendations=10):
+    def popularity_recommendations(self, user_id, n_recommendations=10, filters=None):
         """Generate recommendations based on popularity for new users"""
-        # Get popular songs
-        popular_songs = Song.query.order_by(Song.popularity.desc()).limit(n_recommendations*2).all()
-        
-        # Filter out songs the user has already rated
+        # Songs the user has already rated are skipped
         user_rated_songs = UserPreference.query.filter_by(user_id=user_id).with_entities(UserPreference.song_id).all()
-        user_rated_song_ids = [song.song_id for song in user_rated_songs]
-        
-        recommended_song_ids = []
-        for song in popular_songs:
-            if song.id not in user_rated_song_ids:
-                recommended_song_ids.append(song.id)
-                if len(recommended_song_ids) >= n_recommendations:
-                    break
+        user_rated_song_ids = {song.song_id for song in user_rated_songs}
+        
+        if filters:
+            # Filtered requests are rare; the (genre, popularity) index keeps this query bounded
+            popular = (Song.query.with_entities(Song.id)
+                       .filter(*filter_conditions(filters))
+                       .order_by(Song.popularity.desc())
+                       .limit(n_recommendations + len(user_rated_song_ids)).all())
+            recommended_song_ids = [song_id for (song_id,) in popular
+                                    if song_id not in user_rated_song_ids][:n_recommendations]
+            self.store_recommendations(user_id, recommended_song_ids)
+            logger.info(f"Generated {len(recommended_song_ids)} filtered popularity-based recommendations "
+                        f"for user {user_id}")
+            return True
+        
+        # Genres of the songs the user liked come first, most liked genre first
+        liked_genres = [genre for genre, _ in (
+            db.session.query(Song.genre, func.count())
+            .join(UserPreference, UserPreference.song_id == Song.id)
+            .filter(UserPreference.user_id == user_id,
+                    UserPreference.rating.is_(True),
+                    Song.genre.isnot(None))
+            .group_by(Song.genre)
+            .order_by(func.count().desc())
+            .all())]
+        
+        # Precomputed top-K lists, no sort over the songs table
+        recommended_song_ids = popularity_index.top(n_recommendations, exclude=user_rated_song_ids,
+                                                    genres=liked_genres)
+        
+        # A user who rated most of the top-K (or songs without popularity) falls back to the table
+        if len(recommended_song_ids) < n_recommendations:
+            taken = user_rated_song_ids | set(recommended_song_ids)
+            extra = (Song.query.with_entities(Song.id)
+                     .filter(Song.id.notin_(taken))
+                     .order_by(Song.popularity.desc())
+                     .limit(n_recommendations - len(recommended_song_ids)).all())
+            recommended_song_ids.extend(song_id for (song_id,) in extra)
         
         # Store recommendations in database
         self.store_recommendations(user_id, recommended_song_ids)
         
-        logger.info(f"Generated {len(recommended_song_ids)} popularity-based recommendations for user {user_id}")
+        logger.info(f"Generated {len(recommended_song_ids)} popularity-based recommendations for user {user_id} "
+                    f"(popularity lists v{popularity_index.version})")
         return True
     
     def store_recommendations(self, user_id, song_ids, distances=None):
         """Store recommendations in the database"""
-        # Clear existing unshown recommendations
-        Recommendation.query.filter_by(user_id=user_id, is_shown=False).delete()
+        # Calculate scores (inverse of distance, or decreasing by rank for popularity-based)
+        scored = [
+            (song_id, 1.0 / (1.0 + distances[i]) if distances is not None else 1.0 - (i * 0.05))
+            for i, song_id in enumerate(song_ids)
+        ]
         
-        # Add new recommendations
-        for i, song_id in enumerate(song_ids):
-            # Calculate score (inverse of distance, or 1.0 for popularity-based)
-            score = 1.0 / (1.0 + distances[i]) if distances is not None else 1.0 - (i * 0.05)
-            
-            recommendation = Recommendation(
-                user_id=user_id,
-                song_id=song_id,
-                recommendation_score=float(score),
-                is_shown=False
-            )
-            db.session.add(recommendation)
+        # Replace existing unshown recommendations
+        self.bulk_store_recommendations({user_id: scored})
+        logger.info(f"Stored {len(song_ids)} recommendations for user {user_id}")
         
+        # Have the next read served from memory
+        serving_cache.load(user_id)
+    
+    @metrics.timed('store')
+    def bulk_store_recommendations(self, recommendations, replace=True, chunk_size=500):
+        """Write pending recommendations for one or many users in a few statements.
+        
+        ``recommendations`` maps user ids to ``(song_id, score)`` lists. With
+        ``replace`` the users' unshown recommendations are deleted first;
+        otherwise songs already pending for a user are skipped. Returns the
+        number of rows inserted.
+        """
+        user_ids = list(recommendations)
+        pending = set()
+        
+        # Recommendations already served must be marked shown before unshown ones are replaced
+        serving_cache.flush(commit=False)
+        
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            unshown = (Recommendation.user_id.in_(chunk), Recommendation.is_shown.is_(False))
+            if replace:
+                db.session.execute(delete(Recommendation).where(*unshown))
+            else:
+                pending.update((user_id, song_id) for user_id, song_id in
+                               db.session.query(Recommendation.user_id, Recommendation.song_id).filter(*unshown))
+        
+        now = datetime.utcnow()
+        rows = []
+        for user_id, scored in recommendations.items():
+            for song_id, score in scored:
+                if (user_id, song_id) in pending:
+                    continue
+                pending.add((user_id, song_id))
+                rows.append({
+                    'user_id': user_id,
+                    'song_id': int(song_id),
+                    'recommendation_score': float(score),
+                    'is_shown': False,
+                    'timestamp': now,
+                })
+        
+        # A single executemany batch for all rows
+        if rows:
+            db.session.execute(insert(Recommendation), rows)
         db.session.commit()
-        logger.info(f"Stored {len(song_ids)} recommendations for user {user_id}")
+        serving_cache.invalidate(user_ids)
+        return len(rows)
     
     def process_feedback(self, user_id, song_id, rating):
-        """Process user feedback and update recommendations"""
-        # Check if we have enough feedback to generate new recommendations
-        feedback_count = UserPreference.query.filter_by(user_id=user_id).count()
+        """Store user feedback and update the user's profile.
         
+        Regenerating recommendations is left to the caller (see
+        ``regeneration_scheduler``) so feedback returns right after the write.
+        """
         # Store the feedback
         existing_pref = UserPreference.query.filter_by(
             user_id=user_id,
@@ -276,7 +775,9 @@ class RecommendationEngine:
         
         if existing_pref:
             # Update existing preference
+            old_rating = existing_pref.rating
             existing_pref.rating = rating
+            self.update_user_profile(user_id, song_id, old_rating, rating)
             db.session.commit()
             logger.info(f"Updated feedback for user {user_id}, song {song_id}, rating {rating}")
         else:
@@ -287,28 +788,19 @@ class RecommendationEngine:
                 rating=rating
             )
             db.session.add(new_pref)
+            self.update_user_profile(user_id, song_id, None, rating)
             db.session.commit()
             logger.info(f"Added new feedback for user {user_id}, song {song_id}, rating {rating}")
         
-        # Generate new recommendations if we have enough feedback
-        if feedback_count >= 5:  # Arbitrary threshold
-            self.generate_recommendations(user_id)
-        
         return True
     
     def fetch_and_store_spotify_recommendations(self, user_id, access_token):
         """Fetch recommendations from Spotify API and store them"""
         # Get user's top liked songs as seed tracks
-        top_preferences = UserPreference.query.filter_by(
-            user_id=user_id, 
-            rating=True
-        ).order_by(UserPreference.timestamp.desc()).limit(5).all()
-        
-        seed_tracks = []
-        for pref in top_preferences:
-            song = Song.query.get(pref.song_id)
-            if song:
-                seed_tracks.append(song.spotify_id)
+        seed_tracks = [spotify_id for (spotify_id,) in db.session.query(Song.spotify_id)
+                       .join(UserPreference, UserPreference.song_id == Song.id)
+                       .filter(UserPreference.user_id == user_id, UserPreference.rating.is_(True))
+                       .order_by(UserPreference.timestamp.desc()).limit(5)]
         
         # If user has no liked songs, use popularity-based recommendations
         if not seed_tracks:
@@ -325,14 +817,15 @@ class RecommendationEngine:
             logger.error("Failed to get recommendations from Spotify")
             return False
         
-        # Process and store recommendations
-        for track in spotify_recommendations['tracks']:
-            # Check if song exists in our database
-            song = Song.query.filter_by(spotify_id=track['id']).first()
-            
-            # If not, create it
-            if not song:
-                song = Song(
+        # Look up all recommended tracks that are already in our database at once
+        tracks = spotify_recommendations['tracks']
+        songs = {song.spotify_id: song for song in
+                 Song.query.filter(Song.spotify_id.in_([track['id'] for track in tracks]))}
+        
+        # Create the missing songs
+        for track in tracks:
+            if track['id'] not in songs:
+                songs[track['id']] = Song(
                     spotify_id=track['id'],
                     title=track['name'],
                     artist=track['artists'][0]['name'],
@@ -340,34 +833,69 @@ class RecommendationEngine:
                     popularity=track['popularity'],
                     preview_url=track['preview_url']
                 )
-                db.session.add(song)
-                db.session.commit()
-                
-                # Get audio features for the song
-                features = SpotifyClient.get_audio_features(access_token, track['id'])
-                if features:
-                    song.set_features(features)
-                    db.session.commit()
-            
-            # Create recommendation
-            existing_rec = Recommendation.query.filter_by(
-                user_id=user_id,
-                song_id=song.id,
-                is_shown=False
-            ).first()
-            
-            if not existing_rec:
-                recommendation = Recommendation(
-                    user_id=user_id,
-                    song_id=song.id,
-                    recommendation_score=0.9,  # High score for Spotify recommendations
-                    is_shown=False
-                )
-                db.session.add(recommendation)
+                db.session.add(songs[track['id']])
         
-        db.session.commit()
+        # Get audio features for every song lacking them in one batched call
+        missing = [spotify_id for spotify_id, song in songs.items() if song.feature_vector is None]
+        for spotify_id, features in SpotifyClient.get_audio_features_batch(access_token, missing).items():
+            if spotify_id in songs:
+                songs[spotify_id].set_features(features)
+        db.session.flush()
+        
+        # High score for Spotify recommendations
+        recommended = [(songs[track['id']].id, 0.9) for track in tracks]
+        
+        # Add the songs that are not already pending for the user
+        self.bulk_store_recommendations({user_id: recommended}, replace=False)
         logger.info(f"Stored Spotify recommendations for user {user_id}")
         return True
 
 # Create a singleton instance
 recommendation_engine = RecommendationEngine()
+
+
+@event.listens_for(Session, 'before_flush')
+def _song_vectors_changing(session, flush_context, instances):
+    """Move a song's old vector to its new one in the running profiles of the users who like it.
+
+    Profiles hold the sum of the liked songs' vectors as they were when the
+    likes were applied, so features arriving after a like (enrichment,
+    imports) or changing later would otherwise never reach them, and a later
+    unlike would subtract a vector the sum never held.
+    """
+    changed = [song for song in session.dirty
+               if isinstance(song, Song) and inspect(song).attrs.feature_vector.history.has_changes()]
+    if not changed:
+        return
+    
+    with session.no_autoflush:
+        # Not flushed yet, so the table still holds the vectors the profiles were built from
+        old_vectors = dict(session.execute(select(Song.id, Song.feature_vector)
+                                           .where(Song.id.in_([song.id for song in changed]))).all())
+        preferences = session.query(UserPreference).filter(UserPreference.song_id.in_(list(old_vectors))).all()
+        preferences += [obj for obj in session.new if isinstance(obj, UserPreference) and obj.song_id in old_vectors]
+        likers = {}
+        for pref in preferences:
+            if pref.rating and pref not in session.deleted:
+                likers.setdefault(pref.song_id, set()).add(pref.user_id)
+        if not likers:
+            return
+        
+        user_ids = set().union(*likers.values())
+        profiles = {obj.user_id: obj for obj in session.new if isinstance(obj, UserProfile)}
+        profiles.update((profile.user_id, profile) for profile in
+                        UserProfile.query.filter(UserProfile.user_id.in_(user_ids - set(profiles))))
+    
+    for song in changed:
+        old, new = unpack_vector(old_vectors.get(song.id)), unpack_vector(song.feature_vector)
+        if old is None and new is None:
+            continue
+        delta = (np.zeros(FEATURE_DIM) if new is None else new.astype(np.float64)) - \
+            (0 if old is None else old.astype(np.float64))
+        count_delta = (new is not None) - (old is not None)
+        for user_id in likers.get(song.id, ()):
+            profile = profiles.get(user_id)
+            # Users without a profile yet get one rebuilt from the table on first use
+            if profile is not None:
+                profile.set_sum(profile.get_sum(FEATURE_DIM) + delta)
+                profile.like_count = max(profile.like_count + count_delta, 0)
@@ -0,0 +1,165 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from src.models.recommendation import recommendation_engine
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ('future', 'first_requested', 'due')
+
+    def __init__(self, now):
+        self.future = Future()
+        self.first_requested = now
+        self.due = now
+
+
+class RegenerationScheduler:
+    """Debounced, coalesced per-user recommendation regeneration.
+
+    ``schedule`` queues a regeneration due ``debounce`` seconds after the
+    user's latest request; further requests inside the window push it back
+    (up to ``max_delay`` after the first) and share its future, so a burst
+    of feedback costs one kNN pass. A user is never regenerated twice at
+    once: requests arriving while a run is in flight queue one follow-up
+    run, and ``run`` callers with nothing newer queued share the in-flight
+    future.
+    """
+
+    def __init__(self, generate, debounce=2.0, max_delay=10.0, workers=2):
+        self.generate = generate
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.workers = workers
+        self.worker_enabled = True
+        self.app = None
+        self._pending = {}  # user id -> _Job not started yet
+        self._running = {}  # user id -> Future of the in-flight run
+        self._heap = []  # (due, user id); stale entries are skipped
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self.requested = self.coalesced = self.runs = self.failures = 0
+
+    def init_app(self, app):
+        """Read debounce window and worker count from the Flask config"""
+        self.app = app
+        self.debounce = app.config.get('REGENERATION_DEBOUNCE', self.debounce)
+        self.max_delay = app.config.get('REGENERATION_MAX_DELAY', self.max_delay)
+        self.workers = app.config.get('REGENERATION_WORKERS', self.workers)
+
+    def stats(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'running': len(self._running), 'requested': self.requested,
+                    'coalesced': self.coalesced, 'runs': self.runs, 'failures': self.failures}
+
+    def schedule(self, user_id):
+        """Queue a debounced regeneration for the user; returns its future"""
+        with self._cond:
+            now = time.monotonic()
+            job = self._pending.get(user_id)
+            self.requested += 1
+            if job is None:
+                job = self._pending[user_id] = _Job(now)
+            else:
+                self.coalesced += 1
+            job.due = min(now + self.debounce, job.first_requested + self.max_delay)
+            heapq.heappush(self._heap, (job.due, user_id))
+            self._cond.notify()
+        self._ensure_dispatcher()
+        return job.future
+
+    def run(self, user_id):
+        """Regenerate as soon as possible, sharing any in-flight or queued run; returns its future"""
+        with self._cond:
+            self.requested += 1
+            running = self._running.get(user_id)
+            job = self._pending.get(user_id)
+            if running is not None and job is None:
+                self.coalesced += 1
+                return running
+            if job is None:
+                job = self._pending[user_id] = _Job(time.monotonic())
+            else:
+                self.coalesced += 1
+            job.due = time.monotonic()
+            heapq.heappush(self._heap, (job.due, user_id))
+            self._cond.notify()
+        self._ensure_dispatcher()
+        if not self.worker_enabled:
+            self.drain()
+        return job.future
+
+    def _ensure_dispatcher(self):
+        if not self.worker_enabled:
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='regenerate')
+                self._thread = threading.Thread(target=self._dispatch, name='regeneration', daemon=True)
+                self._thread.start()
+
+    def _next_due(self, block=True):
+        """Pop the next job that is due and whose user has no run in flight"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._heap:
+                    due, user_id = self._heap[0]
+                    job = self._pending.get(user_id)
+                    if job is None or job.due != due or user_id in self._running:
+                        # Superseded, or re-queued when the in-flight run finishes
+                        heapq.heappop(self._heap)
+                        continue
+                    if due > now:
+                        break
+                    heapq.heappop(self._heap)
+                    del self._pending[user_id]
+                    self._running[user_id] = job.future
+                    return user_id, job
+                if not block:
+                    return None
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _dispatch(self):
+        while True:
+            user_id, job = self._next_due()
+            self._executor.submit(self._execute, user_id, job)
+
+    def _execute(self, user_id, job):
+        try:
+            with self.app.app_context():
+                result = self.generate(user_id)
+            job.future.set_result(result)
+        except Exception as e:
+            logger.error(f"Regenerating recommendations for user {user_id} failed: {e}")
+            job.future.set_exception(e)
+        finally:
+            with self._cond:
+                self.runs += 1
+                self.failures += job.future.exception() is not None
+                del self._running[user_id]
+                follow_up = self._pending.get(user_id)
+                if follow_up is not None:
+                    heapq.heappush(self._heap, (follow_up.due, user_id))
+                    self._cond.notify()
+
+    def drain(self):
+        """Run every queued regeneration in the calling thread, ignoring the debounce"""
+        with self._cond:
+            for job in self._pending.values():
+                job.due = 0.0
+            self._heap = [(0.0, user_id) for user_id in self._pending]
+        while True:
+            due = self._next_due(block=False)
+            if due is None:
+                return
+            self._execute(*due)
+
+
+# Create a singleton instance
+regeneration_scheduler = RegenerationScheduler(recommendation_engine.generate_recommendations)
@@ -0,0 +1,185 @@
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from sqlalchemy import update
+
+from src.models.user import db, Song, Recommendation
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationServingCache:
+    """Per-user buffers of ready-to-render recommendations with write-behind "shown" marking.
+
+    A read pops payloads from the user's buffer without touching the
+    database; on a miss the user's unshown recommendations are loaded with
+    one joined query. Served recommendation ids are collected and marked
+    ``is_shown`` in batched UPDATEs by a background thread.
+
+    Buffers are dropped whenever the user's recommendations are regenerated.
+    They are also capped in number (LRU) and age (``ttl``), which bounds how
+    long another worker process can serve recommendations regenerated
+    elsewhere.
+    """
+
+    def __init__(self, buffer_size=50, max_users=10000, ttl=60.0, flush_interval=1.0, flush_batch=500):
+        self.buffer_size = buffer_size
+        self.max_users = max_users
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.worker_enabled = True
+        self.app = None
+        self._buffers = OrderedDict()  # user id -> (filled at, deque of payloads, holds every unshown row)
+        self._shown = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+
+    def init_app(self, app):
+        """Read buffer sizes and flush cadence from the Flask config"""
+        self.app = app
+        self.buffer_size = app.config.get('SERVING_BUFFER_SIZE', self.buffer_size)
+        self.max_users = app.config.get('SERVING_MAX_USERS', self.max_users)
+        self.ttl = app.config.get('SERVING_TTL', self.ttl)
+        self.flush_interval = app.config.get('SERVING_FLUSH_INTERVAL', self.flush_interval)
+        self.flush_batch = app.config.get('SERVING_FLUSH_BATCH', self.flush_batch)
+        self.worker_enabled = app.config.get('SERVING_WRITE_BEHIND', self.worker_enabled)
+        atexit.register(self._flush_at_exit)
+
+    def reset(self):
+        with self._lock:
+            self._buffers.clear()
+            self._shown.clear()
+            self.hits = self.misses = self.flushed = 0
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._buffers), 'hits': self.hits, 'misses': self.misses,
+                    'pending_shown': len(self._shown), 'flushed': self.flushed}
+
+    @staticmethod
+    def payload(rec, song):
+        return {
+            'id': rec.id,
+            'song': {
+                'id': song.id,
+                'spotify_id': song.spotify_id,
+                'title': song.title,
+                'artist': song.artist,
+                'album': song.album,
+                'preview_url': song.preview_url
+            },
+            'score': rec.recommendation_score
+        }
+
+    def invalidate(self, user_ids):
+        """Drop the buffers of users whose recommendations changed"""
+        with self._lock:
+            for user_id in user_ids:
+                self._buffers.pop(user_id, None)
+
+    def load(self, user_id):
+        """Fill a user's buffer from the database with one joined query"""
+        rows = (db.session.query(Recommendation, Song)
+                .join(Song, Song.id == Recommendation.song_id)
+                .filter(Recommendation.user_id == user_id,
+                        Recommendation.is_shown.is_(False))
+                .order_by(Recommendation.recommendation_score.desc())
+                .limit(self.buffer_size).all())
+        with self._lock:
+            # Rows already served but not flushed yet still read as unshown
+            buffer = deque(self.payload(rec, song) for rec, song in rows if rec.id not in self._shown)
+            self._buffers[user_id] = (time.monotonic(), buffer, len(rows) < self.buffer_size)
+            self._buffers.move_to_end(user_id)
+            while len(self._buffers) > self.max_users:
+                self._buffers.popitem(last=False)
+        return buffer
+
+    def pop(self, user_id, n=10):
+        """Take the user's next ``n`` recommendations and queue them to be marked shown"""
+        with self._lock:
+            entry = self._buffers.get(user_id)
+            if entry is not None:
+                filled_at, buffer, complete = entry
+                # Expired, or drained while the database may hold more
+                if time.monotonic() - filled_at > self.ttl or (not buffer and not complete):
+                    entry = None
+            if entry is not None:
+                self.hits += 1
+                self._buffers.move_to_end(user_id)
+            else:
+                self.misses += 1
+
+        if entry is None:
+            self.load(user_id)
+
+        with self._lock:
+            _, buffer, _ = self._buffers.get(user_id, (None, deque(), True))
+            served = [buffer.popleft() for _ in range(min(n, len(buffer)))]
+            self._shown.update(item['id'] for item in served)
+            pending = len(self._shown)
+
+        if served:
+            if self.worker_enabled:
+                self._ensure_worker()
+                if pending >= self.flush_batch:
+                    self._wake.set()
+        return served
+
+    def flush(self, commit=True):
+        """Mark served recommendations shown in batched UPDATEs; returns rows marked"""
+        with self._lock:
+            ids, self._shown = list(self._shown), set()
+        if not ids:
+            return 0
+        try:
+            for start in range(0, len(ids), self.flush_batch):
+                db.session.execute(update(Recommendation)
+                                   .where(Recommendation.id.in_(ids[start:start + self.flush_batch]))
+                                   .values(is_shown=True))
+            if commit:
+                db.session.commit()
+        except Exception:
+            # Keep the ids for the next flush
+            db.session.rollback()
+            with self._lock:
+                self._shown.update(ids)
+            raise
+        with self._lock:
+            self.flushed += len(ids)
+        return len(ids)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='serving-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                logger.error(f"Flushing shown recommendations failed: {e}")
+
+    def _flush_at_exit(self):
+        if self._shown and self.app is not None:
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                logger.error(f"Flushing shown recommendations at exit failed: {e}")
+
+
+# Create a singleton instance
+serving_cache = RecommendationServingCache()
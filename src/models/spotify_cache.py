@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+class ResponseCache:
+    """Disk-backed TTL + LRU cache for Spotify API responses.
+
+    Entries live in a local SQLite file, so they survive restarts and are
+    shared by every worker process on the host. Each endpoint has its own
+    TTL; once the cache holds more than ``max_entries`` rows the least
+    recently used ones are evicted. Hit and miss counters are per process.
+    """
+
+    DEFAULT_TTLS = {
+        'track': 7 * DAY,
+        'audio-features': 30 * DAY,
+        'search': 60 * 60,
+    }
+
+    # Only refresh an entry's LRU timestamp when it is older than this, to
+    # avoid turning every hit into a write
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path=None, max_entries=100000, ttls=None, evict_every=500):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = dict(self.DEFAULT_TTLS, **(ttls or {}))
+        self.evict_every = evict_every
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read the cache location, size and TTLs from the Flask config"""
+        self.path = app.config.get('SPOTIFY_CACHE_PATH', self.path)
+        self.max_entries = app.config.get('SPOTIFY_CACHE_MAX_ENTRIES', self.max_entries)
+        self.ttls.update(app.config.get('SPOTIFY_CACHE_TTLS', {}))
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.path != self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                         'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)')
+            self._local.conn, self._local.path = conn, self.path
+        return conn
+
+    @staticmethod
+    def _key(endpoint, key):
+        return f'{endpoint}:{key}'
+
+    def get(self, endpoint, key):
+        """Cached response for ``key`` or None"""
+        return self.get_many(endpoint, [key]).get(key)
+
+    def get_many(self, endpoint, keys):
+        """``{key: response}`` for the keys that are cached and fresh"""
+        keys = list(dict.fromkeys(keys))
+        if not self.enabled or not keys:
+            with self._lock:
+                self.misses[endpoint] += len(keys)
+            return {}
+
+        now = time.time()
+        conn = self._connection()
+        found = {}
+        stale = []
+        for start in range(0, len(keys), 500):
+            chunk = {self._key(endpoint, key): key for key in keys[start:start + 500]}
+            rows = conn.execute(
+                f"SELECT key, value, expires_at, accessed_at FROM responses "
+                f"WHERE key IN ({','.join('?' * len(chunk))})", list(chunk)).fetchall()
+            for cache_key, value, expires_at, accessed_at in rows:
+                if expires_at <= now:
+                    continue
+                found[chunk[cache_key]] = json.loads(value)
+                if now - accessed_at > self.TOUCH_INTERVAL:
+                    stale.append(cache_key)
+
+        if stale:
+            conn.executemany('UPDATE responses SET accessed_at = ? WHERE key = ?', [(now, k) for k in stale])
+
+        with self._lock:
+            self.hits[endpoint] += len(found)
+            self.misses[endpoint] += len(keys) - len(found)
+        return found
+
+    def set(self, endpoint, key, value):
+        self.set_many(endpoint, {key: value})
+
+    def set_many(self, endpoint, values):
+        """Store ``{key: response}`` with the endpoint's TTL"""
+        if not self.enabled or not values:
+            return
+
+        now = time.time()
+        expires_at = now + self.ttls.get(endpoint, DAY)
+        conn = self._connection()
+        conn.executemany(
+            'INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+            [(self._key(endpoint, key), json.dumps(value), expires_at, now) for key, value in values.items()])
+
+        with self._lock:
+            self._writes += len(values)
+            evict = self._writes >= self.evict_every
+            if evict:
+                self._writes = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones beyond ``max_entries``"""
+        conn = self._connection()
+        conn.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+        (count,) = conn.execute('SELECT COUNT(*) FROM responses').fetchone()
+        if count > self.max_entries:
+            conn.execute('DELETE FROM responses WHERE key IN '
+                         '(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)', (count - self.max_entries,))
+            logger.info(f"Evicted {count - self.max_entries} Spotify cache entries")
+
+    def clear(self):
+        if self.enabled:
+            self._connection().execute('DELETE FROM responses')
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        entries = self._connection().execute('SELECT COUNT(*) FROM responses').fetchone()[0] if self.enabled else 0
+        endpoints = sorted(set(self.hits) | set(self.misses))
+        return {
+            'entries': entries,
+            'endpoints': {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in endpoints},
+        }
+
+
+# Create a singleton instance
+spotify_cache = ResponseCache()
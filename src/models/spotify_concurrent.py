@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.models.user import db, Song
+from src.models.recommendation import SpotifyClient
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Thread-safe token bucket: at most ``rate`` acquisitions per second on average"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class ConcurrentSpotifyFetcher:
+    """Runs many Spotify requests at once under a concurrency and rate cap.
+
+    Work is submitted to a shared bounded thread pool (Spotify calls are I/O
+    bound, and the pooled HTTP session is thread-safe). Results are yielded
+    as each request completes, with only a bounded number of requests in
+    flight, so callers can write to the database while fetches continue.
+    """
+
+    def __init__(self, max_workers=8, rate_per_second=20.0):
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate_per_second)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read concurrency and rate settings from the Flask config"""
+        self.max_workers = app.config.get('SPOTIFY_FETCH_CONCURRENCY', self.max_workers)
+        self.limiter = RateLimiter(app.config.get('SPOTIFY_FETCH_RATE', self.limiter.rate))
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='spotify-fetch')
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _call(self, fn, item):
+        self.limiter.acquire()
+        return fn(item)
+
+    def imap_unordered(self, fn, items):
+        """Yield ``(item, fn(item))`` pairs in completion order"""
+        in_flight = {}
+        max_in_flight = 2 * self.max_workers
+
+        def drain(return_when):
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+
+        for item in items:
+            if len(in_flight) >= max_in_flight:
+                yield from drain(FIRST_COMPLETED)
+            in_flight[self.executor.submit(self._call, fn, item)] = item
+        while in_flight:
+            yield from drain(FIRST_COMPLETED)
+
+    def fetch_audio_features(self, access_token, track_ids, failed=None):
+        """Stream ``{track_id: features}`` dicts, one per 100-id request, as they complete.
+
+        Ids of requests that failed are added to ``failed`` when given.
+        """
+        def fetch(chunk):
+            chunk_failed = []
+            return SpotifyClient.get_audio_features_batch(access_token, chunk, chunk_failed), chunk_failed
+
+        chunks = SpotifyClient.chunk_ids(track_ids, SpotifyClient.AUDIO_FEATURES_BATCH_SIZE)
+        for _, (features, chunk_failed) in self.imap_unordered(fetch, chunks):
+            if failed is not None:
+                failed.extend(chunk_failed)
+            yield features
+
+    def fetch_tracks(self, access_token, track_ids):
+        """Stream ``{track_id: track}`` dicts, one per 50-id request, as they complete"""
+        chunks = SpotifyClient.chunk_ids(track_ids, SpotifyClient.TRACKS_BATCH_SIZE)
+        fetch = lambda chunk: SpotifyClient.get_tracks_batch(access_token, chunk)
+        for _, tracks in self.imap_unordered(fetch, chunks):
+            yield tracks
+
+
+# Create a singleton instance
+spotify_fetcher = ConcurrentSpotifyFetcher()
+
+
+def enrich_songs(access_token, spotify_ids, fetcher=spotify_fetcher, failed=None):
+    """Fetch audio features concurrently and store each batch as soon as it arrives.
+
+    Ids whose request failed (rather than being answered without features)
+    are added to ``failed`` when given, so callers can retry them.
+    """
+    enriched = 0
+    for features in fetcher.fetch_audio_features(access_token, spotify_ids, failed):
+        if not features:
+            continue
+        for song in Song.query.filter(Song.spotify_id.in_(list(features))):
+            song.set_features(features[song.spotify_id])
+            song.features_status = None
+            enriched += 1
+        db.session.commit()
+    logger.info(f"Enriched {enriched} of {len(spotify_ids)} songs with audio features")
+    return enriched
@@ -0,0 +1,110 @@
+import email.utils
+import logging
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.models.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SpotifyHTTP:
+    """Shared HTTP session for all Spotify calls.
+
+    One ``requests.Session`` keeps pooled keep-alive connections, so calls
+    reuse TCP/TLS connections instead of handshaking every time. The urllib3
+    pool behind it is thread-safe and the session holds no per-call state
+    (no cookies or auth are set on it), so it can be shared across threads.
+
+    Responses with status 429 are retried for every method, honouring
+    ``Retry-After``; 5xx responses and connection errors are retried only for
+    idempotent methods. Waits use exponential backoff with full jitter.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    def __init__(self, pool_size=20, max_retries=3, backoff=0.5, max_backoff=30.0, timeout=(3.05, 10.0)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = None
+        self._configure_session(pool_size)
+
+    def init_app(self, app):
+        """Read pool, retry and timeout settings from the Flask config"""
+        self.max_retries = app.config.get('SPOTIFY_HTTP_MAX_RETRIES', self.max_retries)
+        self.backoff = app.config.get('SPOTIFY_HTTP_BACKOFF', self.backoff)
+        self.max_backoff = app.config.get('SPOTIFY_HTTP_MAX_BACKOFF', self.max_backoff)
+        self.timeout = app.config.get('SPOTIFY_HTTP_TIMEOUT', self.timeout)
+        self._configure_session(app.config.get('SPOTIFY_HTTP_POOL_SIZE', self.pool_size))
+
+    def _configure_session(self, pool_size):
+        if self.session is not None:
+            self.session.close()
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        # Retries are handled in request() so they can honour Retry-After and jitter
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Send a request with retries; returns the final response or raises the last connection error"""
+        method = method.upper()
+        retry_errors = method in self.IDEMPOTENT_METHODS
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe_spotify(method, url, 'error', time.perf_counter() - started)
+                if last_attempt or not retry_errors:
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning(f"Spotify {method} {url} failed ({e}), retrying in {delay:.2f}s")
+            else:
+                metrics.observe_spotify(method, url, response.status_code, time.perf_counter() - started)
+                retryable = response.status_code == 429 or (retry_errors and response.status_code >= 500)
+                if last_attempt or response.status_code not in self.RETRY_STATUSES or not retryable:
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                logger.warning(f"Spotify {method} {url} returned {response.status_code}, "
+                               f"retrying in {delay:.2f}s")
+                response.close()
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _retry_after(self, response):
+        """Seconds requested by a Retry-After header (delta-seconds or HTTP date), if any"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0.0), self.max_backoff)
+
+
+# Create a singleton instance
+spotify_http = SpotifyHTTP()
@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import numpy as np
 import json
+from src.models.features import normalize_features, pack_vector, unpack_vector
 
 db = SQLAlchemy()
 
@@ -24,6 +26,11 @@ class User(db.Model):
 
 class Song(db.Model):
     __tablename__ = 'songs'
+    # Bounded refills of the in-memory popularity lists read these in order instead of sorting
+    __table_args__ = (
+        db.Index('ix_songs_popularity', 'popularity'),
+        db.Index('ix_songs_genre_popularity', 'genre', 'popularity'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     spotify_id = db.Column(db.String(64), unique=True, nullable=False)
@@ -31,7 +38,10 @@ class Song(db.Model):
     artist = db.Column(db.String(256), nullable=False)
     album = db.Column(db.String(256), nullable=True)
     genre = db.Column(db.String(128), nullable=True)
-    features = db.Column(db.Text, nullable=True)  # JSON string of audio features
+    features = db.Column(db.Text, nullable=True)  # JSON string of raw audio features (metadata only)
+    feature_vector = db.Column(db.LargeBinary, nullable=True)  # normalized float32 vector, packed at ingest
+    features_status = db.Column(db.String(16), nullable=True)  # 'failed' once enrichment gave up
+    enrichment_attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     popularity = db.Column(db.Integer, nullable=True)
     preview_url = db.Column(db.String(512), nullable=True)
     
@@ -46,11 +56,24 @@ class Song(db.Model):
             return json.loads(self.features)
         return {}
     
-    def set_features(self, features_dict):
-        self.features = json.dumps(features_dict)
+    def set_features(self, features_dict, keep_raw=True):
+        # The normalized vector is what the engine reads; the raw JSON is optional metadata
+        self.feature_vector = pack_vector(normalize_features(features_dict))
+        self.features = json.dumps(features_dict) if keep_raw else None
+    
+    def get_vector(self):
+        return unpack_vector(self.feature_vector)
 
 class UserPreference(db.Model):
     __tablename__ = 'user_preferences'
+    # One preference per user and song; also serves lookups by user_id alone.
+    # (user_id, timestamp, id) serves the newest-first keyset pagination of a user's history;
+    # (song_id, rating) finds the users who like a song whose features changed
+    __table_args__ = (
+        db.Index('uq_user_preferences_user_song', 'user_id', 'song_id', unique=True),
+        db.Index('ix_user_preferences_user_time', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_user_preferences_song_rating', 'song_id', 'rating'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -62,8 +85,31 @@ class UserPreference(db.Model):
         rating_str = "like" if self.rating else "dislike"
         return f'<UserPreference {self.user_id} {rating_str} {self.song_id}>'
 
+class UserProfile(db.Model):
+    __tablename__ = 'user_profiles'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    feature_sum = db.Column(db.LargeBinary, nullable=True)  # Packed float64 sum of liked song vectors
+    like_count = db.Column(db.Integer, nullable=False, default=0)  # Liked songs that have features
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UserProfile {self.user_id} likes:{self.like_count}>'
+    
+    def get_sum(self, dim):
+        if self.feature_sum:
+            return np.frombuffer(self.feature_sum, dtype=np.float64).copy()
+        return np.zeros(dim)
+    
+    def set_sum(self, feature_sum):
+        self.feature_sum = np.asarray(feature_sum, dtype=np.float64).tobytes()
+
 class Recommendation(db.Model):
     __tablename__ = 'recommendations'
+    # Serves "unshown recommendations for a user, best first" without a sort
+    __table_args__ = (
+        db.Index('ix_recommendations_user_shown_score', 'user_id', 'is_shown', 'recommendation_score'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -1,6 +1,12 @@
-from flask import Blueprint, request, jsonify, session, redirect, url_for
+from flask import Blueprint, Response, request, jsonify, session, redirect, url_for
 from src.models.user import db, User, Song, UserPreference, Recommendation
 from src.models.recommendation import recommendation_engine, SpotifyClient
+from src.models.enrichment import enrichment_queue
+from src.models.regeneration import regeneration_scheduler
+from src.models.metrics import metrics
+from src.models.catalog_filters import make_filters
+from flask import current_app
+from concurrent.futures import TimeoutError
 import logging
 
 # Set up logging
@@ -9,6 +15,26 @@ logger = logging.getLogger(__name__)
 
 ai_bp = Blueprint('ai', __name__)
 
+def _list_param(data, name):
+    """A filter value from the JSON body (string or list) or the query string (repeated or comma-separated)"""
+    value = data.get(name) if name in data else request.args.getlist(name)
+    if isinstance(value, str):
+        value = [value]
+    return [item.strip() for entry in value or [] for item in str(entry).split(',') if item.strip()]
+
+def request_filters():
+    """Recommendation filters of the current request; raises ValueError on a bad value"""
+    data = request.get_json(silent=True) or {}
+    min_popularity = data.get('min_popularity', request.args.get('min_popularity'))
+    if min_popularity is not None:
+        min_popularity = int(min_popularity)
+        if not 0 <= min_popularity <= 100:
+            raise ValueError('min_popularity must be between 0 and 100')
+    return make_filters(genres=_list_param(data, 'genre'),
+                        artists=_list_param(data, 'artist'),
+                        exclude_artists=_list_param(data, 'exclude_artist'),
+                        min_popularity=min_popularity)
+
 @ai_bp.route('/recommendations/generate', methods=['POST'])
 def generate_recommendations():
     if 'user_id' not in session:
@@ -16,8 +42,23 @@ def generate_recommendations():
     
     user_id = session['user_id']
     
-    # Generate recommendations
-    success = recommendation_engine.generate_recommendations(user_id)
+    try:
+        filters = request_filters()
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid filter: {e}'}), 400
+    
+    if filters:
+        # Filtered runs are specific to this request, so they are not shared with queued runs
+        success = recommendation_engine.generate_recommendations(user_id, filters=filters)
+    else:
+        # Generate recommendations, sharing a run already in flight for this user
+        try:
+            success = regeneration_scheduler.run(user_id).result(
+                timeout=current_app.config.get('REGENERATION_TIMEOUT', 30))
+        except TimeoutError:
+            return jsonify({'message': 'Recommendations are being generated'}), 202
+        except Exception:
+            success = False
     
     if not success:
         return jsonify({'error': 'Failed to generate recommendations'}), 500
@@ -49,12 +90,29 @@ def spotify_recommendations():
 @ai_bp.route('/recommendations/train', methods=['POST'])
 def train_model():
     # This endpoint would typically be admin-only or triggered by a scheduled task
-    success = recommendation_engine.train()
+    # The new model is fitted in the background and swapped in when ready
+    started = recommendation_engine.train_async(reload=request.args.get('reload') == 'true')
     
-    if not success:
-        return jsonify({'error': 'Failed to train model'}), 500
+    status = recommendation_engine.model_status()
+    status['message'] = 'Training started' if started else 'Training already in progress'
+    return jsonify(status), 202
+
+@ai_bp.route('/recommendations/model', methods=['GET'])
+def model_status():
+    # Training state, the active model version and the versions available for rollback
+    return jsonify(recommendation_engine.model_status()), 200
+
+@ai_bp.route('/recommendations/model/rollback', methods=['POST'])
+def rollback_model():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    snapshot = recommendation_engine.rollback()
+    
+    if snapshot is None:
+        return jsonify({'error': 'No previous model version to roll back to'}), 409
     
-    return jsonify({'message': 'Model trained successfully'}), 200
+    return jsonify(recommendation_engine.model_status()), 200
 
 @ai_bp.route('/feedback/process', methods=['POST'])
 def process_feedback():
@@ -80,7 +138,17 @@ def process_feedback():
     if not success:
         return jsonify({'error': 'Failed to process feedback'}), 500
     
-    # Generate new recommendations if needed
-    recommendation_engine.generate_recommendations(user_id)
+    # Regenerate in the background; a burst of feedback is coalesced into one run
+    regeneration_scheduler.schedule(user_id)
     
     return jsonify({'message': 'Feedback processed successfully'}), 200
+
+@ai_bp.route('/enrichment/status', methods=['GET'])
+def enrichment_status():
+    # Queue depth, drain rate and retry/failure counts of the background feature fetcher
+    return jsonify(enrichment_queue.stats()), 200
+
+@ai_bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Request, SQL, Spotify and engine-stage timings of this worker process
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
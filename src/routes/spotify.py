@@ -4,6 +4,10 @@ import base64
 import json
 import os
 from src.models.user import db, User, Song
+from src.models.spotify_http import spotify_http
+from src.models.spotify_cache import spotify_cache
+from src.models.enrichment import enrichment_queue
+from src.models.features import denormalize_features
 from datetime import datetime, timedelta
 
 spotify_bp = Blueprint('spotify', __name__)
@@ -46,7 +50,7 @@ def spotify_callback():
         'redirect_uri': REDIRECT_URI
     }
     
-    response = requests.post('https://accounts.spotify.com/api/token', headers=headers, data=data)
+    response = spotify_http.post('https://accounts.spotify.com/api/token', headers=headers, data=data)
     
     if response.status_code != 200:
         return "Token exchange failed", 400
@@ -81,7 +85,7 @@ def refresh_token():
         'refresh_token': user.spotify_refresh_token
     }
     
-    response = requests.post('https://accounts.spotify.com/api/token', headers=headers, data=data)
+    response = spotify_http.post('https://accounts.spotify.com/api/token', headers=headers, data=data)
     
     if response.status_code != 200:
         return jsonify({'error': 'Token refresh failed'}), 400
@@ -109,39 +113,44 @@ def search_songs():
     if not user or not user.spotify_access_token:
         return jsonify({'error': 'No Spotify access token available'}), 400
     
-    # Search Spotify
-    headers = {
-        'Authorization': f'Bearer {user.spotify_access_token}'
-    }
-    params = {
-        'q': query,
-        'type': 'track',
-        'limit': 10
-    }
-    
-    response = requests.get('https://api.spotify.com/v1/search', headers=headers, params=params)
-    
-    # Handle token expiration
-    if response.status_code == 401:
-        # Try to refresh token
-        refresh_response = requests.get(url_for('spotify.refresh_token', _external=True))
-        if refresh_response.status_code != 200:
-            return jsonify({'error': 'Spotify authentication expired'}), 401
-        
-        # Retry with new token
-        user = User.query.get(session['user_id'])
+    # Search Spotify, unless the same search was answered recently
+    cache_key = f'10:{query}'
+    data = spotify_cache.get('search', cache_key)
+    if data is None:
         headers = {
             'Authorization': f'Bearer {user.spotify_access_token}'
         }
-        response = requests.get('https://api.spotify.com/v1/search', headers=headers, params=params)
-    
-    if response.status_code != 200:
-        return jsonify({'error': 'Spotify API error'}), response.status_code
-    
-    data = response.json()
+        params = {
+            'q': query,
+            'type': 'track',
+            'limit': 10
+        }
+        
+        response = spotify_http.get('https://api.spotify.com/v1/search', headers=headers, params=params)
+        
+        # Handle token expiration
+        if response.status_code == 401:
+            # Try to refresh token
+            refresh_response = requests.get(url_for('spotify.refresh_token', _external=True))
+            if refresh_response.status_code != 200:
+                return jsonify({'error': 'Spotify authentication expired'}), 401
+            
+            # Retry with new token
+            user = User.query.get(session['user_id'])
+            headers = {
+                'Authorization': f'Bearer {user.spotify_access_token}'
+            }
+            response = spotify_http.get('https://api.spotify.com/v1/search', headers=headers, params=params)
+        
+        if response.status_code != 200:
+            return jsonify({'error': 'Spotify API error'}), response.status_code
+        
+        data = response.json()
+        spotify_cache.set('search', cache_key, data)
     
     # Process and return results
     results = []
+    songs = []
     for item in data['tracks']['items']:
         # Check if song exists in our database
         song = Song.query.filter_by(spotify_id=item['id']).first()
@@ -158,6 +167,7 @@ def search_songs():
             )
             db.session.add(song)
             db.session.commit()
+        songs.append(song)
         
         results.append({
             'id': song.id,
@@ -170,6 +180,9 @@ def search_songs():
             'image_url': item['album']['images'][0]['url'] if item['album']['images'] else None
         })
     
+    # Fetch missing audio features in the background instead of on this request
+    enrichment_queue.enqueue_songs(songs)
+    
     return jsonify(results), 200
 
 @spotify_bp.route('/spotify/features/<spotify_id>', methods=['GET'])
@@ -177,6 +190,21 @@ def get_audio_features(spotify_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     
+    # Serve features we already stored or cached before going to the network
+    song = Song.query.filter_by(spotify_id=spotify_id).first()
+    if song and song.features:
+        return jsonify(song.get_features()), 200
+    if song and song.feature_vector is not None:
+        # Songs stored without the raw JSON (backfilled or imported) still have the normalized vector
+        return jsonify(denormalize_features(song.get_vector())), 200
+    
+    features = spotify_cache.get('audio-features', spotify_id)
+    if features is not None:
+        if song:
+            song.set_features(features)
+            db.session.commit()
+        return jsonify(features), 200
+    
     user = User.query.get(session['user_id'])
     if not user or not user.spotify_access_token:
         return jsonify({'error': 'No Spotify access token available'}), 400
@@ -186,7 +214,7 @@ def get_audio_features(spotify_id):
         'Authorization': f'Bearer {user.spotify_access_token}'
     }
     
-    response = requests.get(f'https://api.spotify.com/v1/audio-features/{spotify_id}', headers=headers)
+    response = spotify_http.get(f'https://api.spotify.com/v1/audio-features/{spotify_id}', headers=headers)
     
     # Handle token expiration
     if response.status_code == 401:
@@ -200,15 +228,15 @@ def get_audio_features(spotify_id):
         headers = {
             'Authorization': f'Bearer {user.spotify_access_token}'
         }
-        response = requests.get(f'https://api.spotify.com/v1/audio-features/{spotify_id}', headers=headers)
+        response = spotify_http.get(f'https://api.spotify.com/v1/audio-features/{spotify_id}', headers=headers)
     
     if response.status_code != 200:
         return jsonify({'error': 'Spotify API error'}), response.status_code
     
     features = response.json()
+    spotify_cache.set('audio-features', spotify_id, features)
     
     # Update song in database with features
-    song = Song.query.filter_by(spotify_id=spotify_id).first()
     if song:
         song.set_features(features)
         db.session.commit()
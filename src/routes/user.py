@@ -1,7 +1,13 @@
 from flask import Blueprint, request, jsonify, session, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from src.models.user import db, User, Song, UserPreference, Recommendation
+from src.models.recommendation import recommendation_engine
+from src.models.enrichment import enrichment_queue
+from src.models.serving import serving_cache
+from src.models.regeneration import regeneration_scheduler
+from sqlalchemy import and_, or_, func
 from datetime import datetime
+import base64
 import json
 
 user_bp = Blueprint('user', __name__)
@@ -89,31 +95,93 @@ def get_profile():
         'has_spotify': bool(user.spotify_access_token)
     }), 200
 
+def encode_cursor(timestamp, row_id):
+    """Opaque keyset cursor for the row after (timestamp, id) in newest-first order"""
+    raw = json.dumps([timestamp.isoformat() if timestamp else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return (datetime.fromisoformat(timestamp) if timestamp else None), int(row_id)
+
+def newest_first(dialect_name):
+    """Keyset order for preference pages: timestamp descending with NULLs last on every backend, then id"""
+    timestamp = UserPreference.timestamp.desc()
+    # PostgreSQL sorts NULLs first when descending; MySQL already puts them last and has no NULLS LAST
+    if dialect_name not in ('mysql', 'mariadb'):
+        timestamp = timestamp.nullslast()
+    return timestamp, UserPreference.id.desc()
+
+def page_size():
+    default = current_app.config.get('API_PAGE_SIZE', 50)
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, current_app.config.get('API_MAX_PAGE_SIZE', 200)))
+
 @user_bp.route('/user/preferences', methods=['GET'])
 def get_preferences():
     if 'user_id' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     
-    preferences = UserPreference.query.filter_by(user_id=session['user_id']).all()
-    result = []
-    
-    for pref in preferences:
-        song = Song.query.get(pref.song_id)
-        if song:
-            result.append({
-                'id': pref.id,
-                'song': {
-                    'id': song.id,
-                    'spotify_id': song.spotify_id,
-                    'title': song.title,
-                    'artist': song.artist,
-                    'album': song.album
-                },
-                'rating': 'like' if pref.rating else 'dislike',
-                'timestamp': pref.timestamp
-            })
+    user_id = session['user_id']
+    # Songs come from the same query instead of one lookup per preference
+    query = (db.session.query(UserPreference, Song)
+             .join(Song, Song.id == UserPreference.song_id)
+             .filter(UserPreference.user_id == user_id))
+    
+    # Only the preferences for songs being displayed, e.g. to mark rating buttons
+    spotify_ids = request.args.get('spotify_ids')
+    if spotify_ids:
+        query = query.filter(Song.spotify_id.in_(spotify_ids.split(',')[:page_size()]))
+    
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            timestamp, pref_id = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        # Keyset pagination on (timestamp, id), newest first: stable while new ratings arrive
+        if timestamp is None:
+            # Rows without a timestamp sort last (see newest_first)
+            query = query.filter(UserPreference.timestamp.is_(None), UserPreference.id < pref_id)
+        else:
+            query = query.filter(or_(
+                UserPreference.timestamp < timestamp,
+                and_(UserPreference.timestamp == timestamp, UserPreference.id < pref_id),
+                UserPreference.timestamp.is_(None)
+            ))
+    
+    limit = page_size()
+    rows = (query.order_by(*newest_first(db.engine.dialect.name))
+            .limit(limit + 1).all())
     
-    return jsonify(result), 200
+    result = []
+    for pref, song in rows[:limit]:
+        result.append({
+            'id': pref.id,
+            'song': {
+                'id': song.id,
+                'spotify_id': song.spotify_id,
+                'title': song.title,
+                'artist': song.artist,
+                'album': song.album
+            },
+            'rating': 'like' if pref.rating else 'dislike',
+            'timestamp': pref.timestamp
+        })
+    
+    response = {
+        'items': result,
+        'next_cursor': encode_cursor(rows[limit - 1][0].timestamp, rows[limit - 1][0].id) if len(rows) > limit else None
+    }
+    
+    # Totals for the profile stats, computed once on the first page
+    if not cursor and not spotify_ids:
+        counts = dict(db.session.query(UserPreference.rating, func.count())
+                      .filter(UserPreference.user_id == user_id)
+                      .group_by(UserPreference.rating).all())
+        response['totals'] = {'like': counts.get(True, 0), 'dislike': counts.get(False, 0)}
+    
+    return jsonify(response), 200
 
 @user_bp.route('/feedback', methods=['POST'])
 def submit_feedback():
@@ -156,23 +224,31 @@ def submit_feedback():
         song_id=song.id
     ).first()
     
+    rating = data['rating'] == 'like'
+    old_rating = existing_pref.rating if existing_pref else None
+    
     if existing_pref:
         # Update existing preference
-        existing_pref.rating = data['rating'] == 'like'
+        existing_pref.rating = rating
         existing_pref.timestamp = datetime.utcnow()
     else:
         # Create new preference
         new_pref = UserPreference(
             user_id=session['user_id'],
             song_id=song.id,
-            rating=data['rating'] == 'like'
+            rating=rating
         )
         db.session.add(new_pref)
     
+    # Keep the user's running taste profile in step with the preference
+    recommendation_engine.update_user_profile(session['user_id'], song.id, old_rating, rating)
     db.session.commit()
     
-    # Update recommendation model (this would trigger the AI to learn)
-    # This is a placeholder - actual implementation would be in the AI module
+    # Songs rated without features are enriched in the background
+    enrichment_queue.enqueue_songs([song])
+    
+    # Regenerate in the background; a burst of feedback is coalesced into one run
+    regeneration_scheduler.schedule(session['user_id'])
     
     return jsonify({'message': 'Feedback submitted successfully'}), 200
 
@@ -181,33 +257,7 @@ def get_recommendations():
     if 'user_id' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     
-    # This is a placeholder - actual implementation would query the AI model
-    # For now, return some mock recommendations
-    
-    # Mark recommendations as shown
-    recommendations = Recommendation.query.filter_by(
-        user_id=session['user_id'],
-        is_shown=False
-    ).order_by(Recommendation.recommendation_score.desc()).limit(10).all()
-    
-    result = []
-    for rec in recommendations:
-        song = Song.query.get(rec.song_id)
-        if song:
-            result.append({
-                'id': rec.id,
-                'song': {
-                    'id': song.id,
-                    'spotify_id': song.spotify_id,
-                    'title': song.title,
-                    'artist': song.artist,
-                    'album': song.album,
-                    'preview_url': song.preview_url
-                },
-                'score': rec.recommendation_score
-            })
-            rec.is_shown = True
-    
-    db.session.commit()
+    # Served from the in-memory buffer; rows are marked shown in the background
+    result = serving_cache.pop(session['user_id'], 10)
     
     return jsonify(result), 200
@@ -6,6 +6,7 @@ document.addEventListener('DOMContentLoaded', function() {
         currentPage: null,
         recommendations: [],
         history: [],
+        historyCursor: null,
         currentSong: null,
         player: null,
         isPlaying: false
@@ -212,8 +213,22 @@ document.addEventListener('DOMContentLoaded', function() {
         document.getElementById('history-loading').classList.remove('d-none');
         document.getElementById('history-list').innerHTML = '';
         document.getElementById('no-history').classList.add('d-none');
+        document.getElementById('history-more').classList.add('d-none');
+        state.history = [];
+        state.historyCursor = null;
         
-        fetch('/api/user/preferences')
+        loadHistoryPage();
+    }
+    
+    // Fetch the next page of history and append it to the list
+    function loadHistoryPage() {
+        const url = state.historyCursor
+            ? `/api/user/preferences?cursor=${encodeURIComponent(state.historyCursor)}`
+            : '/api/user/preferences';
+        const loadMoreBtn = document.getElementById('history-load-more');
+        loadMoreBtn.disabled = true;
+        
+        fetch(url)
             .then(response => {
                 if (response.ok) {
                     return response.json();
@@ -221,29 +236,38 @@ document.addEventListener('DOMContentLoaded', function() {
                 throw new Error('Failed to load history');
             })
             .then(data => {
-                state.history = data;
+                const firstPage = state.history.length === 0;
+                state.history = state.history.concat(data.items);
+                state.historyCursor = data.next_cursor;
                 document.getElementById('history-loading').classList.add('d-none');
+                loadMoreBtn.disabled = false;
+                document.getElementById('history-more').classList.toggle('d-none', !data.next_cursor);
                 
-                if (data.length === 0) {
+                if (firstPage && data.items.length === 0) {
                     document.getElementById('no-history').classList.remove('d-none');
                     return;
                 }
                 
-                // Count likes and dislikes for profile stats
-                const likes = data.filter(item => item.rating === 'like').length;
-                const dislikes = data.filter(item => item.rating === 'dislike').length;
-                document.getElementById('stats-liked').textContent = likes;
-                document.getElementById('stats-disliked').textContent = dislikes;
+                // Profile stats come with the first page and cover the whole history
+                if (data.totals) {
+                    document.getElementById('stats-liked').textContent = data.totals.like;
+                    document.getElementById('stats-disliked').textContent = data.totals.dislike;
+                }
                 
                 // Render songs
-                renderSongs(data.map(item => item.song), 'history-list');
+                renderSongs(data.items.map(item => item.song), 'history-list', !firstPage);
             })
             .catch(error => {
                 document.getElementById('history-loading').classList.add('d-none');
-                document.getElementById('no-history').classList.remove('d-none');
+                loadMoreBtn.disabled = false;
+                if (state.history.length === 0) {
+                    document.getElementById('no-history').classList.remove('d-none');
+                }
                 showToast('Error', 'Failed to load history');
             });
     }
+    
+    document.getElementById('history-load-more').addEventListener('click', loadHistoryPage);
 
     // Profile
     function loadProfile() {
@@ -275,9 +299,11 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     // Render songs
-    function renderSongs(songs, containerId) {
+    function renderSongs(songs, containerId, append = false) {
         const container = document.getElementById(containerId);
-        container.innerHTML = '';
+        if (!append) {
+            container.innerHTML = '';
+        }
         
         const template = document.getElementById('song-template');
         
@@ -66,7 +66,7 @@ function submitFeedback(song, rating) {
                     if (state.currentPage === 'recommendations') {
                         loadRecommendations();
                     }
-                }, 1500);
+                }, 3000);  // regeneration runs after a short pause in feedback
             }
         }
     })
@@ -78,17 +78,23 @@ function submitFeedback(song, rating) {
 
 // Function to mark existing preferences on song load
 function markExistingPreferences() {
-    // Get user preferences
-    fetch('/api/user/preferences')
+    // Only ask for the preferences of the songs on screen, not the whole history
+    const spotifyIds = [...new Set(Array.from(document.querySelectorAll('.like-btn[data-song-id]'))
+        .map(button => button.dataset.songId))];
+    if (spotifyIds.length === 0) {
+        return;
+    }
+    
+    fetch(`/api/user/preferences?limit=${spotifyIds.length}&spotify_ids=${encodeURIComponent(spotifyIds.join(','))}`)
         .then(response => {
             if (response.ok) {
                 return response.json();
             }
             throw new Error('Failed to load preferences');
         })
-        .then(preferences => {
+        .then(data => {
             // For each preference, mark the appropriate button
-            preferences.forEach(pref => {
+            data.items.forEach(pref => {
                 const songElements = document.querySelectorAll(`[data-song-id="${pref.song.spotify_id}"]`);
                 songElements.forEach(element => {
                     const likeBtn = element.closest('.card').querySelector('.like-btn');
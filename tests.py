@@ -1,15 +1,116 @@
 import unittest
 from flask import Flask, session
-from src.models.user import db, User, Song, UserPreference, Recommendation
+from src.models.user import db, User, Song, UserPreference, UserProfile, Recommendation
 from src.models.recommendation import recommendation_engine
+from src.models.recommendation import RecommendationEngine
+from src.models.feature_store import feature_store, CatalogFeatureStore
+from src.models.ann import create_index, evaluate_index
+from src.models.batch import BatchRecommender
+from src.models.recommendation import SpotifyClient
+from src.models.spotify_http import SpotifyHTTP, spotify_http
+from src.models.spotify_concurrent import ConcurrentSpotifyFetcher, enrich_songs
+from src.models.spotify_cache import ResponseCache, spotify_cache
+from src.models.enrichment import EnrichmentQueue, enrichment_queue
+from src.models.features import normalize_features
+from src.models.migrations import backfill_feature_vectors, migrate, migration_status, MIGRATIONS
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import OperationalError
+from src.models.database import engine_options, install_sqlite_pragmas
+from src.models.serving import serving_cache
+from src.models.regeneration import RegenerationScheduler, regeneration_scheduler
+from src.models.metrics import metrics, spotify_endpoint
+from src.models.popularity import popularity_index
+from src.models.model_artifacts import list_artifacts, verify_artifact, INDEX_FILE
+from src.models.catalog_filters import RowSet, make_filters
+from src.models.catalog_import import CatalogImporter, song_row
+from sqlalchemy import event, select
+from sqlalchemy.dialects import mysql, postgresql
+from src.routes.user import newest_first
 import os
 import sys
+import atexit
+import shutil
 import json
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
+from datetime import datetime, timedelta
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 
-# Set up test app
+# Set up test app on a scratch database; the default lives in the instance folder
+# and is dropped after every test
+_TEST_DIR = tempfile.mkdtemp(prefix='spotify-recommender-tests-')
+atexit.register(shutil.rmtree, _TEST_DIR, ignore_errors=True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_TEST_DIR, 'test.db')
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from src.main import app as flask_app
 
+def sample_features(i):
+    """Deterministic audio features for test song number i"""
+    return {
+        'danceability': (i % 10) / 10.0,
+        'energy': ((i * 3) % 10) / 10.0,
+        'key': i % 12,
+        'loudness': -float(i % 30),
+        'mode': i % 2,
+        'speechiness': 0.05,
+        'acousticness': ((i * 7) % 10) / 10.0,
+        'instrumentalness': 0.0,
+        'liveness': 0.1,
+        'valence': ((i * 5) % 10) / 10.0,
+        'tempo': 80.0 + i,
+    }
+
+class FakeSpotify:
+    """Local HTTP server standing in for the Spotify Web API.
+    
+    ``routes`` maps a path to a list of ``(status, headers, body)`` replies
+    served in order (the last one repeats) or to a callable taking the query
+    parameters and returning such a reply.
+    """
+    
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.requests.append((self.command, url.path))
+                route = fake.routes.get(url.path)
+                if route is None:
+                    status, headers, body = 404, {}, {'error': 'not found'}
+                elif callable(route):
+                    status, headers, body = route(parse_qs(url.query))
+                else:
+                    status, headers, body = route.pop(0) if len(route) > 1 else route[0]
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            
+            do_POST = do_GET
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
 class SpotifyRecommenderTests(unittest.TestCase):
     
     def setUp(self):
@@ -23,6 +124,15 @@ class SpotifyRecommenderTests(unittest.TestCase):
         self.app_context.push()
         
         db.create_all()
+        # Cached Spotify responses go to a per-test file, never the instance folder's cache
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.spotify_cache_path = spotify_cache.path
+        spotify_cache.path = os.path.join(self.cache_dir.name, 'spotify_cache.db')
+        spotify_cache.clear()
+        # Queue work is driven explicitly in tests, never by a background thread
+        enrichment_queue.worker_enabled = False
+        serving_cache.worker_enabled = False
+        regeneration_scheduler.worker_enabled = False
         
         # Create test user
         test_user = User(
@@ -48,8 +158,14 @@ class SpotifyRecommenderTests(unittest.TestCase):
     
     def tearDown(self):
         """Clean up after each test"""
+        recommendation_engine.wait_for_training(5)
         db.session.remove()
         db.drop_all()
+        recommendation_engine.reset()
+        enrichment_queue.reset()
+        serving_cache.reset()
+        spotify_cache.path = self.spotify_cache_path
+        self.cache_dir.cleanup()
         self.app_context.pop()
     
     def test_user_registration(self):
@@ -147,5 +263,880 @@ class SpotifyRecommenderTests(unittest.TestCase):
             self.assertIsNotNone(preference)
             self.assertTrue(preference.rating)  # Should be True for 'like'
 
+    def test_feature_store_tracks_song_changes(self):
+        """Test the catalog feature store follows inserts, updates and deletes"""
+        songs = Song.query.order_by(Song.id).all()
+        songs[0].set_features(sample_features(0))
+        db.session.commit()
+        
+        self.assertTrue(recommendation_engine.train())
+        self.assertEqual(len(feature_store), 1)
+        self.assertEqual(feature_store.drift(), 0)
+        
+        # New features are picked up on commit without retraining
+        songs[1].set_features(sample_features(1))
+        db.session.commit()
+        self.assertIn(songs[1].id, feature_store)
+        self.assertGreater(feature_store.drift(), 0)
+        
+        # Rolled back changes never reach the store
+        songs[2].set_features(sample_features(2))
+        db.session.flush()
+        db.session.rollback()
+        self.assertNotIn(songs[2].id, feature_store)
+        
+        db.session.delete(Song.query.get(songs[0].id))
+        db.session.commit()
+        self.assertNotIn(songs[0].id, feature_store)
+        self.assertEqual(feature_store.ids.tolist(), [songs[1].id])
+        
+        # A fit only accounts for the changes its snapshot saw
+        _, _, seq = feature_store.snapshot()
+        feature_store.delete(songs[1].id)
+        feature_store.upsert(songs[3].id, normalize_features(sample_features(3)))
+        feature_store.mark_fitted(seq)
+        self.assertEqual((feature_store.changes_since_fit, feature_store.deleted_since_fit), (2, {songs[1].id}))
+        feature_store.mark_fitted()
+        self.assertEqual((feature_store.changes_since_fit, feature_store.deleted_since_fit), (0, set()))
+
+    def test_shared_catalog_file_swap(self):
+        """Test workers map the published catalog and swap to newer versions"""
+        songs = Song.query.order_by(Song.id).all()
+        for i, song in enumerate(songs[:4]):
+            song.set_features(sample_features(i))
+        db.session.commit()
+        
+        with tempfile.TemporaryDirectory() as catalog_dir:
+            recommendation_engine.catalog_dir = catalog_dir
+            try:
+                self.assertTrue(recommendation_engine.train())
+                
+                worker = RecommendationEngine(store=CatalogFeatureStore(), catalog_dir=catalog_dir)
+                self.assertTrue(worker.check_for_new_catalog(force=True))
+                self.assertEqual(worker.catalog_version, 1)
+                self.assertEqual(sorted(worker.song_ids.tolist()), [s.id for s in songs[:4]])
+                self.assertFalse(worker.song_features.flags.writeable)
+                
+                songs[4].set_features(sample_features(4))
+                db.session.commit()
+                recommendation_engine.train()
+                
+                self.assertTrue(worker.check_for_new_catalog(force=True))
+                self.assertEqual(worker.catalog_version, 2)
+                self.assertEqual(len(worker.song_ids), 5)
+            finally:
+                recommendation_engine.catalog_dir = None
+
+    def test_user_profile_incremental_updates(self):
+        """Test likes, unlikes and flips keep the running profile equal to a rebuild"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()
+        for i, song in enumerate(songs):
+            song.set_features(sample_features(i))
+        db.session.commit()
+        recommendation_engine.train()
+        
+        for song in songs[:4]:
+            recommendation_engine.process_feedback(user.id, song.id, True)
+        recommendation_engine.process_feedback(user.id, songs[1].id, False)
+        recommendation_engine.process_feedback(user.id, songs[5].id, False)
+        
+        liked = [recommendation_engine.extract_features(songs[i]) for i in (0, 2, 3)]
+        profile = recommendation_engine.get_user_profile(user.id)
+        self.assertEqual(UserProfile.query.get(user.id).like_count, 3)
+        np.testing.assert_allclose(profile, np.mean(liked, axis=0), rtol=1e-5)
+        
+        recommendation_engine.rebuild_user_profile(user.id)
+        db.session.commit()
+        np.testing.assert_allclose(recommendation_engine.get_user_profile(user.id), profile, rtol=1e-6)
+
+    def test_user_profile_follows_feature_changes(self):
+        """Test a liked song's features arriving or changing later reach the running profile"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()
+        songs[0].set_features(sample_features(0))
+        db.session.commit()
+        recommendation_engine.process_feedback(user.id, songs[0].id, True)
+        recommendation_engine.process_feedback(user.id, songs[1].id, True)
+        self.assertEqual(UserProfile.query.get(user.id).like_count, 1)
+        
+        # Enriched after the like
+        songs[1].set_features(sample_features(1))
+        db.session.commit()
+        liked = [recommendation_engine.extract_features(songs[i]) for i in (0, 1)]
+        self.assertEqual(UserProfile.query.get(user.id).like_count, 2)
+        np.testing.assert_allclose(recommendation_engine.get_user_profile(user.id), np.mean(liked, axis=0), rtol=1e-5)
+        
+        # Re-enriched with different values, then unliked: nothing of the song is left behind
+        songs[1].set_features(sample_features(5))
+        db.session.commit()
+        recommendation_engine.process_feedback(user.id, songs[1].id, False)
+        np.testing.assert_allclose(recommendation_engine.get_user_profile(user.id), liked[0], rtol=1e-5)
+        
+        recommendation_engine.rebuild_user_profile(user.id)
+        db.session.commit()
+        self.assertEqual(UserProfile.query.get(user.id).like_count, 1)
+        np.testing.assert_allclose(recommendation_engine.get_user_profile(user.id), liked[0], rtol=1e-5)
+
+    def test_index_backends_agree_with_exact_search(self):
+        """Test every index backend against exact search on random vectors"""
+        rng = np.random.default_rng(0)
+        X = rng.random((2000, 11), dtype=np.float32)
+        queries = rng.random((20, 11), dtype=np.float32)
+        
+        for backend, params in [('brute', {}), ('ball_tree', {}), ('ivf', {'n_lists': 16, 'n_probe': 16})]:
+            report = evaluate_index(create_index(backend, **params), X, queries, n_neighbors=10)
+            self.assertEqual(report['recall_at_10'], 1.0, backend)
+            self.assertGreater(report['memory_bytes'], 0)
+        
+        # Probing fewer cells is approximate but still finds most neighbours
+        report = evaluate_index(create_index('ivf', n_lists=16, n_probe=4), X, queries, n_neighbors=10)
+        self.assertGreater(report['recall_at_10'], 0.5)
+
+    def test_recommendations_skip_rated_songs(self):
+        """Test kNN returns exactly n unrated songs even when most neighbours are rated"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()
+        for i, song in enumerate(songs):
+            song.set_features(sample_features(i))
+        for song in songs[:7]:
+            db.session.add(UserPreference(user_id=user.id, song_id=song.id, rating=True))
+        db.session.commit()
+        rated = {song.id for song in songs[:7]}
+        
+        for backend in ('ball_tree', 'brute', 'ivf'):
+            recommendation_engine.index_backend = backend
+            recommendation_engine.train()
+            try:
+                self.assertTrue(recommendation_engine.generate_recommendations(user.id, n_recommendations=3))
+            finally:
+                recommendation_engine.index_backend = 'ball_tree'
+            
+            recommended = {rec.song_id for rec in Recommendation.query.filter_by(user_id=user.id, is_shown=False)}
+            self.assertEqual(len(recommended), 3, backend)
+            self.assertFalse(recommended & rated, backend)
+        
+        self.assertGreaterEqual(recommendation_engine.search_stats['searches'], 3)
+        self.assertEqual(recommendation_engine.search_stats['short'], 0)
+        self.assertEqual(recommendation_engine.model_status()['search'], recommendation_engine.search_stats)
+        self.assertGreaterEqual(metrics.search_rounds.count(), 3)
+        
+        # Widening past 2n goes straight to n plus the excluded rows: never more than two rounds
+        X = np.random.default_rng(0).random((200, 11), dtype=np.float32)
+        _, nearest = create_index('brute').fit(X).kneighbors(X[:1], 53)
+        exclude_mask = np.zeros(200, dtype=bool)
+        exclude_mask[nearest[0][:50]] = True
+        _, indices, rounds = create_index('ball_tree').fit(X).kneighbors_excluding(X[:1], 3, exclude_mask)
+        self.assertEqual(rounds, 2)
+        self.assertEqual(list(indices), list(nearest[0][50:]))
+
+    def test_bulk_store_recommendations(self):
+        """Test bulk replace and append of pending recommendations"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = [song.id for song in Song.query.order_by(Song.id)]
+        
+        inserted = recommendation_engine.bulk_store_recommendations({user.id: [(songs[0], 0.5), (songs[1], 0.4)]})
+        self.assertEqual(inserted, 2)
+        
+        # Appending skips songs that are already pending
+        inserted = recommendation_engine.bulk_store_recommendations(
+            {user.id: [(songs[1], 0.9), (songs[2], 0.9)]}, replace=False)
+        self.assertEqual(inserted, 1)
+        
+        # Replacing drops the previous pending set but keeps shown rows
+        Recommendation.query.filter_by(song_id=songs[0]).update({'is_shown': True})
+        recommendation_engine.bulk_store_recommendations({user.id: [(songs[3], 0.7)]})
+        pending = [rec.song_id for rec in Recommendation.query.filter_by(user_id=user.id, is_shown=False)]
+        self.assertEqual(pending, [songs[3]])
+        self.assertEqual(Recommendation.query.filter_by(user_id=user.id).count(), 2)
+
+    def test_batch_recommendations_match_online_path(self):
+        """Test the chunked batch job stores the same songs as the per-user path"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()
+        for i, song in enumerate(songs):
+            song.set_features(sample_features(i))
+        for song in songs[:3]:
+            recommendation_engine.process_feedback(user.id, song.id, True)
+        db.session.commit()
+        
+        recommendation_engine.index_backend = 'brute'
+        try:
+            recommendation_engine.generate_recommendations(user.id, n_recommendations=4)
+        finally:
+            recommendation_engine.index_backend = 'ball_tree'
+        online = [rec.song_id for rec in Recommendation.query.filter_by(user_id=user.id, is_shown=False)
+                  .order_by(Recommendation.recommendation_score.desc())]
+        
+        batch = BatchRecommender(recommendation_engine, n_recommendations=4, workers=1, catalog_chunk=3)
+        self.assertEqual(batch.run(), 4)
+        offline = [rec.song_id for rec in Recommendation.query.filter_by(user_id=user.id, is_shown=False)
+                   .order_by(Recommendation.recommendation_score.desc())]
+        self.assertEqual(offline, online)
+
+    def test_spotify_http_retries(self):
+        """Test the shared Spotify client retries 429/5xx and honours Retry-After"""
+        fake = FakeSpotify()
+        original_url = SpotifyClient.BASE_URL
+        SpotifyClient.BASE_URL = fake.url + '/v1'
+        try:
+            fake.routes['/v1/tracks/abc'] = [(429, {'Retry-After': '0'}, {}), (200, {}, {'id': 'abc'})]
+            self.assertEqual(SpotifyClient.get_track('token', 'abc'), {'id': 'abc'})
+            self.assertEqual(len(fake.requests), 2)
+            
+            client = SpotifyHTTP(max_retries=2, backoff=0.001)
+            fake.routes['/v1/flaky'] = [(503, {}, {}), (502, {}, {}), (200, {}, {'ok': True})]
+            self.assertEqual(client.get(fake.url + '/v1/flaky').json(), {'ok': True})
+            
+            # Non-idempotent requests are not replayed after a server error
+            fake.requests.clear()
+            fake.routes['/v1/token'] = [(503, {}, {})]
+            self.assertEqual(client.post(fake.url + '/v1/token').status_code, 503)
+            self.assertEqual(len(fake.requests), 1)
+        finally:
+            SpotifyClient.BASE_URL = original_url
+            fake.close()
+
+    def test_spotify_batch_enrichment(self):
+        """Test Spotify recommendations are enriched with batched audio-feature calls"""
+        user = User.query.filter_by(username='testuser').first()
+        song = Song.query.first()
+        db.session.add(UserPreference(user_id=user.id, song_id=song.id, rating=True))
+        db.session.commit()
+        
+        def track(i):
+            return {'id': f'new_{i}', 'name': f'New {i}', 'artists': [{'name': 'A'}],
+                    'album': {'name': 'B'}, 'popularity': 50, 'preview_url': None}
+        
+        def audio_features(query):
+            ids = query['ids'][0].split(',')
+            return 200, {}, {'audio_features': [dict(sample_features(i), id=track_id) for i, track_id in enumerate(ids)]}
+        
+        fake = FakeSpotify()
+        original_url = SpotifyClient.BASE_URL
+        SpotifyClient.BASE_URL = fake.url + '/v1'
+        try:
+            fake.routes['/v1/recommendations'] = [(200, {}, {'tracks': [track(i) for i in range(20)]})]
+            fake.routes['/v1/audio-features'] = audio_features
+            self.assertTrue(recommendation_engine.fetch_and_store_spotify_recommendations(user.id, 'token'))
+            self.assertEqual(fake.requests.count(('GET', '/v1/audio-features')), 1)
+            self.assertEqual(Song.query.filter(Song.spotify_id.like('new_%'), Song.features.isnot(None)).count(), 20)
+            self.assertEqual(Recommendation.query.filter_by(user_id=user.id).count(), 20)
+            
+            # Large id lists are split into 100-id requests and merged
+            fake.requests.clear()
+            features = SpotifyClient.get_audio_features_batch('token', [f't{i}' for i in range(250)])
+            self.assertEqual(len(features), 250)
+            self.assertEqual(len(fake.requests), 3)
+        finally:
+            SpotifyClient.BASE_URL = original_url
+            fake.close()
+
+    def test_concurrent_enrichment_respects_cap(self):
+        """Test concurrent feature fetching stays under the concurrency cap and stores everything"""
+        spotify_ids = [f'bulk_{i}' for i in range(1000)]
+        for spotify_id in spotify_ids:
+            db.session.add(Song(spotify_id=spotify_id, title='t', artist='a'))
+        db.session.commit()
+        
+        lock = threading.Lock()
+        active = {'now': 0, 'max': 0}
+        
+        def audio_features(query):
+            with lock:
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+            time.sleep(0.05)
+            with lock:
+                active['now'] -= 1
+            ids = query['ids'][0].split(',')
+            return 200, {}, {'audio_features': [dict(sample_features(1), id=track_id) for track_id in ids]}
+        
+        fake = FakeSpotify()
+        original_url = SpotifyClient.BASE_URL
+        SpotifyClient.BASE_URL = fake.url + '/v1'
+        fetcher = ConcurrentSpotifyFetcher(max_workers=3, rate_per_second=1000)
+        try:
+            fake.routes['/v1/audio-features'] = audio_features
+            self.assertEqual(enrich_songs('token', spotify_ids, fetcher), 1000)
+            self.assertEqual(len(fake.requests), 10)
+            self.assertLessEqual(active['max'], 3)
+            self.assertGreater(active['max'], 1)
+            self.assertEqual(Song.query.filter(Song.spotify_id.like('bulk_%'), Song.features.is_(None)).count(), 0)
+        finally:
+            fetcher.shutdown()
+            SpotifyClient.BASE_URL = original_url
+            fake.close()
+
+    def test_spotify_response_cache(self):
+        """Test cached Spotify responses, TTL expiry and LRU eviction"""
+        fake = FakeSpotify()
+        original_url = SpotifyClient.BASE_URL
+        SpotifyClient.BASE_URL = fake.url + '/v1'
+        try:
+            fake.routes['/v1/tracks/cached'] = [(200, {}, {'id': 'cached'})]
+            SpotifyClient.get_track('token', 'cached')
+            self.assertEqual(SpotifyClient.get_track('token', 'cached'), {'id': 'cached'})
+            self.assertEqual(len(fake.requests), 1)
+            self.assertEqual(spotify_cache.stats()['endpoints']['track'], {'hits': 1, 'misses': 1})
+        finally:
+            SpotifyClient.BASE_URL = original_url
+            fake.close()
+        
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(os.path.join(cache_dir, 'cache.db'), max_entries=3,
+                                  ttls={'search': 0}, evict_every=1)
+            cache.set('search', 'q', {'tracks': []})
+            self.assertIsNone(cache.get('search', 'q'))
+            
+            for i in range(5):
+                cache.set('track', str(i), {'id': i})
+            self.assertEqual(cache.stats()['entries'], 3)
+            self.assertEqual(sorted(cache.get_many('track', [str(i) for i in range(5)])), ['2', '3', '4'])
+        
+        # Songs stored with only the packed vector are answered from it, not refetched (no token here)
+        song = Song.query.filter_by(spotify_id='spotify_id_3').first()
+        song.set_features(sample_features(3), keep_raw=False)
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = User.query.filter_by(username='testuser').first().id
+        response = self.app.get('/api/spotify/features/spotify_id_3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), sample_features(3))
+
+    def test_enrichment_queue_batches_and_gives_up(self):
+        """Test queued songs are deduplicated, fetched in one batch and marked failed after retries"""
+        def audio_features(query):
+            ids = query['ids'][0].split(',')
+            return 200, {}, {'audio_features': [dict(sample_features(i), id=track_id) if track_id != 'spotify_id_10'
+                                                else None for i, track_id in enumerate(ids)]}
+        
+        fake = FakeSpotify()
+        fake.routes['/v1/audio-features'] = audio_features
+        original_url = SpotifyClient.BASE_URL
+        SpotifyClient.BASE_URL = fake.url + '/v1'
+        try:
+            queue = EnrichmentQueue(max_attempts=2, retry_delay=0,
+                                    token_provider=lambda: {'access_token': 'app', 'expires_in': 3600})
+            queue.worker_enabled = False
+            songs = Song.query.all()
+            self.assertEqual(queue.enqueue_songs(songs), 10)
+            self.assertEqual(queue.enqueue_songs(songs), 0)
+            self.assertEqual(queue.depth, 10)
+            
+            self.assertEqual(queue.drain(), 9)
+            self.assertEqual(len(fake.requests), 2)
+            self.assertEqual(Song.query.filter(Song.features.isnot(None)).count(), 9)
+            failed = Song.query.filter_by(spotify_id='spotify_id_10').one()
+            self.assertEqual((failed.features_status, failed.enrichment_attempts), ('failed', 2))
+            
+            stats = queue.stats()
+            self.assertEqual((stats['depth'], stats['enriched'], stats['retried'], stats['failed']), (0, 9, 1, 1))
+            # Songs that gave up are not queued again
+            self.assertEqual(queue.enqueue_songs(Song.query.all()), 0)
+            
+            # Failed requests and a missing token put songs back without counting an attempt
+            song = Song(spotify_id='unreachable', title='t', artist='a')
+            db.session.add(song)
+            db.session.commit()
+            fake.routes['/v1/audio-features'] = [(404, {}, {'error': 'not found'})]
+            self.assertEqual(queue.enqueue_missing(), 1)
+            self.assertEqual(queue.drain(), 0)
+            queue.token_provider = lambda: None
+            for _ in range(3):
+                queue.drain()
+            self.assertEqual((song.features_status, song.enrichment_attempts), (None, 0))
+            self.assertEqual((queue.depth, queue.stats()['deferred']), (1, 4))
+        finally:
+            SpotifyClient.BASE_URL = original_url
+            fake.close()
+
+    def test_packed_feature_vectors(self):
+        """Test vectors are packed at ingest and backfilled for rows with only raw JSON"""
+        song = Song.query.filter_by(spotify_id='spotify_id_1').one()
+        song.set_features(sample_features(1), keep_raw=False)
+        db.session.commit()
+        self.assertIsNone(song.features)
+        np.testing.assert_allclose(song.get_vector(), normalize_features(sample_features(1)), rtol=1e-6)
+        
+        # Rows written before the packed column existed only carry JSON
+        legacy = Song.query.filter_by(spotify_id='spotify_id_2').one()
+        db.session.execute(Song.__table__.update().where(Song.id == legacy.id)
+                           .values(features=json.dumps(sample_features(2)), feature_vector=None))
+        db.session.commit()
+        with db.engine.begin() as conn:
+            self.assertEqual(backfill_feature_vectors(conn), 1)
+            self.assertEqual(backfill_feature_vectors(conn), 0)
+        db.session.expire_all()
+        np.testing.assert_allclose(legacy.get_vector(), normalize_features(sample_features(2)), rtol=1e-6)
+        
+        feature_store.load_from_db()
+        self.assertEqual(sorted(feature_store.ids.tolist()), sorted([song.id, legacy.id]))
+        np.testing.assert_array_equal(feature_store.vector(legacy.id), legacy.get_vector())
+
+    def test_migrations_upgrade_legacy_database(self):
+        """Test migrations deduplicate preferences and add the serving indexes to an old schema"""
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(text('DROP INDEX uq_user_preferences_user_song'))
+            conn.execute(text('DROP INDEX ix_recommendations_user_shown_score'))
+            conn.execute(text("INSERT INTO users (id, username, email, password_hash) VALUES (1, 'u', 'e', 'p')"))
+            conn.execute(text("INSERT INTO songs (id, spotify_id, title, artist) VALUES (1, 's', 't', 'a')"))
+            for rating in (1, 0, 1):
+                conn.execute(text(f'INSERT INTO user_preferences (user_id, song_id, rating) VALUES (1, 1, {rating})'))
+        
+        self.assertEqual(migrate(engine), [version for version, _, _ in MIGRATIONS])
+        self.assertEqual(migrate(engine), [])
+        self.assertTrue(all(applied_at for _, _, applied_at in migration_status(engine)))
+        
+        with engine.connect() as conn:
+            self.assertEqual(conn.execute(text('SELECT id, rating FROM user_preferences')).all(), [(3, 1)])
+        indexes = {index['name'] for table in ('user_preferences', 'recommendations')
+                   for index in inspect(engine).get_indexes(table)}
+        self.assertLessEqual({'uq_user_preferences_user_song', 'ix_recommendations_user_shown_score'}, indexes)
+        engine.dispose()
+
+    def test_sqlite_writes_do_not_wait_for_readers(self):
+        """Test WAL lets feedback writes commit while other connections hold read transactions"""
+        def write_during_read(journal_mode):
+            with tempfile.TemporaryDirectory() as db_dir:
+                path = os.path.join(db_dir, 'concurrency.db')
+                uri = f'sqlite:///{path}'
+                pragmas = {'journal_mode': journal_mode, 'busy_timeout': 200, 'synchronous': 'NORMAL'}
+                engine = create_engine(uri, **engine_options({'SQLALCHEMY_DATABASE_URI': uri,
+                                                              'SQLITE_PRAGMAS': pragmas}))
+                install_sqlite_pragmas(engine, pragmas)
+                db.metadata.create_all(engine)
+                with engine.begin() as conn:
+                    conn.execute(text("INSERT INTO users (id, username, email, password_hash) VALUES (1, 'u', 'e', 'p')"))
+                    conn.execute(text("INSERT INTO songs (id, spotify_id, title, artist) VALUES (1, 's', 't', 'a')"))
+                
+                # Other workers in the middle of read transactions
+                readers = [sqlite3.connect(path, isolation_level=None) for _ in range(4)]
+                try:
+                    for reader in readers:
+                        reader.execute('BEGIN')
+                        reader.execute('SELECT COUNT(*) FROM user_preferences').fetchall()
+                    started = time.perf_counter()
+                    with engine.begin() as writer:
+                        writer.execute(text('INSERT INTO user_preferences (user_id, song_id, rating) VALUES (1, 1, 1)'))
+                    return time.perf_counter() - started
+                finally:
+                    for reader in readers:
+                        reader.close()
+                    engine.dispose()
+        
+        self.assertLess(write_during_read('WAL'), 0.1)
+        # With the rollback journal the commit waits for the readers and gives up after busy_timeout
+        with self.assertRaises(OperationalError):
+            write_during_read('DELETE')
+
+    def test_preferences_keyset_pagination(self):
+        """Test preference history pages follow (timestamp, id) order without gaps or repeats"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()
+        same_time = datetime(2024, 1, 1)
+        for i, song in enumerate(songs):
+            # Half of the ratings share a timestamp, so the id breaks ties; the last two have none
+            timestamp = same_time if i % 2 else same_time + timedelta(minutes=i)
+            db.session.add(UserPreference(user_id=user.id, song_id=song.id, rating=i < 7, timestamp=timestamp))
+        db.session.flush()
+        # The column default fills in a missing timestamp, so rows without one are made explicitly
+        UserPreference.query.filter(UserPreference.song_id.in_([songs[8].id, songs[9].id])).update(
+            {'timestamp': None})
+        db.session.commit()
+        prefs = UserPreference.query.filter_by(user_id=user.id).all()
+        dated = sorted((pref for pref in prefs if pref.timestamp), key=lambda pref: (pref.timestamp, pref.id))
+        undated = sorted((pref for pref in prefs if not pref.timestamp), key=lambda pref: pref.id)
+        expected = [pref.id for pref in dated[::-1] + undated[::-1]]
+        
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = user.id
+        
+        seen, cursor, pages = [], None, 0
+        while True:
+            url = '/api/user/preferences?limit=3' + (f'&cursor={cursor}' if cursor else '')
+            data = json.loads(self.app.get(url).data)
+            if pages == 0:
+                self.assertEqual(data['totals'], {'like': 7, 'dislike': 3})
+            seen += [item['id'] for item in data['items']]
+            pages += 1
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual(pages, 4)
+        
+        data = json.loads(self.app.get('/api/user/preferences?spotify_ids=spotify_id_1,spotify_id_2').data)
+        self.assertEqual(sorted(item['song']['spotify_id'] for item in data['items']), ['spotify_id_1', 'spotify_id_2'])
+        self.assertEqual(self.app.get('/api/user/preferences?cursor=bogus').status_code, 400)
+        
+        # PostgreSQL needs NULLS LAST spelled out to match the cursor predicate; MySQL rejects it
+        query = select(UserPreference.id)
+        self.assertIn('NULLS LAST', str(query.order_by(*newest_first('postgresql'))
+                                        .compile(dialect=postgresql.dialect())))
+        self.assertNotIn('NULLS LAST', str(query.order_by(*newest_first('mysql')).compile(dialect=mysql.dialect())))
+
+    def test_recommendations_served_from_memory(self):
+        """Test reads pop from the serving buffer without SQL and shown marks are flushed in a batch"""
+        user = User.query.filter_by(username='testuser').first()
+        song_ids = [song.id for song in Song.query.order_by(Song.id)]
+        recommendation_engine.store_recommendations(user.id, song_ids[:6])
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = user.id
+        
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            first = json.loads(self.app.get('/api/recommendations').data)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual([item['song']['id'] for item in first], song_ids[:6])
+        self.assertEqual(statements, [])
+        
+        # Nothing is written until the flush, which marks all served rows at once
+        self.assertEqual(Recommendation.query.filter_by(user_id=user.id, is_shown=True).count(), 0)
+        self.assertEqual(serving_cache.flush(), 6)
+        self.assertEqual(Recommendation.query.filter_by(user_id=user.id, is_shown=True).count(), 6)
+        self.assertEqual(json.loads(self.app.get('/api/recommendations').data), [])
+        
+        # Regeneration replaces the buffer
+        recommendation_engine.store_recommendations(user.id, song_ids[6:])
+        second = json.loads(self.app.get('/api/recommendations').data)
+        self.assertEqual([item['song']['id'] for item in second], song_ids[6:])
+
+    def test_regeneration_is_debounced_and_shared(self):
+        """Test bursts of feedback coalesce into one regeneration and concurrent requests share a run"""
+        calls = []
+        release = threading.Event()
+        
+        def generate(user_id):
+            calls.append(user_id)
+            release.wait(5)
+            return True
+        
+        scheduler = RegenerationScheduler(generate, debounce=0.1, max_delay=1.0)
+        scheduler.init_app(flask_app)
+        scheduler.debounce, scheduler.max_delay = 0.1, 1.0
+        
+        release.set()
+        futures = [scheduler.schedule(1) for _ in range(5)]
+        self.assertEqual(len({id(future) for future in futures}), 1)
+        self.assertTrue(futures[0].result(timeout=5))
+        self.assertEqual(calls, [1])
+        
+        # While a run is in flight, run() callers share it
+        release.clear()
+        first = scheduler.run(2)
+        for _ in range(50):
+            if calls[-1:] == [2]:
+                break
+            time.sleep(0.01)
+        self.assertIs(scheduler.run(2), first)
+        # Newer feedback during the run queues exactly one follow-up
+        follow_up = scheduler.schedule(2)
+        self.assertIs(scheduler.schedule(2), follow_up)
+        release.set()
+        self.assertTrue(first.result(timeout=5))
+        self.assertTrue(follow_up.result(timeout=5))
+        self.assertEqual(calls, [1, 2, 2])
+        self.assertEqual(scheduler.stats()['runs'], 3)
+
+    def test_model_snapshots_swap_and_roll_back(self):
+        """Test training in the background swaps snapshots atomically and the previous one can be restored"""
+        songs = Song.query.order_by(Song.id).all()
+        for i, song in enumerate(songs[:5]):
+            song.set_features(sample_features(i))
+        db.session.commit()
+        
+        self.assertEqual(self.app.post('/api/recommendations/train').status_code, 202)
+        self.assertEqual(recommendation_engine.wait_for_training(10), 'ready')
+        first = recommendation_engine.snapshot
+        self.assertEqual(len(first), 5)
+        self.assertFalse(first.song_features.flags.writeable)
+        
+        for i, song in enumerate(songs[5:], start=5):
+            song.set_features(sample_features(i))
+        db.session.commit()
+        self.assertTrue(recommendation_engine.train_async())
+        self.assertEqual(recommendation_engine.wait_for_training(10), 'ready')
+        
+        # A request holding the old snapshot still sees a consistent model
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(first.model.kneighbors(first.song_features[:1], 5)[1][0]), 5)
+        status = json.loads(self.app.get('/api/recommendations/model').data)
+        self.assertEqual(status['active']['songs'], 10)
+        self.assertEqual(status['previous'][0]['version'], first.version)
+        
+        self.assertEqual(self.app.post('/api/recommendations/model/rollback').status_code, 401)
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = User.query.filter_by(username='testuser').first().id
+        
+        # Songs of the old model deleted since are still excluded after rolling back to it
+        db.session.delete(Song.query.get(songs[0].id))
+        db.session.commit()
+        recommendation_engine.train()
+        recommendation_engine.rollback()
+        self.assertEqual(self.app.post('/api/recommendations/model/rollback').status_code, 200)
+        self.assertIs(recommendation_engine.snapshot, first)
+        self.assertEqual(feature_store.deleted_since_fit, {songs[0].id})
+        self.assertEqual(feature_store.changes_since_fit, 6)
+        self.assertEqual(self.app.post('/api/recommendations/model/rollback').status_code, 409)
+    
+    def test_model_artifacts_reused_after_restart(self):
+        """Test a saved fit is reloaded for an unchanged catalog and ignored once the catalog changes"""
+        songs = Song.query.order_by(Song.id).all()
+        for i, song in enumerate(songs[:6]):
+            song.set_features(sample_features(i))
+        db.session.commit()
+        
+        with tempfile.TemporaryDirectory() as artifact_dir:
+            recommendation_engine.artifact_dir = artifact_dir
+            try:
+                self.assertTrue(recommendation_engine.train())
+                manifest, = list_artifacts(artifact_dir)
+                self.assertEqual(manifest['songs'], 6)
+                self.assertEqual(verify_artifact(manifest['path']), [])
+                
+                # A fresh process reuses the saved index instead of fitting
+                restarted = RecommendationEngine(store=CatalogFeatureStore(), artifact_dir=artifact_dir)
+                self.assertTrue(restarted.load_latest_artifact())
+                self.assertEqual(restarted.snapshot.source, 'artifact')
+                self.assertEqual(sorted(restarted.song_ids.tolist()), [s.id for s in songs[:6]])
+                query = recommendation_engine.song_features[:1]
+                np.testing.assert_array_equal(restarted.model.kneighbors(query, 3)[1],
+                                              recommendation_engine.model.kneighbors(query, 3)[1])
+                
+                # A changed catalog or another backend needs a new fit
+                songs[0].set_features(sample_features(20))
+                db.session.commit()
+                self.assertFalse(RecommendationEngine(store=CatalogFeatureStore(),
+                                                      artifact_dir=artifact_dir).load_latest_artifact())
+                songs[0].set_features(sample_features(0))
+                db.session.commit()
+                self.assertFalse(RecommendationEngine(store=CatalogFeatureStore(), artifact_dir=artifact_dir,
+                                                      index_backend='brute').load_latest_artifact())
+                
+                # A tampered index is never unpickled; startup falls back to fitting
+                with open(os.path.join(manifest['path'], INDEX_FILE), 'ab') as f:
+                    f.write(b'corrupt')
+                self.assertIn(f'{INDEX_FILE} checksum mismatch', verify_artifact(manifest['path']))
+                with mock.patch('pickle.loads') as loads:
+                    self.assertFalse(RecommendationEngine(store=CatalogFeatureStore(),
+                                                          artifact_dir=artifact_dir).load_latest_artifact())
+                loads.assert_not_called()
+            finally:
+                recommendation_engine.artifact_dir = None
+    
+    def test_metrics_endpoint(self):
+        """Test request, SQL, Spotify and engine-stage timings are exposed in Prometheus text format"""
+        metrics.reset()
+        user = User.query.filter_by(username='testuser').first()
+        for i, song in enumerate(Song.query.order_by(Song.id)):
+            song.set_features(sample_features(i))
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = user.id
+        
+        self.assertEqual(self.app.get('/api/user/profile').status_code, 200)
+        self.assertEqual(self.app.get('/api/user/profile').status_code, 200)
+        self.assertTrue(recommendation_engine.train())
+        
+        fake = FakeSpotify()
+        original_url = SpotifyClient.BASE_URL
+        SpotifyClient.BASE_URL = fake.url + '/v1'
+        try:
+            track_id = '4uLU6hMCjMI75M1A2tKUQC'
+            fake.routes[f'/v1/tracks/{track_id}'] = [(503, {}, {}), (200, {}, {'id': track_id})]
+            spotify_http.backoff = 0.001
+            self.assertEqual(SpotifyClient.get_track('token', track_id), {'id': track_id})
+        finally:
+            spotify_http.backoff = flask_app.config['SPOTIFY_HTTP_BACKOFF']
+            SpotifyClient.BASE_URL = original_url
+            fake.close()
+        self.assertEqual(spotify_endpoint(f'https://api.spotify.com/v1/tracks/{track_id}'), '/v1/tracks/{id}')
+        
+        response = self.app.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text_format = response.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",route="/api/user/profile",status="200"} 2', text_format)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/api/user/profile"} 2', text_format)
+        self.assertIn('http_request_db_queries_count{method="GET",route="/api/user/profile"} 2', text_format)
+        self.assertIn('spotify_requests_total{method="GET",endpoint="/v1/tracks/{id}",status="503"} 1', text_format)
+        self.assertIn('spotify_requests_total{method="GET",endpoint="/v1/tracks/{id}",status="200"} 1', text_format)
+        self.assertIn('recommender_stage_duration_seconds_count{stage="train"} 1', text_format)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text_format)
+        self.assertGreater(metrics.queries.value(), 0)
+    
+    def test_popularity_lists(self):
+        """Test cold-start users get genre then global top-K lists that follow song changes in place"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()  # popularity 89 down to 80
+        for i, song in enumerate(songs):
+            song.genre = 'rock' if i % 2 else 'pop'
+        db.session.add(UserPreference(user_id=user.id, song_id=songs[1].id, rating=True))
+        db.session.commit()
+        
+        k = popularity_index.k
+        popularity_index.k = 3
+        try:
+            self.assertTrue(recommendation_engine.popularity_recommendations(user.id, 4))
+            recs = [rec.song_id for rec in Recommendation.query.filter_by(user_id=user.id)
+                    .order_by(Recommendation.recommendation_score.desc())]
+            # Liked genre first (rated song skipped), then the global list
+            self.assertEqual(recs, [songs[3].id, songs[5].id, songs[0].id, songs[2].id])
+            
+            # A new, more popular song is ranked in place without a reload
+            version = popularity_index.version
+            hit = Song(spotify_id='hit', title='Hit', artist='New', genre='rock', popularity=99)
+            db.session.add(hit)
+            db.session.commit()
+            self.assertGreater(popularity_index.version, version)
+            self.assertEqual(popularity_index.top(2, genres=['rock']), [hit.id, songs[1].id])
+            self.assertEqual(popularity_index.top(1), [hit.id])
+            
+            # A member losing popularity is refilled from the table on the next read
+            hit.popularity = 1
+            songs[0].genre = 'rock'
+            db.session.commit()
+            self.assertEqual(popularity_index.top(3), [songs[0].id, songs[1].id, songs[2].id])
+            self.assertEqual(popularity_index.top(3, exclude={songs[1].id}, genres=['rock']),
+                             [songs[0].id, songs[3].id, songs[2].id])
+            
+            # Writes that bypass the listeners (another process, bulk imports) show after a reloading fit
+            db.session.execute(Song.__table__.update().where(Song.id == songs[9].id).values(popularity=100))
+            db.session.commit()
+            self.assertEqual(popularity_index.top(1), [songs[0].id])
+            recommendation_engine.train(reload=True)
+            self.assertEqual(popularity_index.top(1), [songs[9].id])
+        finally:
+            popularity_index.k = k
+
+    def test_recommendation_filters(self):
+        """Test genre, artist and popularity filters are applied inside the neighbour search"""
+        user = User.query.filter_by(username='testuser').first()
+        songs = Song.query.order_by(Song.id).all()  # popularity 89 down to 80
+        for i, song in enumerate(songs):
+            song.genre = 'rock' if i % 2 else 'pop'
+            song.artist = f'Artist {i % 3}'
+            song.set_features(sample_features(i))
+        recommendation_engine.process_feedback(user.id, songs[0].id, True)
+        db.session.commit()
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = user.id
+        
+        def recommended():
+            return [db.session.get(Song, rec.song_id) for rec in Recommendation.query.filter_by(user_id=user.id)]
+        
+        # A narrow filter scans the allowed rows directly
+        recommendation_engine.filter_scan_fraction = 0.5
+        try:
+            response = self.app.post('/api/recommendations/generate',
+                                     json={'genre': 'Rock', 'exclude_artist': 'artist 1', 'min_popularity': 83})
+        finally:
+            recommendation_engine.filter_scan_fraction = 0.05
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(song.id for song in recommended()), [songs[3].id, songs[5].id])
+        
+        # Query-string filters through the index search
+        response = self.app.post('/api/recommendations/generate?genre=pop,rock&artist=Artist%202')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(song.id for song in recommended()), [songs[2].id, songs[5].id, songs[8].id])
+        self.assertEqual(self.app.post('/api/recommendations/generate', json={'min_popularity': 101}).status_code,
+                         400)
+        
+        batch = BatchRecommender(recommendation_engine, n_recommendations=4, workers=1,
+                                 filters=make_filters(genres=['pop']))
+        self.assertEqual(batch.run(), 4)
+        self.assertEqual({song.genre for song in recommended()}, {'pop'})
+        
+        # Sparse sets keep row numbers, dense ones a bitmap of the catalog
+        sparse, dense = RowSet([3, 70], 1000), RowSet(list(range(0, 1000, 2)), 1000)
+        self.assertIsNotNone(sparse.rows)
+        self.assertIsNone(dense.rows)
+        self.assertEqual(dense.nbytes, 125)
+        mask = dense.add_to(sparse.add_to(np.zeros(1000, dtype=bool)))
+        self.assertEqual(int(mask.sum()), 501)
+        self.assertEqual(list(dense.to_rows()[:3]), [0, 2, 4])
+
+    def test_catalog_import_resumes(self):
+        """Test dumps are upserted on spotify_id in chunks and an interrupted import resumes where it stopped"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tracks.jsonl')
+            with open(path, 'w') as f:
+                f.write(json.dumps({'id': 'spotify_id_1', 'name': 'Renamed', 'artists': [{'name': 'A'}, {'name': 'B'}],
+                                    'audio_features': sample_features(1)}) + '\n')
+                for i in range(2, 7):
+                    f.write(json.dumps({'spotify_id': f'new_{i}', 'title': f'New {i}', 'artist': 'C', 'genre': 'jazz',
+                                        'popularity': i, 'features': sample_features(i)}) + '\n')
+                f.write('{"title": "no id"}\n')
+                # New complete features replace the stored raw JSON; partial ones are not zero-filled
+                f.write(json.dumps({'spotify_id': 'spotify_id_2', 'title': 'Test Song 2', 'artist': 'Test Artist 2',
+                                    'features': sample_features(9)}) + '\n')
+                f.write(json.dumps({'spotify_id': 'spotify_id_3', 'title': 'Test Song 3', 'artist': 'Test Artist 3',
+                                    'danceability': 0.5}) + '\n')
+            for i in (2, 3):
+                Song.query.filter_by(spotify_id=f'spotify_id_{i}').first().set_features(sample_features(i))
+            Song.query.filter_by(spotify_id='spotify_id_1').first().features_status = 'failed'
+            db.session.commit()
+            user = User.query.filter_by(username='testuser').first()
+            recommendation_engine.process_feedback(user.id, Song.query.filter_by(spotify_id='spotify_id_2').one().id,
+                                                   True)
+            popularity_index.load_from_db()
+            
+            def interrupt(state):
+                raise KeyboardInterrupt
+            
+            importer = CatalogImporter(path, chunk_size=2)
+            with self.assertRaises(KeyboardInterrupt):
+                importer.run(interrupt)
+            self.assertEqual(Song.query.filter(Song.spotify_id.like('new_%')).count(), 1)
+            
+            state = CatalogImporter(path, chunk_size=2).run()
+            self.assertEqual((state['rows'], state['rejected'], state['partial_features']), (8, 1, 1))
+            self.assertFalse(os.path.exists(importer.state_path))
+            self.assertEqual(Song.query.count(), 15)
+            song = Song.query.filter_by(spotify_id='spotify_id_1').first()
+            # Values missing from the dump keep what was stored
+            self.assertEqual((song.title, song.artist, song.popularity), ('Renamed', 'A, B', 89))
+            np.testing.assert_allclose(song.get_vector(), normalize_features(sample_features(1)), rtol=1e-6)
+            song = Song.query.filter_by(spotify_id='spotify_id_2').first()
+            self.assertIsNone(song.features)
+            np.testing.assert_allclose(song.get_vector(), normalize_features(sample_features(9)), rtol=1e-6)
+            song = Song.query.filter_by(spotify_id='spotify_id_3').first()
+            self.assertEqual(song.get_features(), sample_features(3))
+            np.testing.assert_allclose(song.get_vector(), normalize_features(sample_features(3)), rtol=1e-6)
+            
+            # Each chunk does the Song listeners' work: enrichment state, profiles and popularity lists
+            self.assertIsNone(Song.query.filter_by(spotify_id='spotify_id_1').first().features_status)
+            self.assertIsNone(UserProfile.query.get(user.id))
+            np.testing.assert_allclose(recommendation_engine.get_user_profile(user.id),
+                                       normalize_features(sample_features(9)), rtol=1e-5)
+            self.assertEqual(popularity_index.top(1, genres=['jazz']),
+                             [Song.query.filter_by(spotify_id='new_6').one().id])
+            
+            csv_path = os.path.join(directory, 'tracks.csv')
+            with open(csv_path, 'w') as f:
+                columns = sorted(sample_features(0))
+                f.write(','.join(['track_id', 'track_name', 'artist_name', 'popularity'] + columns) + '\n')
+                f.write(','.join(['new_2', '"Title, with comma"', 'C', '77'] +
+                                 [str(sample_features(5)[name]) for name in columns]) + '\n')
+                f.write(','.join(['new_7', 'No features', 'C', '10'] + [''] * len(columns)) + '\n')
+            CatalogImporter(csv_path).run()
+            song = Song.query.filter_by(spotify_id='new_2').first()
+            self.assertEqual((song.title, song.popularity, song.genre), ('Title, with comma', 77, 'jazz'))
+            np.testing.assert_allclose(song.get_vector(), normalize_features(sample_features(5)), rtol=1e-6)
+            # Only the imported song without features is queued for enrichment
+            self.assertEqual(enrichment_queue.depth, 1)
+            self.assertEqual(enrichment_queue.next_batch(block=False),
+                             [Song.query.filter_by(spotify_id='new_7').one().id])
+        
+        # Text is cut to the column sizes
+        row, _ = song_row({'id': 'long', 'name': 't', 'artist': 'a', 'genre': 'g' * 200, 'preview_url': 'u' * 600})
+        self.assertEqual((len(row['genre']), len(row['preview_url'])), (128, 512))
+
 if __name__ == '__main__':
     unittest.main()